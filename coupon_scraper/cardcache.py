@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from scrapy import signals
+
+
+# Cached result of a card that isn't a coupon, told apart from a miss
+MISSING = object()
+
+
+class CardCache:
+    """Bounded LRU cache of the fields extracted from coupon cards
+
+    The same card shows up on several listing pages and on every run, and
+    running the selector cascade on it is the costliest part of parsing a
+    page. Entries are keyed by a hash of the card's outer HTML (whitespace
+    collapsed) and the spider's extraction profile, so a changed card or
+    changed extraction code never hits a stale entry. The value is the
+    field dict, without the page URL, or None for a card that isn't a
+    coupon.
+
+    The CPU saved is an estimate: the average extraction time of the
+    misses times the hits, less the time spent serializing and hashing the
+    cards that hit.
+    """
+
+    def __init__(self, max_size=10000, path=None, stats=None):
+        self.max_size = max_size
+        self.path = path
+        self.stats = stats
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+        # Average extraction time of earlier runs, until this one has misses
+        self.extract_time = 0.0
+        if path and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Cache configured by the CARD_CACHE_* settings, or None when disabled"""
+        settings = crawler.settings
+        if not settings.getbool('CARD_CACHE_ENABLED'):
+            return None
+        cache = cls(settings.getint('CARD_CACHE_SIZE', 10000), settings.get('CARD_CACHE_FILE'), crawler.stats)
+        crawler.signals.connect(cache.spider_closed, signal=signals.spider_closed)
+        return cache
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(html, profile):
+        digest = hashlib.blake2b(profile.encode(), digest_size=16)
+        digest.update(' '.join(html.split()).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        fields = self.entries.get(key, MISSING)
+        if fields is not MISSING:
+            self.entries.move_to_end(key)
+        return fields
+
+    def put(self, key, fields):
+        self.entries[key] = fields
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            if self.stats:
+                self.stats.inc_value('card_cache/evictions')
+
+    def extract(self, card, profile, extract):
+        """Fields of the ``card`` selector, from the cache or from ``extract(card)``"""
+        started = time.process_time()
+        key = self.key(card.get(), profile)
+        fields = self.get(key)
+        if fields is not MISSING:
+            self.hits += 1
+            self.hit_time += time.process_time() - started
+            return fields
+        fields = extract(card)
+        self.put(key, fields)
+        self.misses += 1
+        self.miss_time += time.process_time() - started
+        return fields
+
+    def cpu_saved(self):
+        average = self.miss_time / self.misses if self.misses else self.extract_time
+        return self.hits * average - self.hit_time
+
+    def update_stats(self):
+        lookups = self.hits + self.misses
+        self.stats.set_value('card_cache/hits', self.hits)
+        self.stats.set_value('card_cache/misses', self.misses)
+        self.stats.set_value('card_cache/hit_rate', round(self.hits / lookups, 3) if lookups else 0.0)
+        self.stats.set_value('card_cache/cpu_saved', round(self.cpu_saved(), 3))
+        self.stats.set_value('card_cache/size', len(self.entries))
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self.extract_time = data.get('extract_time', 0.0)
+        # Saved least recently used first
+        for key, fields in list(data['entries'].items())[-self.max_size:]:
+            self.entries[key] = fields
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        extract_time = self.miss_time / self.misses if self.misses else self.extract_time
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'extract_time': extract_time, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def spider_closed(self, spider):
+        if self.stats:
+            self.update_stats()
+        self.save()
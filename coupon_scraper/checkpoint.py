@@ -0,0 +1,376 @@
+import json
+import os
+import time
+from datetime import datetime
+
+from itemadapter import is_item
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import JsonLinesItemExporter
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+
+from coupon_scraper.pipelines import DuplicatesPipeline
+
+
+JOURNAL_FILE = 'journal.jsonl'
+META_FILE = 'checkpoint.json'
+
+
+def encode_request(request, spider):
+    """JSON-safe dict of a request (bytes are kept as latin-1 text)"""
+    d = request.to_dict(spider=spider)
+    d['body'] = d['body'].decode('latin1')
+    d['headers'] = {
+        name.decode('latin1'): [value.decode('latin1') for value in values]
+        for name, values in d['headers'].items()
+    }
+    return d
+
+
+def decode_request(d, spider):
+    d = dict(d, body=d['body'].encode('latin1'))
+    return request_from_dict(d, spider=spider)
+
+
+class CheckpointState:
+    """Crawl state as of the last commit of a journal"""
+
+    def __init__(self):
+        self.pending = {}     # fingerprint -> encoded request (None if it couldn't be encoded)
+        self.seen = set()     # fingerprints of every scheduled request
+        self.item_ids = set()
+        self.offset = 0
+        self.items = 0
+        self.closed = None
+
+    @classmethod
+    def load(cls, path):
+        """Replay a journal, ignoring everything after its last commit record"""
+        state = cls()
+        pending, seen, item_ids = {}, set(), set()
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write of a crash: nothing after the last commit counts
+                    break
+                if 's' in record:
+                    seen.add(record['s'])
+                    if 'r' in record or 'p' in record:
+                        pending[record['s']] = record.get('r')
+                elif 'd' in record:
+                    pending.pop(record['d'], None)
+                elif 'i' in record:
+                    item_ids.add(record['i'])
+                elif 'c' in record:
+                    state.pending = dict(pending)
+                    state.seen = set(seen)
+                    state.item_ids = set(item_ids)
+                    state.offset = record['c']
+                    state.items = record['items']
+                    state.closed = record.get('closed')
+        return state
+
+    def compacted_records(self):
+        """Journal records equivalent to this state"""
+        for fp in self.seen - self.pending.keys():
+            yield {'s': fp}
+        for fp, request in self.pending.items():
+            yield {'s': fp, 'r': request} if request is not None else {'s': fp, 'p': 1}
+        for item_id in self.item_ids:
+            yield {'i': item_id}
+        yield {'c': self.offset, 'items': self.items}
+
+
+class CrawlCheckpoint:
+    """Extension making a crawl resumable after a crash or a stop
+
+    Every scheduled request (that the dupefilter didn't drop), every
+    completed request and every exported item is appended to a journal in ``CHECKPOINT_DIR``, and items are
+    written to a JSON lines feed (``CHECKPOINT_FEED``) owned by the
+    extension. Every ``CHECKPOINT_INTERVAL`` seconds the feed and the
+    journal are flushed to disk and a commit record with the feed size is
+    appended. A request only counts as completed once every item its
+    callback produced has been exported or dropped.
+
+    With ``CHECKPOINT_RESUME`` the journal is replayed up to its last
+    commit: the feed is truncated to the committed size, the requests that
+    were pending are scheduled instead of the spider's start requests,
+    fingerprints of requests seen before are filtered from the spider
+    output, and DuplicatesPipeline gets the ids of the exported items back,
+    so the resumed crawl neither loses nor repeats items. Requests whose
+    download failed stay pending and are retried on resume.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.directory = settings.get('CHECKPOINT_DIR')
+        self.interval = settings.getfloat('CHECKPOINT_INTERVAL', 10)
+        self.resume = settings.getbool('CHECKPOINT_RESUME')
+        self.feed_path = settings.get('CHECKPOINT_FEED') or os.path.join(self.directory, 'items.jsonl')
+        self.journal_path = os.path.join(self.directory, JOURNAL_FILE)
+        self.fingerprinter = crawler.request_fingerprinter
+
+        self.state = None
+        self.unconfirmed = None
+        self.journal = None
+        self.feed = None
+        self.exporter = None
+        self.items = 0
+        self.outstanding = {}           # fingerprint -> items produced but not yet exported or dropped
+        self.item_owners = {}           # id(item) -> fingerprint of the request that produced it
+        self.callbacks_done = set()     # fingerprints whose callback finished before its items
+        self.time_spent = 0.0
+        self.commit_loop = task.LoopingCall(self.commit)
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.resume and os.path.exists(self.journal_path):
+            self.state = CheckpointState.load(self.journal_path)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('CHECKPOINT_DIR'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(ext.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(ext.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(ext.item_error, signal=signals.item_error)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def fingerprint(self, request):
+        return self.fingerprinter.fingerprint(request).hex()
+
+    def spider_opened(self, spider):
+        if self.state is not None:
+            self.restore(spider)
+        else:
+            if self.resume:
+                spider.logger.warning(f'No checkpoint journal in {self.directory}, starting a new crawl')
+            self.journal = open(self.journal_path, 'w')
+            self.feed = open(self.feed_path, 'wb')
+            with open(os.path.join(self.directory, META_FILE), 'w') as f:
+                json.dump({'spider': spider.name, 'feed': os.path.abspath(self.feed_path)}, f)
+        self.exporter = JsonLinesItemExporter(self.feed)
+        self.exporter.start_exporting()
+        self.commit_loop.start(self.interval, now=False)
+
+    def restore(self, spider):
+        state = self.state
+        # Rewrite the journal compacted to the committed state, so torn
+        # records and superseded entries don't accumulate across resumes
+        tmp_path = f'{self.journal_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in state.compacted_records():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+
+        self.feed = open(self.feed_path, 'r+b' if os.path.exists(self.feed_path) else 'wb')
+        self.feed.truncate(state.offset)
+        self.feed.seek(state.offset)
+        self.items = state.items
+
+        pipeline = self.crawler.get_item_pipeline(DuplicatesPipeline)
+        if pipeline is not None:
+            pipeline.ids_seen.update(state.item_ids)
+
+        self.stats.set_value('checkpoint/resumed_pending', len(state.pending))
+        self.stats.set_value('checkpoint/resumed_items', state.items)
+        spider.logger.info(
+            f'Resuming from checkpoint: {len(state.pending)} pending requests, '
+            f'{len(state.seen)} seen, {state.items} items already exported'
+        )
+
+    def pending_requests(self, spider):
+        """Requests to schedule instead of the start requests when resuming"""
+        for fp, encoded in self.state.pending.items():
+            if encoded is None:
+                self.stats.inc_value('checkpoint/unrestorable')
+                continue
+            request = decode_request(encoded, spider)
+            # Already in the seen set of the previous run
+            yield request.replace(dont_filter=True)
+
+    def is_seen(self, request):
+        """Whether a request was already scheduled by the run being resumed"""
+        if self.state is None or request.dont_filter:
+            return False
+        return self.fingerprint(request) in self.state.seen
+
+    def write(self, record):
+        self.confirm_scheduled()
+        self.journal.write(json.dumps(record) + '\n')
+
+    def request_scheduled(self, request, spider):
+        self.confirm_scheduled()
+        # The dupefilter runs right after this signal; the request is only
+        # journaled once it is known not to have been dropped
+        self.unconfirmed = request
+
+    def request_dropped(self, request, spider):
+        if request is self.unconfirmed:
+            self.unconfirmed = None
+
+    def confirm_scheduled(self):
+        request, self.unconfirmed = self.unconfirmed, None
+        if request is None:
+            return
+        started = time.perf_counter()
+        fp = self.fingerprint(request)
+        try:
+            line = json.dumps({'s': fp, 'r': encode_request(request, self.crawler.spider)})
+        except (ValueError, TypeError):
+            # e.g. a callback that is not a spider method
+            self.stats.inc_value('checkpoint/unserializable')
+            line = json.dumps({'s': fp, 'p': 1})
+        self.journal.write(line + '\n')
+        self.time_spent += time.perf_counter() - started
+
+    def response_received(self, response, request, spider):
+        # Error responses never produce output; don't retry them on resume
+        if not 200 <= response.status < 300:
+            self.complete(self.fingerprint(request))
+
+    def item_produced(self, item, fp):
+        self.outstanding[fp] = self.outstanding.get(fp, 0) + 1
+        self.item_owners[id(item)] = fp
+
+    def callback_finished(self, fp):
+        if self.outstanding.get(fp):
+            self.callbacks_done.add(fp)
+        else:
+            self.complete(fp)
+
+    def item_settled(self, item):
+        fp = self.item_owners.pop(id(item), None)
+        if fp is None:
+            return
+        self.outstanding[fp] -= 1
+        if not self.outstanding[fp]:
+            del self.outstanding[fp]
+            if fp in self.callbacks_done:
+                self.callbacks_done.discard(fp)
+                self.complete(fp)
+
+    def complete(self, fp):
+        self.write({'d': fp})
+
+    def item_scraped(self, item, spider):
+        started = time.perf_counter()
+        self.exporter.export_item(item)
+        self.items += 1
+        self.write({'i': DuplicatesPipeline.item_id(item)})
+        self.item_settled(item)
+        self.time_spent += time.perf_counter() - started
+
+    def item_dropped(self, item, response, exception, spider):
+        self.item_settled(item)
+
+    def item_error(self, item, response, spider, failure):
+        self.item_settled(item)
+
+    def commit(self, closed=None):
+        """Make everything recorded so far durable, and mark the point a resume restarts from"""
+        self.confirm_scheduled()
+        started = time.perf_counter()
+        self.feed.flush()
+        os.fsync(self.feed.fileno())
+        record = {'c': self.feed.tell(), 'items': self.items}
+        if closed:
+            record['closed'] = closed
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.time_spent += time.perf_counter() - started
+        self.stats.inc_value('checkpoint/commits')
+
+    def spider_closed(self, spider, reason):
+        if self.commit_loop.running:
+            self.commit_loop.stop()
+        self.exporter.finish_exporting()
+        self.commit(closed=reason)
+        self.journal.close()
+        self.feed.close()
+
+        self.stats.set_value('checkpoint/time', round(self.time_spent, 4))
+        start_time = self.stats.get_value('start_time')
+        if start_time:
+            elapsed = (datetime.now(tz=start_time.tzinfo) - start_time).total_seconds()
+            if elapsed > 0:
+                self.stats.set_value('checkpoint/overhead', round(self.time_spent / elapsed, 4))
+
+
+class CheckpointMiddleware:
+    """Spider middleware reporting callback completion to CrawlCheckpoint
+
+    It also replaces the start requests with the pending requests when
+    resuming, and filters requests the resumed run had already seen.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.checkpoint = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('CHECKPOINT_DIR'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def get_checkpoint(self):
+        if self.checkpoint is None:
+            self.checkpoint = self.crawler.get_extension(CrawlCheckpoint)
+        return self.checkpoint
+
+    async def process_start(self, start):
+        checkpoint = self.get_checkpoint()
+        if checkpoint is None or checkpoint.state is None:
+            async for element in start:
+                yield element
+            return
+        for request in checkpoint.pending_requests(self.crawler.spider):
+            yield request
+
+    def process_spider_output(self, response, result):
+        checkpoint = self.get_checkpoint()
+        fp = checkpoint.fingerprint(response.request)
+        try:
+            for element in result:
+                if self.keep(checkpoint, element, fp):
+                    yield element
+        finally:
+            checkpoint.callback_finished(fp)
+
+    async def process_spider_output_async(self, response, result):
+        checkpoint = self.get_checkpoint()
+        fp = checkpoint.fingerprint(response.request)
+        try:
+            async for element in result:
+                if self.keep(checkpoint, element, fp):
+                    yield element
+        finally:
+            checkpoint.callback_finished(fp)
+
+    def keep(self, checkpoint, element, fp):
+        if isinstance(element, Request):
+            if checkpoint.is_seen(element):
+                checkpoint.stats.inc_value('checkpoint/filtered_seen')
+                return False
+        elif is_item(element):
+            checkpoint.item_produced(element, fp)
+        return True
+
+    def process_spider_exception(self, response, exception):
+        checkpoint = self.get_checkpoint()
+        checkpoint.callback_finished(checkpoint.fingerprint(response.request))
+        return None
+
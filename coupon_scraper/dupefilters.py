@@ -0,0 +1,226 @@
+"""
+Request dupefilter keeping fingerprints as fixed-width integers.
+
+Scrapy's RFPDupeFilter keeps each request fingerprint as a 20 byte
+``bytes`` object in a set, about 100 bytes per request once the object
+and set overheads are counted. CompactDupeFilter keeps the first 8 bytes
+of each fingerprint as an unsigned 64-bit integer in an open-addressing
+hash table: 8 bytes a slot, 11 to 23 bytes per request depending on how
+full the table is. Fingerprints are SHA-1 digests, so two different
+requests share a key with probability about n^2 / 2^65, 3 in a million
+for a whole 10M request crawl.
+
+With JOBDIR the table is a memory-mapped file: what's written survives
+a crash of the crawl, and a resumed crawl maps the table back instead of
+reading every fingerprint again. A ``requests.seen`` left by RFPDupeFilter in
+the job directory is imported on the first run.
+"""
+
+import logging
+import mmap
+import os
+from array import array
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+
+logger = logging.getLogger(__name__)
+
+TABLE_FILE = 'requests.seen.table'
+LEGACY_FILE = 'requests.seen'
+
+# Header of a table file, in 64-bit words: magic, number of keys
+MAGIC = int.from_bytes(b'CDFTBL01', 'little')
+HEADER = 2
+MAX_LOAD = 0.7
+
+
+class FingerprintTable:
+    """Set of non-zero 64-bit keys, in an array or a memory-mapped file
+
+    Linear probing; the table doubles when it's ``MAX_LOAD`` full. A file
+    table grows into a new file that replaces the old one once it's
+    complete, so a crash never leaves a half-copied table behind.
+    """
+
+    def __init__(self, capacity=1 << 16, path=None):
+        self.path = path
+        self.map = None
+        if path and os.path.exists(path) and not self.open_file(path):
+            logger.warning(f'Ignoring {path}: not a fingerprint table')
+        if self.map is None:
+            capacity = max(16, 1 << (capacity - 1).bit_length())
+            self.use(*self.allocate(capacity, path), capacity)
+
+    def __len__(self):
+        return self.slots[1]
+
+    def __contains__(self, key):
+        slots = self.slots
+        mask = self.mask
+        i = key & mask
+        while True:
+            slot = slots[HEADER + i]
+            if slot == key:
+                return True
+            if slot == 0:
+                return False
+            i = (i + 1) & mask
+
+    @property
+    def capacity(self):
+        return self.mask + 1
+
+    @property
+    def nbytes(self):
+        return (HEADER + self.capacity) * 8
+
+    @staticmethod
+    def allocate(capacity, path=None):
+        """Empty slots for ``capacity`` keys, and the mmap holding them if in a file"""
+        if path:
+            with open(path, 'wb') as f:
+                f.truncate((HEADER + capacity) * 8)
+            map_ = map_file(path)
+            slots = memoryview(map_).cast('Q')
+        else:
+            map_ = None
+            slots = array('Q', bytes((HEADER + capacity) * 8))
+        slots[0] = MAGIC
+        return slots, map_
+
+    def use(self, slots, map_, capacity):
+        self.slots = slots
+        self.map = map_
+        self.mask = capacity - 1
+        self.limit = int(capacity * MAX_LOAD)
+
+    def open_file(self, path):
+        capacity = os.path.getsize(path) // 8 - HEADER
+        if capacity < 16 or capacity & (capacity - 1):
+            return False
+        map_ = map_file(path)
+        slots = memoryview(map_).cast('Q')
+        if slots[0] != MAGIC:
+            slots.release()
+            map_.close()
+            return False
+        self.use(slots, map_, capacity)
+        return True
+
+    def add(self, key):
+        """Add ``key``, returning False if it was already there"""
+        slots = self.slots
+        mask = self.mask
+        i = key & mask
+        while True:
+            slot = slots[HEADER + i]
+            if slot == key:
+                return False
+            if slot == 0:
+                break
+            i = (i + 1) & mask
+        slots[HEADER + i] = key
+        slots[1] += 1
+        if slots[1] > self.limit:
+            self.grow()
+        return True
+
+    def keys(self):
+        return (key for key in self.slots[HEADER:] if key)
+
+    def grow(self):
+        capacity = self.capacity * 2
+        mask = capacity - 1
+        tmp_path = f'{self.path}.tmp' if self.path else None
+        slots, map_ = self.allocate(capacity, tmp_path)
+        for key in self.keys():
+            i = key & mask
+            while slots[HEADER + i]:
+                i = (i + 1) & mask
+            slots[HEADER + i] = key
+        slots[1] = self.slots[1]
+        self.close()
+        if tmp_path:
+            map_.flush()
+            os.replace(tmp_path, self.path)
+        self.use(slots, map_, capacity)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.slots.release()
+            self.map.close()
+            self.map = None
+
+
+def map_file(path):
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), 0)
+
+
+def fingerprint_key(fingerprint):
+    """Table key of a request fingerprint: its first 8 bytes, never 0"""
+    return int.from_bytes(fingerprint[:8], 'little') or 1
+
+
+def read_legacy_fingerprints(path):
+    """Fingerprints of an RFPDupeFilter ``requests.seen`` (2 byte length, then the fingerprint)"""
+    # RFPDupeFilter can't read the file for us: its __init__ loads it into
+    # the private _fingerprints set through the private _read_fingerprints(),
+    # and a set of every fingerprint is the memory this filter avoids. The
+    # format parsed here is the one documented in RFPDupeFilter's docstring.
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + 2 <= len(data):
+        size = int.from_bytes(data[pos:pos + 2], 'big')
+        fingerprint = data[pos + 2:pos + 2 + size]
+        if len(fingerprint) < size:  # truncated by a crash
+            return
+        yield fingerprint
+        pos += 2 + size
+
+
+class CompactDupeFilter(RFPDupeFilter):
+    """RFPDupeFilter storing fingerprints in a FingerprintTable
+
+    ``DUPEFILTER_CAPACITY`` is the initial number of table slots; set it
+    to about 1.5 times the expected requests to avoid growing the table.
+    """
+
+    def __init__(self, path=None, debug=False, *, fingerprinter=None, capacity=1 << 16, stats=None):
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.stats = stats
+        self.table = FingerprintTable(capacity, os.path.join(path, TABLE_FILE) if path else None)
+        legacy_path = os.path.join(path, LEGACY_FILE) if path else None
+        if not len(self.table) and legacy_path and os.path.exists(legacy_path):
+            for fingerprint in read_legacy_fingerprints(legacy_path):
+                self.table.add(fingerprint_key(fingerprint))
+            logger.info(f'Imported {len(self.table)} fingerprints from {legacy_path}')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            job_dir(settings),
+            settings.getbool('DUPEFILTER_DEBUG'),
+            fingerprinter=crawler.request_fingerprinter,
+            capacity=settings.getint('DUPEFILTER_CAPACITY', 1 << 16),
+            stats=crawler.stats,
+        )
+
+    def request_seen(self, request):
+        # fingerprint_key(), inlined
+        return not self.table.add(int.from_bytes(self.fingerprinter.fingerprint(request)[:8], 'little') or 1)
+
+    def close(self, reason):
+        if self.stats is not None:
+            self.stats.set_value('dupefilter/fingerprints', len(self.table))
+            self.stats.set_value('dupefilter/table_bytes', self.table.nbytes)
+        self.table.flush()
+        self.table.close()
@@ -0,0 +1,139 @@
+from datetime import datetime
+
+from scrapy.exporters import BaseItemExporter
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is only needed for the columnar feed formats
+    pa = None
+
+from coupon_scraper.normalize import parse_expiry_date
+
+
+def parse_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def coupon_schema():
+    """Fixed, typed Arrow schema for CouponItem"""
+    return pa.schema([
+        ('title', pa.string()),
+        ('code', pa.string()),
+        ('description', pa.string()),
+        ('expiry_date', pa.date32()),
+        ('store', pa.dictionary(pa.int32(), pa.string())),
+        ('url', pa.string()),
+        ('scraped_at', pa.timestamp('us')),
+        ('discount_percentage', pa.int32()),
+        ('discount_amount', pa.float64()),
+        ('minimum_spend', pa.float64()),
+        ('bogo', pa.string()),
+        ('free_shipping', pa.bool_()),
+        ('category', pa.dictionary(pa.int32(), pa.string())),
+        ('terms_conditions', pa.string()),
+    ])
+
+
+# Converters from item values to the schema's column types
+COLUMN_CONVERTERS = {
+    'expiry_date': parse_expiry_date,
+    'scraped_at': parse_timestamp,
+    'discount_percentage': parse_int,
+}
+
+
+class ColumnarItemExporter(BaseItemExporter):
+    """Buffer items column-wise and write them in fixed size batches
+
+    At most ``row_group_size`` items are held in memory; each full buffer
+    becomes one Parquet row group or Arrow record batch. Use the feed's
+    ``batch_item_count`` option to roll over to a new file by row count.
+
+    Dictionary-encoded columns share one dictionary across the batches of
+    a file, only ever appended to: Arrow IPC files can't replace a
+    dictionary between batches, only extend it.
+    """
+
+    def __init__(self, file, **kwargs):
+        if pa is None:
+            raise ImportError('pyarrow is required for the parquet and arrow feed formats')
+        self.row_group_size = int(kwargs.pop('row_group_size', 10000))
+        self._configure(kwargs, dont_fail=True)
+        self.file = file
+        self.schema = coupon_schema()
+        self.writer = None
+        # Dictionary column -> {value: index}, in the order values were first seen
+        self.dictionaries = {field.name: {} for field in self.schema if pa.types.is_dictionary(field.type)}
+        self.reset_buffer()
+
+    def reset_buffer(self):
+        self.columns = {name: [] for name in self.schema.names}
+        self.buffered = 0
+
+    def start_exporting(self):
+        self.writer = self.open_writer()
+
+    def export_item(self, item):
+        for name, values in self.columns.items():
+            value = item.get(name)
+            converter = COLUMN_CONVERTERS.get(name)
+            if converter:
+                value = converter(value)
+            elif name in self.dictionaries and value is not None:
+                dictionary = self.dictionaries[name]
+                value = dictionary.setdefault(value, len(dictionary))
+            values.append(value)
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if field.name in self.dictionaries:
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(values, pa.int32()), pa.array(list(self.dictionaries[field.name]), pa.string())))
+            else:
+                arrays.append(pa.array(values, field.type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.reset_buffer()
+
+    def finish_exporting(self):
+        self.flush()
+        self.writer.close()
+
+    def open_writer(self):
+        raise NotImplementedError
+
+
+class ParquetItemExporter(ColumnarItemExporter):
+    """Export CouponItems to Parquet, one row group per buffered batch"""
+
+    def __init__(self, file, **kwargs):
+        self.compression = kwargs.pop('compression', 'zstd')
+        super().__init__(file, **kwargs)
+
+    def open_writer(self):
+        return pq.ParquetWriter(self.file, self.schema, compression=self.compression)
+
+
+class ArrowItemExporter(ColumnarItemExporter):
+    """Export CouponItems to the Arrow IPC file format, one record batch per buffered batch"""
+
+    def open_writer(self):
+        return pa.ipc.new_file(self.file, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
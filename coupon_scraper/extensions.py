@@ -0,0 +1,207 @@
+import os
+import time
+import tracemalloc
+from datetime import datetime
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+from scrapy.selector import Selector
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.trackref import live_refs
+
+from coupon_scraper.items import CouponItem
+from coupon_scraper.resolver import PersistentCachingResolver
+
+
+class MemoryDiagnostics:
+    """Extension to find what makes long crawls grow in memory
+
+    Every ``MEMDIAG_INTERVAL`` responses it logs the allocation sites that
+    grew the most over the last ``MEMDIAG_WINDOW`` responses (with their
+    growth per response), together with the live ``Response``, ``Selector``
+    and ``CouponItem`` counts and the process RSS. tracemalloc, which makes
+    parsing several times slower, only runs during these windows: it is
+    started ``MEMDIAG_WINDOW`` responses before each snapshot and stopped
+    after it, so the rest of the crawl runs at full speed (measured with
+    ``run_benchmarks.py --memdiag``).
+    """
+
+    tracked_types = {
+        'Response': Response,
+        'Selector': Selector,
+        'CouponItem': CouponItem,
+    }
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.interval = settings.getint('MEMDIAG_INTERVAL', 500)
+        self.window = min(settings.getint('MEMDIAG_WINDOW', 50), self.interval)
+        self.top = settings.getint('MEMDIAG_TOP', 10)
+        self.frames = settings.getint('MEMDIAG_FRAMES', 1)
+        self.report_file = settings.get('MEMDIAG_FILE')
+        self.responses = 0
+        self.snapshot = None
+        self.window_start = 0
+        self.started_tracing = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('MEMDIAG_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self.open_window()
+        spider.logger.info(f'Memory diagnostics enabled, snapshot of the last {self.window} '
+                           f'of every {self.interval} responses')
+
+    def response_received(self, response, request, spider):
+        self.responses += 1
+        if self.snapshot is not None and self.responses % self.interval == 0:
+            self.report(spider)
+            self.close_window()
+        self.open_window()
+
+    def spider_closed(self, spider):
+        if self.snapshot is not None and self.responses != self.window_start:
+            self.report(spider)
+        self.close_window()
+
+    def open_window(self):
+        """Start tracing if the next snapshot is ``window`` responses away"""
+        if self.snapshot is not None or (self.responses + self.window) % self.interval:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.snapshot = self.take_snapshot()
+        self.window_start = self.responses
+
+    def close_window(self):
+        self.snapshot = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+
+    def live_counts(self):
+        """Live instance counts of the tracked types (and their subclasses)"""
+        counts = dict.fromkeys(self.tracked_types, 0)
+        for cls, refs in list(live_refs.items()):
+            for name, tracked in self.tracked_types.items():
+                if issubclass(cls, tracked):
+                    counts[name] += len(refs)
+        return counts
+
+    def report(self, spider):
+        started = time.perf_counter()
+        snapshot = self.take_snapshot()
+        responses = max(self.responses - self.window_start, 1)
+        diffs = snapshot.compare_to(self.snapshot, 'lineno')
+        diffs = [d for d in diffs if d.size_diff > 0][:self.top]
+
+        current, peak = tracemalloc.get_traced_memory()
+        counts = self.live_counts()
+        rss = get_rss()
+
+        self.stats.inc_value('memdiag/snapshots')
+        self.stats.set_value('memdiag/traced_current', current)
+        self.stats.max_value('memdiag/traced_peak', peak)
+        if rss:
+            self.stats.set_value('memdiag/rss', rss)
+            self.stats.max_value('memdiag/rss_max', rss)
+        for name, count in counts.items():
+            self.stats.set_value(f'memdiag/live/{name}', count)
+            self.stats.max_value(f'memdiag/live_max/{name}', count)
+
+        lines = [
+            f'{datetime.now().isoformat()} responses={self.responses} window={responses} '
+            f'traced={current / 1024:.0f}KiB peak={peak / 1024:.0f}KiB rss={rss / 1024:.0f}KiB',
+            'live: ' + ' '.join(f'{name}={count}' for name, count in counts.items()),
+        ]
+        for diff in diffs:
+            frame = diff.traceback[0]
+            lines.append(
+                f'  +{diff.size_diff / 1024:.1f}KiB ({diff.size_diff / responses:.0f}B/response) '
+                f'+{diff.count_diff} blocks {frame.filename}:{frame.lineno}'
+            )
+        self.stats.inc_value('memdiag/report_time', time.perf_counter() - started)
+
+        spider.logger.info('Memory diagnostics:\n' + '\n'.join(lines))
+        if self.report_file:
+            with open(self.report_file, 'a') as f:
+                f.write('\n'.join(lines) + '\n\n')
+
+
+class DNSCacheWarmup:
+    """Extension to resolve the spider's hosts at spider open
+
+    Hosts of the start URLs that PersistentCachingResolver did not preload
+    are resolved concurrently as soon as the spider opens, overlapping the lookups with engine start-up
+    instead of serializing them in front of the first requests. At spider
+    close the hosts this crawl requested are counted in its stats by how
+    the resolver got them: from the cache file or by a lookup.
+    """
+
+    def __init__(self, crawler):
+        self.stats = crawler.stats
+        self.resolver = None
+        self.hosts = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('DNSCACHE_ENABLED') or not crawler.settings.get('DNSCACHE_FILE'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        from twisted.internet import reactor
+        from scrapy.resolver import dnscache
+
+        if isinstance(reactor.resolver, PersistentCachingResolver):
+            self.resolver = reactor.resolver
+        hosts = {urlparse(url).hostname for url in getattr(spider, 'start_urls', [])}
+        hosts = sorted(host for host in hosts if host and host not in dnscache)
+        for host in hosts:
+            reactor.resolve(host).addErrback(lambda failure: None)
+        self.stats.set_value('dns_cache/warmed', len(hosts))
+
+    def request_reached_downloader(self, request, spider):
+        self.hosts.add(urlparse_cached(request).hostname)
+
+    def spider_closed(self, spider):
+        if self.resolver is None:
+            return
+        preloaded = self.resolver.preloaded
+        hits = [host for host in self.hosts if host in preloaded]
+        self.stats.set_value('dns_cache/preloaded', len(preloaded))
+        self.stats.set_value('dns_cache/hits', len(hits))
+        self.stats.set_value('dns_cache/lookups', sum(1 for host in self.hosts if host in self.resolver.looked_up))
+        self.stats.set_value('dns_cache/time_saved',
+                             round(sum(preloaded[host].get('latency', 0.0) for host in hits), 4))
+
+
+def get_rss():
+    """Current resident set size in bytes (0 where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
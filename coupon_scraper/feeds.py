@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import JsonLinesItemExporter
+from twisted.internet import task
+try:
+    # Python 3.14+, or the backports.zstd package on older versions
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+SEGMENT_EXTENSIONS = {
+    'zstd': '.jsonl.zst',
+    'gzip': '.jsonl.gz',
+    'none': '.jsonl',
+}
+
+
+class HashingWriter:
+    """Write-through wrapper counting and hashing the bytes that reach disk"""
+
+    mode = 'wb'
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+class CountingWriter:
+    """Write-through wrapper counting the bytes handed to a compressor"""
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def check_compression(compression):
+    """Raise ValueError if ``compression`` can't be used in this environment"""
+    if compression not in SEGMENT_EXTENSIONS:
+        raise ValueError(f'Unknown feed compression: {compression}')
+    if compression == 'zstd' and zstd is None and zstandard is None:
+        raise ValueError('zstd compression requires Python 3.14, backports.zstd or zstandard')
+
+
+def open_compressed(raw, compression, level=None):
+    """Wrap a binary file in a streaming compressor (closing it leaves ``raw`` open)
+
+    ``compression`` must have passed check_compression().
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level or 6)
+    if compression == 'zstd':
+        if zstd is not None:
+            return zstd.ZstdFile(raw, mode='wb', level=level)
+        return zstandard.ZstdCompressor(level=level or 3).stream_writer(raw, closefd=False)
+    return raw
+
+
+class Segment:
+    """One feed segment being written under a temporary name"""
+
+    def __init__(self, directory, name, compression, level):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.tmp_path = f'{self.path}.part'
+        self.raw = open(self.tmp_path, 'wb')
+        self.hashing = HashingWriter(self.raw)
+        self.stream = open_compressed(self.hashing, compression, level)
+        self.counting = CountingWriter(self.stream)
+        self.exporter = JsonLinesItemExporter(self.counting)
+        self.exporter.start_exporting()
+        self.items = 0
+        self.started = time.time()
+
+    def export_item(self, item):
+        self.exporter.export_item(item)
+        self.items += 1
+
+    def close(self):
+        """Finish the segment and move it to its final name atomically"""
+        self.exporter.finish_exporting()
+        if self.stream is not self.hashing:
+            self.stream.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.tmp_path, self.path)
+        return {
+            'name': self.name,
+            'items': self.items,
+            'bytes': self.hashing.bytes_written,
+            'uncompressed_bytes': self.counting.bytes_written,
+            'sha256': self.hashing.sha256.hexdigest(),
+            'started_at': datetime.fromtimestamp(self.started).isoformat(),
+            'finished_at': datetime.now().isoformat(),
+        }
+
+
+class SegmentedFeed:
+    """Extension writing items to compressed, rotating JSON lines segments
+
+    Items are compressed as they are written (``SEGMENTED_FEED_COMPRESSION``:
+    gzip, zstd or none) into ``SEGMENTED_FEED_DIR``. A segment is closed once
+    ``SEGMENTED_FEED_MAX_BYTES`` bytes of JSON have been written to it (the
+    compressors buffer internally, so the compressed size is only known at
+    close) or it has been open for ``SEGMENTED_FEED_MAX_SECONDS``; it is written under a ``.part`` name
+    and renamed when complete, and ``manifest.json`` is then rewritten
+    atomically with the name, item count, size and SHA-256 of every finished
+    segment. Consumers can process the segments listed in the manifest while
+    the crawl is still running.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.directory = settings.get('SEGMENTED_FEED_DIR')
+        self.compression = settings.get('SEGMENTED_FEED_COMPRESSION', 'gzip')
+        self.level = settings.getint('SEGMENTED_FEED_LEVEL') or None
+        self.max_bytes = settings.getint('SEGMENTED_FEED_MAX_BYTES', 64 * 1024 * 1024)
+        self.max_seconds = settings.getfloat('SEGMENTED_FEED_MAX_SECONDS', 300)
+        check_compression(self.compression)
+        self.extension = SEGMENT_EXTENSIONS[self.compression]
+
+        self.segment = None
+        self.segments = []
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.rotation_check = task.LoopingCall(self.check_age)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('SEGMENTED_FEED_DIR'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.segments = json.load(f).get('segments', [])
+        if self.max_seconds:
+            self.rotation_check.start(min(self.max_seconds, 5.0), now=False)
+
+    def item_scraped(self, item, spider):
+        if self.segment is None:
+            self.open_segment()
+        self.segment.export_item(item)
+        if self.segment.counting.bytes_written >= self.max_bytes:
+            self.rotate()
+
+    def check_age(self):
+        if self.segment is not None and time.time() - self.segment.started >= self.max_seconds:
+            self.rotate()
+
+    def open_segment(self):
+        name = f'{self.run_id}-{len(self.segments) + 1:05d}{self.extension}'
+        self.segment = Segment(self.directory, name, self.compression, self.level)
+
+    def rotate(self):
+        segment, self.segment = self.segment, None
+        entry = segment.close()
+        self.segments.append(entry)
+        self.write_manifest(complete=False)
+        self.stats.inc_value('segmented_feed/segments')
+        self.stats.inc_value('segmented_feed/items', entry['items'])
+        self.stats.inc_value('segmented_feed/bytes', entry['bytes'])
+
+    def write_manifest(self, complete):
+        manifest = {
+            'complete': complete,
+            'compression': self.compression,
+            'updated_at': datetime.now().isoformat(),
+            'segments': self.segments,
+        }
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def spider_closed(self, spider):
+        if self.rotation_check.running:
+            self.rotation_check.stop()
+        if self.segment is not None:
+            self.rotate()
+        self.write_manifest(complete=True)
@@ -0,0 +1,129 @@
+"""
+HTTP/2 downloads with a fallback to HTTP/1.1.
+
+With ``HTTP2_ENABLED`` the https requests to a host are multiplexed as
+streams over a single TLS connection (Scrapy's HTTP/2 client, which
+needs the h2 package; h2 also does the HPACK header compression). A host
+whose server doesn't negotiate HTTP/2 is switched to HTTP/1.1 for the
+rest of the crawl, and the request that found out is retried over
+HTTP/1.1. Plain http and proxied requests, which Scrapy's HTTP/2 client
+doesn't support, always use HTTP/1.1.
+"""
+
+import logging
+
+from OpenSSL import SSL
+from scrapy.core.downloader.handlers.base import BaseDownloadHandler
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet.defer import DeferredSemaphore
+
+try:
+    from h2.exceptions import ProtocolError
+    from scrapy.core.downloader.handlers.http2 import H2DownloadHandler
+except ImportError:
+    H2DownloadHandler = None
+    NEGOTIATION_ERRORS = (SSL.Error,)
+else:
+    # Scrapy has no public exception for a server that doesn't speak HTTP/2:
+    # these two are private to its HTTP/2 client. Should they move, hosts
+    # that negotiate HTTP/1.1 through ALPN fail instead of falling back.
+    try:
+        from scrapy.core._http2.protocol import InvalidNegotiatedProtocol, MethodNotAllowed405
+    except ImportError:
+        NEGOTIATION_ERRORS = (SSL.Error, ProtocolError)
+    else:
+        NEGOTIATION_ERRORS = (SSL.Error, ProtocolError, InvalidNegotiatedProtocol, MethodNotAllowed405)
+
+
+logger = logging.getLogger(__name__)
+
+
+def negotiation_failed(error):
+    """Whether a download error means the server doesn't speak HTTP/2
+
+    A server without HTTP/2 either aborts the TLS handshake (no protocol
+    in common through ALPN), negotiates another protocol, or doesn't do
+    ALPN and then answers the HTTP/2 preface with garbage.
+    """
+    cause = error.__cause__ or error
+    for reason in getattr(cause, 'reasons', None) or []:
+        reason = getattr(reason, 'value', reason)  # a Failure or an exception
+        if isinstance(reason, NEGOTIATION_ERRORS):
+            return True
+    return False
+
+
+class FallbackH2DownloadHandler(BaseDownloadHandler):
+    """https handler using HTTP/2 when enabled and available, else HTTP/1.1
+
+    At most ``HTTP2_MAX_STREAMS`` requests to a host are in flight at
+    once, whatever download slots they go through; the usual
+    ``CONCURRENT_REQUESTS_PER_DOMAIN`` and ``DOWNLOAD_DELAY`` limits still
+    apply per slot.
+    """
+
+    lazy = True
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.http11 = HTTP11DownloadHandler.from_crawler(crawler)
+        self.http2 = None
+        if settings.getbool('HTTP2_ENABLED'):
+            if H2DownloadHandler is None:
+                logger.warning('HTTP2_ENABLED is set but the h2 package is not installed: using HTTP/1.1')
+            else:
+                self.http2 = H2DownloadHandler.from_crawler(crawler)
+        self.max_streams = settings.getint('HTTP2_MAX_STREAMS', 8)
+        self.streams = {}           # host -> DeferredSemaphore
+        self.http2_hosts = set()    # hosts that answered over HTTP/2
+        self.http11_hosts = set()   # hosts that don't speak HTTP/2
+
+    def use_http2(self, request, host):
+        return (
+            self.http2 is not None
+            and urlparse_cached(request).scheme == 'https'
+            and host not in self.http11_hosts
+            and not request.meta.get('proxy')
+        )
+
+    async def download_request(self, request):
+        host = urlparse_cached(request).netloc
+        if not self.use_http2(request, host):
+            if self.http2 is not None:
+                self.stats.inc_value('http2/http11_requests')
+            return await self.http11.download_request(request)
+
+        streams = self.streams.get(host)
+        if streams is None:
+            streams = self.streams[host] = DeferredSemaphore(self.max_streams)
+        await maybe_deferred_to_future(streams.acquire())
+        self.stats.max_value('http2/streams_max', self.max_streams - streams.tokens)
+        try:
+            response = await self.http2.download_request(request)
+        except Exception as e:
+            # Once a host has answered over HTTP/2, errors are just errors
+            if host in self.http2_hosts or not negotiation_failed(e):
+                raise
+            error = e
+        else:
+            self.http2_hosts.add(host)
+            self.stats.inc_value('http2/requests')
+            return response
+        finally:
+            streams.release()
+
+        if host not in self.http11_hosts:
+            self.http11_hosts.add(host)
+            self.stats.inc_value('http2/fallback_hosts')
+            logger.info(f'{host} does not support HTTP/2 ({error}), using HTTP/1.1')
+        self.stats.inc_value('http2/http11_requests')
+        return await self.http11.download_request(request)
+
+    async def close(self):
+        await self.http11.close()
+        if self.http2 is not None:
+            await self.http2.close()
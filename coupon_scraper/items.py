@@ -12,9 +12,21 @@ class CouponItem(scrapy.Item):
     url = scrapy.Field()
     scraped_at = scrapy.Field()
     discount_percentage = scrapy.Field()
+    discount_amount = scrapy.Field()
+    minimum_spend = scrapy.Field()
+    bogo = scrapy.Field()
+    free_shipping = scrapy.Field()
     category = scrapy.Field()
     terms_conditions = scrapy.Field()
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self['scraped_at'] = datetime.now().isoformat()
+
+
+class NormalizedCouponItem(CouponItem):
+    """CouponItem whose fields the spider already normalized
+
+    The validation and cleaning pipelines pass these through. The mark is
+    the item's class, so it survives item.copy() and isn't exported.
+    """
@@ -1,21 +1,367 @@
+import base64
+import hashlib
+import json
+import os
 import random
+import time
+from scrapy import signals
 from scrapy.downloadermiddlewares.useragent import UserAgentMiddleware
+from urllib.parse import urlencode
+
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse, Response, TextResponse
+from scrapy.utils.httpobj import urlparse_cached
+
+
+class BrowserSession:
+    """One consistent client identity: user agent, header set and cookie jar"""
+    
+    def __init__(self, session_id, user_agent):
+        self.session_id = session_id
+        self.user_agent = user_agent
+        self.headers = self.build_headers(user_agent)
+        self.requests = 0
+        self.latency_total = 0.0
+        self.responses = 0
+    
+    @staticmethod
+    def build_headers(user_agent):
+        """Precompute the header set a browser with this user agent would send"""
+        if 'Firefox/' in user_agent:
+            accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'
+            accept_language = 'en-US,en;q=0.5'
+        else:
+            accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8'
+            accept_language = 'en-US,en;q=0.9'
+        return {
+            b'User-Agent': user_agent.encode('utf8'),
+            b'Accept': accept.encode('ascii'),
+            b'Accept-Language': accept_language.encode('ascii'),
+        }
 
 
 class RotateUserAgentMiddleware(UserAgentMiddleware):
-    """Middleware to rotate user agents"""
+    """Middleware to rotate user agents
+    
+    User agents come from ``USER_AGENT_LIST``. By default every request
+    gets a random one. With ``SESSION_AFFINITY_ENABLED`` each download slot
+    (one per domain by default) keeps a single identity - user agent,
+    matching header set and cookie jar - so the server sees one consistent
+    client on our pooled keep-alive connections. The identity of a slot is
+    only replaced after ``SESSION_MAX_REQUESTS`` requests or when a
+    response status in ``SESSION_BLOCK_STATUSES`` suggests we are blocked.
+    """
     
-    def __init__(self, user_agent=''):
+    def __init__(self, user_agent='', user_agent_list=None, session_affinity=False,
+                 max_requests=0, block_statuses=(), stats=None):
         self.user_agent = user_agent
-        self.user_agent_list = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:89.0) Gecko/20100101 Firefox/89.0',
-        ]
+        self.user_agent_list = list(user_agent_list or [user_agent])
+        self.session_affinity = session_affinity
+        self.max_requests = max_requests
+        self.block_statuses = set(block_statuses)
+        self.stats = stats
+        self.sessions = {}
+        self.session_count = 0
+    
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        middleware = cls(
+            user_agent=settings.get('USER_AGENT'),
+            user_agent_list=settings.getlist('USER_AGENT_LIST'),
+            session_affinity=settings.getbool('SESSION_AFFINITY_ENABLED'),
+            max_requests=settings.getint('SESSION_MAX_REQUESTS', 0),
+            block_statuses=[int(status) for status in settings.getlist('SESSION_BLOCK_STATUSES', [403, 429])],
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+    
+    def process_request(self, request, spider):
+        if not self.session_affinity:
+            request.headers['User-Agent'] = random.choice(self.user_agent_list)
+            return None
+        
+        slot = self.slot_key(request)
+        session = self.sessions.get(slot)
+        if session is None:
+            session = self.new_session(slot)
+        elif self.max_requests and session.requests >= self.max_requests:
+            session = self.new_session(slot, reason='recycled')
+        
+        if session.requests:
+            self.stats.inc_value('session/reused_requests')
+        session.requests += 1
+        for name, value in session.headers.items():
+            request.headers[name] = value
+        request.meta.setdefault('cookiejar', session.session_id)
+        request.meta['session_id'] = session.session_id
+        self.stats.inc_value('session/requests')
+        return None
+    
+    def process_response(self, request, response, spider):
+        if not self.session_affinity or 'session_id' not in request.meta:
+            return response
+        
+        slot = self.slot_key(request)
+        session = self.sessions.get(slot)
+        if session is None or session.session_id != request.meta['session_id']:
+            return response
+        
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            session.latency_total += latency
+            session.responses += 1
+        
+        if response.status in self.block_statuses:
+            self.stats.inc_value(f'session/blocked/{response.status}')
+            self.new_session(slot, reason='rotated_blocked')
+        return response
+    
+    def slot_key(self, request):
+        return request.meta.get('download_slot') or urlparse_cached(request).hostname or ''
+    
+    def new_session(self, slot, reason=None):
+        old = self.sessions.get(slot)
+        if old is not None:
+            self.record_session(old)
+        self.session_count += 1
+        # Avoid handing the replacement session the identity that was just dropped
+        choices = [ua for ua in self.user_agent_list if old is None or ua != old.user_agent]
+        session = BrowserSession(self.session_count, random.choice(choices or self.user_agent_list))
+        self.sessions[slot] = session
+        self.stats.inc_value('session/created')
+        if reason:
+            self.stats.inc_value(f'session/{reason}')
+        return session
+    
+    def record_session(self, session):
+        self.stats.max_value('session/max_requests_per_session', session.requests)
+        if session.responses:
+            self.stats.max_value('session/max_avg_latency', round(session.latency_total / session.responses, 4))
+    
+    def spider_closed(self, spider):
+        for slot, session in self.sessions.items():
+            self.record_session(session)
+            if session.responses:
+                spider.logger.info(
+                    f'Session {session.session_id} ({slot}): {session.requests} requests, '
+                    f'avg latency {session.latency_total / session.responses:.3f}s'
+                )
+        requests = self.stats.get_value('session/requests', 0)
+        if requests:
+            reused = self.stats.get_value('session/reused_requests', 0)
+            self.stats.set_value('session/reuse_ratio', round(reused / requests, 3))
+
+
+class PersistentRobotsTxtCacheMiddleware:
+    """Middleware to serve robots.txt from an on-disk cache shared between runs
+
+    RobotsTxtMiddleware downloads robots.txt once per domain and run. This
+    middleware answers those downloads from ``ROBOTSCACHE_DIR`` while the
+    cached copy is younger than ``ROBOTSCACHE_TTL`` seconds, and stores
+    fresh downloads there. Entries are written atomically, so concurrent
+    spider processes on one host can share the directory. The raw body is
+    cached rather than a parser object, so the cache works with any
+    ``ROBOTSTXT_PARSER``; parsing it again costs microseconds.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.cache_dir = settings.get('ROBOTSCACHE_DIR')
+        self.ttl = settings.getint('ROBOTSCACHE_TTL', 86400)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not (settings.getbool('ROBOTSTXT_OBEY') and settings.getbool('ROBOTSCACHE_ENABLED')):
+            raise NotConfigured
+        return cls(crawler)
+
+    def is_robots_request(self, request):
+        return request.meta.get('dont_obey_robotstxt') and request.url.endswith('/robots.txt')
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf8')).hexdigest() + '.json')
 
     def process_request(self, request, spider):
-        ua = random.choice(self.user_agent_list)
-        request.headers['User-Agent'] = ua
+        if not self.is_robots_request(request):
+            return None
+
+        try:
+            with open(self.cache_path(request.url), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.stats.inc_value('robotscache/miss')
+            return None
+
+        if time.time() - entry['fetched_at'] > self.ttl:
+            self.stats.inc_value('robotscache/expired')
+            return None
+
+        self.stats.inc_value('robotscache/hit')
+        self.stats.inc_value('robotscache/time_saved', entry.get('latency', 0.0))
+        return Response(
+            request.url,
+            status=entry['status'],
+            body=base64.b64decode(entry['body']),
+            request=request,
+            flags=['robotscache'],
+        )
+
+    def process_response(self, request, response, spider):
+        if not self.is_robots_request(request) or 'robotscache' in response.flags:
+            return response
+        # Keep server errors out of the cache so the next run retries them
+        if response.status >= 500:
+            return response
+
+        entry = {
+            'status': response.status,
+            'body': base64.b64encode(response.body).decode('ascii'),
+            'fetched_at': time.time(),
+            'latency': request.meta.get('download_latency', 0.0),
+        }
+        path = self.cache_path(request.url)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self.stats.inc_value('robotscache/stored')
+        return response
+
+
+# Download slot of the render service requests; its concurrency is the
+# size of the render pool (see DOWNLOAD_SLOTS in settings.py)
+RENDER_SLOT = 'render'
+
+
+def render_request(response, callback):
+    """Request for ``response``'s page through the render service, or None if it was rendered already"""
+    if response.meta.get('render'):
         return None
+    return response.follow(response.url, callback, meta={'render': True}, dont_filter=True)
+
+
+class RenderOnDemandMiddleware:
+    """Middleware to fetch pages marked ``meta['render']`` through a render service
+
+    Spiders only mark a page for rendering when static extraction found no
+    coupons on it. Such requests are answered from ``RENDER_CACHE_DIR`` when
+    the page was rendered less than ``RENDER_CACHE_TTL`` seconds ago, and
+    otherwise rewritten to the Splash compatible ``render.html`` endpoint at
+    ``RENDER_URL``. They run in their own download slot, whose concurrency
+    bounds the render pool, and at most ``RENDER_BUDGET`` pages are
+    rendered per run. The rendered HTML comes back to the spider under the
+    page's own URL with the 'rendered' flag.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.render_url = settings.get('RENDER_URL').rstrip('/')
+        self.wait = settings.getfloat('RENDER_WAIT', 0.5)
+        self.timeout = settings.getfloat('RENDER_TIMEOUT', 30)
+        self.budget = settings.getint('RENDER_BUDGET', 50)
+        self.cache_dir = settings.get('RENDER_CACHE_DIR')
+        self.cache_ttl = settings.getint('RENDER_CACHE_TTL', 86400)
+        self.dispatched = 0
+        # Distinct pages the spider asked to render
+        self.render_pages = set()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RENDER_ENABLED'):
+            raise NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def endpoint(self, url):
+        query = urlencode({'url': url, 'wait': self.wait, 'timeout': self.timeout})
+        return f'{self.render_url}/render.html?{query}'
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf8')).hexdigest() + '.html')
+
+    def read_cache(self, url):
+        if not self.cache_dir:
+            return None
+        path = self.cache_path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.cache_ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_cache(self, url, body):
+        if not self.cache_dir:
+            return
+        path = self.cache_path(url)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def process_request(self, request, spider):
+        if not request.meta.get('render') or 'render_target' in request.meta:
+            return None
+
+        self.stats.inc_value('render/requested')
+        self.render_pages.add(request.url)
+        body = self.read_cache(request.url)
+        if body is not None:
+            self.stats.inc_value('render/cache_hit')
+            return HtmlResponse(request.url, body=body, encoding='utf-8', request=request,
+                                flags=['rendered', 'render_cache'])
+
+        if self.budget and self.dispatched >= self.budget:
+            self.stats.inc_value('render/budget_exhausted')
+            raise IgnoreRequest(f'Render budget of {self.budget} pages exhausted: {request.url}')
+
+        self.dispatched += 1
+        self.stats.inc_value('render/dispatched')
+        return request.replace(
+            url=self.endpoint(request.url),
+            meta={
+                **request.meta,
+                'render_target': request.url,
+                'download_slot': RENDER_SLOT,
+                # Robots rules were checked for the page itself
+                'dont_obey_robotstxt': True,
+                'autothrottle_dont_adjust_delay': True,
+            },
+        )
+
+    def process_response(self, request, response, spider):
+        target = request.meta.get('render_target')
+        if target is None:
+            if not request.meta.get('render') and isinstance(response, HtmlResponse):
+                self.stats.inc_value('render/static_pages')
+            return response
+
+        if response.status != 200:
+            self.stats.inc_value(f'render/failed/{response.status}')
+            return response
+
+        self.stats.inc_value('render/rendered')
+        self.stats.inc_value('render/time', request.meta.get('download_latency', 0.0))
+        self.write_cache(target, response.body)
+        encoding = response.encoding if isinstance(response, TextResponse) else 'utf-8'
+        return HtmlResponse(target, body=response.body, encoding=encoding, request=request, flags=['rendered'])
+
+    def spider_closed(self, spider):
+        render_pages = len(self.render_pages)
+        self.stats.set_value('render/pages', render_pages)
+        # A page is only marked for rendering after its static fetch found no
+        # coupons, so the static pages already include the pages that needed
+        # rendering; render requests (cache hits, retries, refusals) aren't pages
+        pages = max(self.stats.get_value('render/static_pages', 0), render_pages)
+        if pages:
+            self.stats.set_value('render/share', round(render_pages / pages, 4))
@@ -0,0 +1,362 @@
+"""
+Local mock coupon site for load testing the spiders.
+
+Pages use the markup that CouponsComSpider and CouponsSpider select on
+(data-testid'd cards with title, code, description, store and expiry) and
+are generated deterministically from a seed, so runs are comparable.
+
+The server answers for any Host, so it can also be used as the spiders'
+HTTP proxy: crawling http://www.coupons.com/ through it exercises the
+spiders' real URL handling without leaving the machine.
+
+It also stands in for a Splash render service: a share of the pages can
+be served as empty JavaScript shells, whose cards only appear when the
+page is fetched through ``/render.html?url=...``.
+
+With ``tls=True`` the site is served over HTTPS by Twisted instead, with
+a throwaway self-signed certificate, and offers HTTP/2 (when the h2
+package is installed) as well as HTTP/1.1 through ALPN.
+"""
+
+import json
+import multiprocessing
+import random
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# The first sections mirror the spiders' start_urls
+SECTIONS = ['/', '/coupon-codes/', '/printable-coupons/', '/deals/']
+
+STORES = ['Target', 'Old Navy', 'Best Buy', 'Sephora', 'Home Depot', 'Expedia', 'Pizza Hut', 'AutoZone']
+PRODUCTS = ['shoes', 'pizza', 'laptops', 'makeup', 'furniture', 'hotel stays', 'tires', 'vitamins']
+OFFERS = ['{n}% Off {product}', 'Save {n}% on {product}', '${n} Off {product} Orders', 'Buy 1 Get 1 Free {product}']
+
+
+class MockSiteConfig:
+    """Shape of the generated site and how the server misbehaves"""
+
+    def __init__(self, sections=4, depth=5, cards_per_page=20, latency='fixed:0',
+                 error_rate=0.0, seed=42, pagination='next', structured=False,
+                 js_only_rate=0.0, render_delay=0.0):
+        self.sections = sections
+        self.depth = depth
+        self.cards_per_page = cards_per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        # 'next' links only the following page; 'numbered' shows "Page X of Y"
+        # and links to the neighbouring and last pages
+        self.pagination = pagination
+        # Also embed the cards as __NEXT_DATA__ hydration state
+        self.structured = structured
+        # Share of pages served as JavaScript shells, and the extra time
+        # /render.html takes to "execute" them
+        self.js_only_rate = js_only_rate
+        self.render_delay = render_delay
+
+    def section_paths(self):
+        paths = SECTIONS[:self.sections]
+        paths += [f'/category/{n}/' for n in range(self.sections - len(paths))]
+        return paths
+
+    def total_pages(self):
+        return len(self.section_paths()) * self.depth
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def latency_sampler(spec):
+    """Build a delay function from 'fixed:S', 'uniform:A:B', 'exp:MEAN' or 'lognormal:MU:SIGMA'"""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(':') if v] or [0.0]
+
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+
+def card_data(rng, index):
+    """Generate the fields of one coupon card"""
+    store = rng.choice(STORES)
+    product = rng.choice(PRODUCTS)
+    n = rng.choice([5, 10, 15, 20, 25, 30, 40, 50])
+    title = rng.choice(OFFERS).format(n=n, product=product)
+    return {
+        'title': title,
+        'code': f'{store.split()[0].upper()}{n}{index % 100:02d}',
+        'description': f'Get {title.lower()} at {store}. Limited time offer.',
+        'store': store,
+        'expires': f'{rng.randint(1, 12)}/{rng.randint(1, 28)}/2030',
+        'terms': 'Exclusions apply.',
+    }
+
+
+def render_card(card):
+    return (
+        '<div class="coupon-card" data-testid="coupon-card">'
+        f'<h3 class="coupon-title" data-testid="offer-title">{escape(card["title"])}</h3>'
+        f'<span class="coupon-code" data-testid="offer-code" data-clipboard-text="{card["code"]}">{card["code"]}</span>'
+        f'<p class="coupon-description" data-testid="offer-description">{escape(card["description"])}</p>'
+        f'<span class="store-name" data-testid="store-name">{escape(card["store"])}</span>'
+        f'<span class="expiry-date" data-testid="expiry-date">Expires {card["expires"]}</span>'
+        f'<div class="terms">{escape(card["terms"])}</div>'
+        '</div>'
+    )
+
+
+def render_next_data(cards):
+    """Hydration state the way a Next.js page embeds it"""
+    offers = [
+        {
+            'offerTitle': card['title'],
+            'couponCode': card['code'],
+            'description': card['description'],
+            'merchant': {'name': card['store']},
+            'expirationDate': card['expires'],
+            'terms': card['terms'],
+        }
+        for card in cards
+    ]
+    data = json.dumps({'props': {'pageProps': {'offers': offers}}}).replace('</', '<\\/')
+    return f'<script id="__NEXT_DATA__" type="application/json">{data}</script>'
+
+
+def is_js_only(config, path, page):
+    return random.Random(f'{config.seed}:{path}:{page}:js').random() < config.js_only_rate
+
+
+def render_page(config, path, page, rendered=False):
+    """Return the HTML of listing ``path`` page ``page`` (1-based), or None
+
+    JavaScript-only pages are returned as an empty shell unless ``rendered``.
+    """
+    if path not in config.section_paths() or not 1 <= page <= config.depth:
+        return None
+
+    rng = random.Random(f'{config.seed}:{path}:{page}')
+    card_list = [card_data(rng, i) for i in range(config.cards_per_page)]
+    cards = ''.join(render_card(card) for card in card_list)
+    if config.structured:
+        cards += render_next_data(card_list)
+    nav = ''.join(f'<a href="{p}">{p.strip("/") or "home"}</a>' for p in config.section_paths())
+    if not rendered and is_js_only(config, path, page):
+        return (
+            '<!DOCTYPE html><html><head><title>Mock Coupons</title></head><body>'
+            f'<header class="site-header"><nav>{nav}</nav></header>'
+            '<main><div id="root"></div><script src="/static/app.js"></script></main>'
+            '</body></html>'
+        )
+    pagination = ''
+    if config.pagination == 'numbered':
+        numbers = sorted({1, page - 1, page + 1, config.depth} & set(range(1, config.depth + 1)) - {page})
+        links = ''.join(f'<a href="{path}?page={n}">{n}</a>' for n in numbers)
+        pagination = f'<nav class="pagination"><span>Page {page} of {config.depth}</span>{links}</nav>'
+    elif page < config.depth:
+        pagination = f'<nav class="pagination"><a aria-label="Next" class="next" href="{path}?page={page + 1}">Next</a></nav>'
+
+    return (
+        '<!DOCTYPE html><html><head><title>Mock Coupons</title></head><body>'
+        f'<header class="site-header"><nav>{nav}</nav></header>'
+        f'<main><h1>Coupons page {page}</h1>{cards}{pagination}</main>'
+        '<footer class="site-footer">Mock coupon site</footer>'
+        '</body></html>'
+    )
+
+
+def respond(config, delay, rng, path):
+    """Return (seconds to wait, status, body, content type) of a GET of ``path``"""
+    url = urlparse(path)
+    if url.path == '/robots.txt':
+        return 0.0, 200, b'User-agent: *\nAllow: /\n', 'text/plain'
+
+    wait = delay(rng)
+    if rng.random() < config.error_rate:
+        return wait, 500, b'Internal Server Error', 'text/plain'
+
+    rendered = url.path == '/render.html'
+    if rendered:
+        # Splash style render endpoint: the page to render is in ?url=
+        url = urlparse(parse_qs(url.query).get('url', [''])[0])
+        wait += config.render_delay
+
+    page = int(parse_qs(url.query).get('page', ['1'])[0])
+    html = render_page(config, url.path, page, rendered)
+    if html is None:
+        return wait, 404, b'Not Found', 'text/plain'
+    return wait, 200, html.encode('utf8'), 'text/html; charset=utf-8'
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+    delay = None
+    rng = random.Random()
+
+    def do_GET(self):
+        wait, status, body, content_type = respond(self.config, self.delay, self.rng, self.path)
+        if wait > 0:
+            time.sleep(wait)
+        self.send_body(status, body, content_type)
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(config, host='127.0.0.1', port=0):
+    handler = type('ConfiguredMockSiteHandler', (MockSiteHandler,), {
+        'config': config,
+        'delay': staticmethod(latency_sampler(config.latency)),
+        'rng': random.Random(config.seed),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def _serve(config_dict, host, port, ready):
+    server = make_server(MockSiteConfig(**config_dict), host, port)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def self_signed_certificate(host):
+    """Throwaway key and certificate for ``host``, as pyOpenSSL objects"""
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    from OpenSSL import crypto
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .sign(key, hashes.SHA256())
+    )
+    return crypto.PKey.from_cryptography_key(key), crypto.X509.from_cryptography(certificate)
+
+
+def make_tls_site(config, http2=True):
+    """Twisted Site serving the mock site, answering without blocking the other streams"""
+    from twisted.internet import reactor
+    from twisted.internet.task import deferLater
+    from twisted.web.resource import Resource
+    from twisted.web.server import NOT_DONE_YET, Site
+
+    delay = latency_sampler(config.latency)
+    rng = random.Random(config.seed)
+
+    class MockSiteResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            wait, status, body, content_type = respond(config, delay, rng, request.uri.decode())
+
+            def send():
+                request.setResponseCode(status)
+                request.setHeader('Content-Type', content_type)
+                request.setHeader('Content-Length', str(len(body)))
+                request.write(body)
+                request.finish()
+
+            if wait <= 0:
+                send()
+                return NOT_DONE_YET
+            sending = deferLater(reactor, wait, send)
+            request.notifyFinish().addErrback(lambda _: sending.cancel())
+            sending.addErrback(lambda _: None)
+            return NOT_DONE_YET
+
+    site = Site(MockSiteResource())
+    site.noisy = False
+    if not http2:
+        # The protocols offered through ALPN are the site's
+        site.acceptableProtocols = lambda: [b'http/1.1']
+    return site
+
+
+def _serve_tls(config_dict, host, port, ready, http2):
+    from twisted.internet import reactor, ssl
+    from twisted.internet.endpoints import SSL4ServerEndpoint
+
+    key, certificate = self_signed_certificate(host)
+    options = ssl.CertificateOptions(privateKey=key, certificate=certificate)
+    endpoint = SSL4ServerEndpoint(reactor, port, options, interface=host)
+    listening = endpoint.listen(make_tls_site(MockSiteConfig(**config_dict), http2))
+    listening.addCallback(lambda listener: ready.put(listener.getHost().port))
+    reactor.run()
+
+
+class MockSite:
+    """Run the mock site in a separate process so it does not compete with the crawl for the GIL
+
+    Usage::
+
+        with MockSite(MockSiteConfig(depth=10)) as site:
+            print(site.base_url, site.start_urls('http://www.coupons.com'))
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0, tls=False, http2=True):
+        self.config = config or MockSiteConfig()
+        self.host = host
+        self.port = port
+        self.tls = tls
+        # Offer HTTP/2 over TLS; without it clients have to use HTTP/1.1
+        self.http2 = http2
+        self.process = None
+
+    def start(self):
+        ready = multiprocessing.Queue()
+        if self.tls:
+            target, args = _serve_tls, (self.config.to_dict(), self.host, self.port, ready, self.http2)
+        else:
+            target, args = _serve, (self.config.to_dict(), self.host, self.port, ready)
+        self.process = multiprocessing.Process(target=target, args=args, daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=10)
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    @property
+    def base_url(self):
+        return f"{'https' if self.tls else 'http'}://{self.host}:{self.port}"
+
+    def start_urls(self, base_url=None):
+        base_url = base_url or self.base_url
+        return [f'{base_url}{path}' for path in self.config.section_paths()]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,99 @@
+"""
+Text normalization shared by the spiders and the pipelines.
+
+The spiders normalize every field once, when they build an item, with the
+patterns and tables below (compiled at import), and build it as a
+NormalizedCouponItem: the pipelines skip the cleaning they would otherwise
+repeat on those.
+"""
+
+import re
+from datetime import datetime
+
+
+# "Deal: ..." / "... coupon" in one substitution
+AFFIXES = re.compile(r'^(?:deal|offer|coupon):\s*|\s*(?:deal|offer|coupon)$', re.IGNORECASE)
+AFFIX_WORDS = ('deal', 'offer', 'coupon')
+
+# ASCII characters outside \w, deleted from coupon codes without a regex
+CODE_DELETE = {c: None for c in range(128) if not (chr(c).isalnum() or chr(c) == '_')}
+NON_WORD = re.compile(r'\W+')
+
+EXPIRY_PREFIX = re.compile(r'^(?:expires?:?\s*|exp:?\s*|(?:valid )?until:?\s*)', re.IGNORECASE)
+EXPIRY_DATE = re.compile(r'\d{1,2}/\d{1,2}/\d{4}|\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2}-\d{4}|[A-Za-z]+ \d{1,2}, \d{4}')
+# strptime formats of the EXPIRY_DATE alternatives
+EXPIRY_DATE_FORMATS = [
+    '%m/%d/%Y',   # MM/DD/YYYY
+    '%Y-%m-%d',   # YYYY-MM-DD
+    '%m-%d-%Y',   # MM-DD-YYYY
+    '%B %d, %Y',  # Month DD, YYYY
+    '%b %d, %Y',  # Mon DD, YYYY
+]
+
+
+def squash(text):
+    """Collapse runs of whitespace and strip"""
+    if not text:
+        return None
+    return ' '.join(text.split())
+
+
+def clean_text(text):
+    """Collapse whitespace and remove "Deal:" style prefixes and "... offer" suffixes"""
+    if not text:
+        return None
+    text = ' '.join(text.split())
+    lowered = text[:6].lower()
+    if lowered.startswith(AFFIX_WORDS) or text[-6:].lower().endswith(AFFIX_WORDS):
+        text = AFFIXES.sub('', text).strip()
+    return text
+
+
+def clean_code(code):
+    """Upper-cased code without spaces or punctuation"""
+    if not code:
+        return None
+    code = code.upper().translate(CODE_DELETE)
+    if not code.isascii():
+        code = NON_WORD.sub('', code)
+    return code
+
+
+def squash_code(code):
+    """Upper-cased code without whitespace, punctuation kept as displayed"""
+    if not code:
+        return None
+    return ''.join(code.split()).upper()
+
+
+def clean_expiry(text):
+    """The date in an expiry text, or the text without its "Expires" prefix"""
+    if not text:
+        return None
+    text = EXPIRY_PREFIX.sub('', text)
+    match = EXPIRY_DATE.search(text)
+    return match.group() if match else text.strip()
+
+
+def parse_expiry_date(value):
+    """Parse a free-form expiry string into a date, or None"""
+    if not value:
+        return None
+    match = EXPIRY_DATE.search(str(value))
+    if not match:
+        return None
+    for fmt in EXPIRY_DATE_FORMATS:
+        try:
+            return datetime.strptime(match.group(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def coupon_key(title, code, store):
+    """Deduplication key of a coupon, based on title, code and store
+
+    Codes are compared without their punctuation, so "SAVE-20" and "save20"
+    are the same coupon.
+    """
+    return f"{(title or '').strip().lower()}:{(clean_code(code) or '').lower()}:{(store or '').strip().lower()}"
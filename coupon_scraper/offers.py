@@ -0,0 +1,162 @@
+"""
+Offer grammar: the discount terms in a coupon's title and description.
+
+The terms are read by a single compiled pattern, an alternation with a
+named group per term, in one left-to-right pass over each text:
+
+- percent off: "20% off", "save 20%", "20% discount", a bare "20%";
+- amount off: "$10 off", "save $10", "$10 discount";
+- minimum spend: "orders over $50", "when you spend $50", "minimum purchase
+  of $50", "$50+"; an amount followed by "off" is a discount, not a minimum;
+- buy X get Y: "BOGO", "buy one get one free", "buy 2 get 1 50% off";
+- free shipping: "free shipping", "free delivery", "ships free".
+
+Titles repeat a lot across pages, stores and runs, so the scan of a text
+is cached.
+"""
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+
+AMOUNT = r'\$\s?(?P<{}>\d[\d,]*(?:\.\d+)?)'
+COUNT = r'(?:\d+|one|two|three)'
+
+# A minimum is an amount after "over", "above", "at least", "spend",
+# "minimum" or "orders of" / "purchase of" (a bare "orders $5 off" is no
+# minimum), not followed by "off"
+MINIMUM = (
+    r'\b(?:over|above|at\s+least|spend|min(?:imum|\.)?(?:\s+(?:order|purchase|spend))?'
+    r'|(?:orders?|purchases?)\s+of)\s+' + AMOUNT.format('min_amount') + r'(?![\d,.]*\s*(?:off|discount))'
+)
+
+# Matched against the lower-cased text. Every alternative starts with a
+# digit, "$" or one of the letters in the lookahead, so at most positions
+# the scan fails on that one character test instead of trying them all.
+OFFER_GRAMMAR = re.compile(
+    r'(?=[\d$abfmops])(?:'
+    r'(?P<minimum>' + MINIMUM + r')'
+    r'|(?P<amount>' + AMOUNT.format('amount_value') +
+    r'(?P<min_plus>\+|\s+or\s+more)?(?:\s*(?P<amount_kind>off|discount))?)'
+    r'|(?P<percent>(?P<percent_value>\d+)(?:\.\d+)?%(?:\s*(?P<percent_kind>off|discount|savings))?)'
+    r'|(?P<save>save\s*(?:(?P<save_percent>\d+)(?:\.\d+)?%(?P<save_off>\s*off)?|'
+    + AMOUNT.format('save_amount') + r'))'
+    r'|(?P<bogo>bogo|buy\s+(?P<buy>' + COUNT + r')\s*,?\s*get\s+(?P<get>' + COUNT + r')'
+    r'(?:\s+(?:(?P<get_percent>\d+)%\s*off|(?P<get_half>half\s+off)|free))?)'
+    r'|(?P<shipping>free\s+(?:standard\s+|ground\s+)?(?:shipping|delivery)|ships?\s+free)'
+    r')'
+)
+
+# Preference among several percentages, lower first: "20% off" over
+# "save 20%" over "20% discount" over "20% savings" over a bare "20%"
+PERCENT_KIND_RANKS = {'off': 0, 'discount': 2, 'savings': 3}
+SAVE_RANK = 1
+BARE_RANK = 4
+
+NUMBERS = {'one': 1, 'two': 2, 'three': 3}
+
+Offer = namedtuple('Offer', [
+    'discount_percentage', 'percent_rank', 'discount_amount', 'minimum_spend', 'bogo', 'free_shipping',
+])
+NO_OFFER = Offer(None, BARE_RANK + 1, None, None, None, False)
+
+# Item fields filled from an Offer
+OFFER_FIELDS = ('discount_percentage', 'discount_amount', 'minimum_spend', 'bogo', 'free_shipping')
+
+
+def parse_amount(value):
+    return float(value.replace(',', ''))
+
+
+def parse_count(value):
+    return NUMBERS.get(value) or int(value)
+
+
+@lru_cache(maxsize=20000)
+def scan_offer(text):
+    """Offer terms in ``text``, the first of each kind (the preferred percentage)"""
+    if not text:
+        return NO_OFFER
+    percent = amount = minimum = bogo = None
+    percent_rank = BARE_RANK + 1
+    free_shipping = False
+    for match in OFFER_GRAMMAR.finditer(text.lower()):
+        kind = match.lastgroup
+        if kind == 'percent':
+            kind_word = match.group('percent_kind')
+            rank = PERCENT_KIND_RANKS[kind_word] if kind_word else BARE_RANK
+            if rank < percent_rank:
+                percent = int(match.group('percent_value'))
+                percent_rank = rank
+        elif kind == 'amount':
+            if match.group('min_plus'):
+                if minimum is None:
+                    minimum = parse_amount(match.group('amount_value'))
+            elif amount is None and match.group('amount_kind'):
+                amount = parse_amount(match.group('amount_value'))
+        elif kind == 'save':
+            if match.group('save_percent'):
+                rank = 0 if match.group('save_off') else SAVE_RANK
+                if rank < percent_rank:
+                    percent = int(match.group('save_percent'))
+                    percent_rank = rank
+            elif amount is None:
+                amount = parse_amount(match.group('save_amount'))
+        elif kind == 'minimum':
+            if minimum is None:
+                minimum = parse_amount(match.group('min_amount'))
+        elif kind == 'bogo':
+            if bogo is None:
+                bogo = bogo_terms(match)
+        elif kind == 'shipping':
+            free_shipping = True
+    return Offer(percent, percent_rank, amount, minimum, bogo, free_shipping)
+
+
+def bogo_terms(match):
+    """"buy 1 get 1 free" / "buy 2 get 1 50% off" for a buy X get Y match"""
+    if match.group('buy') is None:  # BOGO
+        return 'buy 1 get 1 free'
+    terms = f"buy {parse_count(match.group('buy'))} get {parse_count(match.group('get'))}"
+    if match.group('get_percent'):
+        return f"{terms} {match.group('get_percent')}% off"
+    if match.group('get_half'):
+        return f'{terms} 50% off'
+    return f'{terms} free'
+
+
+def parse_offer(title, description=None):
+    """Offer terms of a coupon, from its title, then its description
+
+    A term is taken from the description only when the title doesn't have
+    it, except for a percentage the description states more precisely
+    ("20% off" in the description beats a bare "20%" in the title).
+    """
+    offer = scan_offer(title)
+    if not description:
+        return offer
+    other = scan_offer(description)
+    if other == NO_OFFER:
+        return offer
+    if other.percent_rank < offer.percent_rank:
+        offer = offer._replace(discount_percentage=other.discount_percentage, percent_rank=other.percent_rank)
+    return Offer(
+        offer.discount_percentage,
+        offer.percent_rank,
+        offer.discount_amount if offer.discount_amount is not None else other.discount_amount,
+        offer.minimum_spend if offer.minimum_spend is not None else other.minimum_spend,
+        offer.bogo or other.bogo,
+        offer.free_shipping or other.free_shipping,
+    )
+
+
+def offer_fields(title, description=None):
+    """Item fields of the offer terms found, e.g. {'discount_percentage': 20, 'free_shipping': True}"""
+    offer = parse_offer(title, description)
+    fields = {}
+    for name in OFFER_FIELDS:
+        value = getattr(offer, name)
+        if value is not None and value is not False:
+            fields[name] = value
+    return fields
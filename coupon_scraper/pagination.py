@@ -0,0 +1,129 @@
+import math
+import re
+from urllib.parse import urlparse
+
+
+# Page number in the query string (?page=3) or the path (/page/3/)
+PAGE_PATTERNS = [
+    re.compile(r'([?&](?:page|p|pg|pagenum|page_number)=)(\d+)', re.IGNORECASE),
+    re.compile(r'(/page/)(\d+)', re.IGNORECASE),
+]
+# Item offset in the query string (?offset=40)
+OFFSET_PATTERNS = [
+    re.compile(r'([?&](?:offset|start|skip|from)=)(\d+)', re.IGNORECASE),
+]
+
+# Meta of the requests a plan schedules: the listing's pages scheduled so
+# far, and whether this is the plan's last page, which may link further
+# into the listing than the page the plan was made from
+PLANNED_META = 'pagination_planned'
+CONTINUE_META = 'pagination_continue'
+
+# "Page 2 of 14"
+PAGE_COUNT_PATTERN = re.compile(r'page\s+\d+\s+of\s+(\d+)', re.IGNORECASE)
+# "Showing 1-20 of 345 coupons"
+RESULT_COUNT_PATTERN = re.compile(r'of\s+([\d,]+)\s+(?:results|coupons|offers|deals|items|codes)', re.IGNORECASE)
+
+
+def classify_url(url):
+    """Return (kind, template, number) for a paginated URL, or None
+
+    ``kind`` is 'page' or 'offset' and ``template`` is the URL with the
+    number replaced by a ``{}`` placeholder.
+    """
+    for kind, patterns in (('page', PAGE_PATTERNS), ('offset', OFFSET_PATTERNS)):
+        for pattern in patterns:
+            match = pattern.search(url)
+            if match:
+                template = url[:match.start(2)].replace('{', '{{').replace('}', '}}') + '{}' + \
+                    url[match.end(2):].replace('{', '{{').replace('}', '}}')
+                return kind, template, int(match.group(2))
+    return None
+
+
+def listing_path(url):
+    """Path of a listing URL with any path-based page number removed"""
+    path = urlparse(url).path
+    path = re.split(r'/page/\d+', path, flags=re.IGNORECASE)[0]
+    return path.rstrip('/') or '/'
+
+
+def plan_pagination(response, budget=50):
+    """URLs of the remaining pages of the listing ``response`` belongs to
+
+    Recognizes numbered (?page=N, /page/N/) and offset (?offset=N)
+    pagination from the page's links, extended by "Page X of Y" or
+    "of N results" counts when the page shows them. Returns at most
+    ``budget`` URLs after the current page, or an empty list when no
+    pagination pattern is found (the caller then falls back to following
+    a "Next" link).
+    """
+    current_path = listing_path(response.url)
+    groups = {}
+    for href in response.css('a::attr(href)').getall():
+        url = response.urljoin(href)
+        classified = classify_url(url)
+        if not classified:
+            continue
+        kind, template, number = classified
+        if listing_path(template.format(number)) != current_path:
+            continue
+        groups.setdefault((kind, template), set()).add(number)
+
+    if not groups:
+        return []
+
+    # The pattern with the most links is the listing's pagination
+    (kind, template), numbers = max(groups.items(), key=lambda group: len(group[1]))
+
+    current = classify_url(response.url)
+    if current and current[:2] == (kind, template):
+        position = current[2]
+    else:
+        position = 1 if kind == 'page' else 0
+
+    # One regex pass over the raw markup is cheaper than collecting text nodes
+    text = response.text
+
+    if kind == 'page':
+        last = max(numbers)
+        page_count = PAGE_COUNT_PATTERN.search(text)
+        if page_count:
+            last = max(last, int(page_count.group(1)))
+        step = 1
+    else:
+        offsets = sorted(numbers | {position})
+        steps = [b - a for a, b in zip(offsets, offsets[1:]) if b > a]
+        if not steps:
+            return []
+        step = min(steps)
+        last = max(offsets)
+        result_count = RESULT_COUNT_PATTERN.search(text)
+        if result_count:
+            total = int(result_count.group(1).replace(',', ''))
+            last = max(last, (math.ceil(total / step) - 1) * step)
+
+    remaining = range(position + step, last + 1, step)
+    return [template.format(number) for number in remaining][:budget]
+
+
+def planned_requests(response, callback, budget=50):
+    """Requests for the remaining pages of the listing, planned once per listing
+
+    The pages a plan schedules don't plan the listing again, except the
+    last one, which continues it (within what's left of ``budget``) when it
+    links to further pages. Returns None when ``response`` isn't part of a
+    planned listing and has no pagination pattern.
+    """
+    meta = response.request.meta if response.request is not None else {}
+    scheduled = meta.get(PLANNED_META)
+    if scheduled is not None and not meta.get(CONTINUE_META):
+        return []
+    urls = plan_pagination(response, budget - (scheduled or 0))
+    if not urls:
+        return None if scheduled is None else []
+    total = (scheduled or 0) + len(urls)
+    return [
+        response.follow(url, callback, meta={PLANNED_META: total, CONTINUE_META: url == urls[-1]})
+        for url in urls
+    ]
@@ -1,6 +1,11 @@
 import re
 from datetime import datetime
+from scrapy import Item
 from scrapy.exceptions import DropItem
+
+from coupon_scraper.items import NormalizedCouponItem
+from coupon_scraper.normalize import coupon_key
+from coupon_scraper.offers import offer_fields
 try:
     from itemadapter import ItemAdapter
 except ImportError:
@@ -20,6 +25,14 @@ class CouponValidationPipeline:
     """Pipeline to validate coupon data"""
     
     def process_item(self, item, spider):
+        # Cleaned by the spider already; only check the code is usable
+        if isinstance(item, NormalizedCouponItem):
+            code = item.get('code')
+            if code is not None and len(code) < 3:
+                spider.logger.warning(f"Dropping unusable code {code!r} of item: {item}")
+                del item['code']
+            return item
+        
         adapter = ItemAdapter(item)
         
         # Validate required fields
@@ -53,19 +66,19 @@ class DuplicatesPipeline:
     def __init__(self):
         self.ids_seen = set()
 
+    @staticmethod
+    def item_id(item):
+        """Unique identifier of a coupon, based on title, code and store"""
+        get = item.get if isinstance(item, (dict, Item)) else ItemAdapter(item).get
+        return coupon_key(get('title'), get('code'), get('store'))
+
     def process_item(self, item, spider):
-        adapter = ItemAdapter(item)
-        
-        # Create a unique identifier based on title and code
-        title = adapter.get('title', '').strip().lower()
-        code = adapter.get('code', '').strip().lower()
-        store = adapter.get('store', '').strip().lower()
-        
-        unique_id = f"{title}:{code}:{store}"
+        unique_id = self.item_id(item)
         
         if unique_id in self.ids_seen:
             spider.logger.info(f"Duplicate item found: {unique_id}")
-            raise DropItem(f"Duplicate item found: {item}")
+            # Scrapy logs the dropped item itself, the key is enough here
+            raise DropItem(f"Duplicate item found: {unique_id}")
         else:
             self.ids_seen.add(unique_id)
             return item
@@ -75,6 +88,10 @@ class CleanDataPipeline:
     """Pipeline to clean and format data"""
     
     def process_item(self, item, spider):
+        # Whitespace and the offer terms were handled by the spider
+        if isinstance(item, NormalizedCouponItem):
+            return item
+        
         adapter = ItemAdapter(item)
         
         # Clean title
@@ -87,11 +104,9 @@ class CleanDataPipeline:
         if description:
             adapter['description'] = ' '.join(description.split())
         
-        # Extract discount percentage if not present
-        if not adapter.get('discount_percentage'):
-            title_text = f"{title} {description}".lower()
-            percentage_match = re.search(r'(\d+)%', title_text)
-            if percentage_match:
-                adapter['discount_percentage'] = int(percentage_match.group(1))
+        # Fill in the offer terms the item doesn't have
+        for name, value in offer_fields(adapter.get('title'), adapter.get('description')).items():
+            if not adapter.get(name):
+                adapter[name] = value
         
         return item
@@ -0,0 +1,333 @@
+"""
+Sampling profiler that can be switched on while a crawl runs.
+
+A background thread takes the reactor thread's stack every
+``PROFILER_INTERVAL`` seconds and counts identical stacks. Sessions are
+written as collapsed stacks (``frame;frame;... count``, root first), the
+input of flamegraph.pl, speedscope and inferno, and the time spent in the
+spider methods, the selector calls and each pipeline is logged and added
+to the stats. Nothing runs between sessions.
+
+A session is started and stopped by:
+
+- ``kill -USR2 <pid>``, which toggles it;
+- the crawl's remote control endpoint (Scrapy's RemoteControl extension),
+  e.g. ``python -m coupon_scraper.profiler start --seconds 30``;
+- ``PROFILER_RESPONSES``, which profiles that many responses after the
+  first ``PROFILER_START_AFTER``.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+logger = logging.getLogger(__name__)
+
+SPIDERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spiders')
+SELECTOR_METHODS = ('css', 'xpath', 're', 're_first', 'get', 'getall', 'attrib', 'jmespath')
+
+
+class StackSampler:
+    """Counts of the stacks of one thread, sampled from a background thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()     # stack of code objects, leaf first -> samples
+        self.samples = 0
+        self.busy = 0.0             # seconds spent sampling
+        self.started = None
+        self.elapsed = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def run(self):
+        current_frames = sys._current_frames
+        clock = time.perf_counter
+        while not self.stopping.wait(self.interval):
+            started = clock()
+            frame = current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                self.counts[tuple(stack)] += 1
+                self.samples += 1
+            self.busy += clock() - started
+
+
+def qualname(code):
+    """Qualified name of a code object (just its name before Python 3.11)"""
+    return getattr(code, 'co_qualname', code.co_name)
+
+
+def frame_name(code):
+    """Flame graph label of a code object: qualified name and file"""
+    path = code.co_filename.replace(os.sep, '/').rsplit('/', 2)
+    return f"{qualname(code)} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def hot_spot(code):
+    """Name to attribute the time of ``code`` to, or None
+
+    The methods of the project's spiders, the parsel selector calls and
+    ``process_item`` of every pipeline are tracked.
+    """
+    name = qualname(code)
+    if code.co_filename.startswith(SPIDERS_DIR):
+        return name
+    if name.endswith('.process_item'):
+        return name
+    if name.startswith(('Selector.', 'SelectorList.')) and name.rpartition('.')[2] in SELECTOR_METHODS:
+        return f'parsel {name}'
+    return None
+
+
+def collapse(counts):
+    """Collapsed stack lines, root frame first"""
+    names = {}
+    lines = Counter()
+    for stack, count in counts.items():
+        frames = []
+        for code in reversed(stack):
+            name = names.get(code)
+            if name is None:
+                name = names[code] = frame_name(code).replace(';', ':')
+            frames.append(name)
+        lines[';'.join(frames)] += count
+    return [f'{line} {count}' for line, count in sorted(lines.items())]
+
+
+def hot_spots(counts):
+    """Samples in each tracked function, callees included (recursion counted once)"""
+    spots = {}
+    totals = Counter()
+    for stack, count in counts.items():
+        seen = set()
+        for code in stack:
+            spot = spots.get(code, False)
+            if spot is False:
+                spot = spots[code] = hot_spot(code)
+            if spot is not None:
+                seen.add(spot)
+        for spot in seen:
+            totals[spot] += count
+    return totals
+
+
+class SamplingProfiler:
+    """Extension sampling the reactor thread on demand
+
+    Idle until a session is started (see the module docstring), and then
+    the only cost is the sampling thread waking every ``PROFILER_INTERVAL``
+    to walk one stack, which is measured as ``profiler/overhead``.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('PROFILER_INTERVAL', 0.005)
+        self.directory = settings.get('PROFILER_DIR', 'profiles')
+        self.top = settings.getint('PROFILER_TOP', 15)
+        self.start_after = settings.getint('PROFILER_START_AFTER', 0)
+        self.window = settings.getint('PROFILER_RESPONSES', 0)
+        # The extension is built in the reactor thread
+        self.thread_id = threading.get_ident()
+        self.sampler = None
+        self.stop_call = None
+        self.responses = 0
+        self.files = []
+        self.signum = None
+        self.previous_handler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILER_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        if ext.window:
+            crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        return ext
+
+    @classmethod
+    def find(cls, crawler):
+        """The profiler of ``crawler``, for the remote control endpoint"""
+        for ext in crawler.extensions.middlewares:
+            if isinstance(ext, cls):
+                return ext
+        raise NotConfigured('PROFILER_ENABLED is not set')
+
+    @property
+    def running(self):
+        return self.sampler is not None
+
+    def spider_opened(self, spider):
+        signame = self.crawler.settings.get('PROFILER_SIGNAL', 'SIGUSR2')
+        signum = getattr(signal, signame, None) if signame else None
+        if signum is not None and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signum, self.handle_signal)
+            self.signum = signum
+            spider.logger.info(f'Profiler ready: kill -{signame[3:]} {os.getpid()} toggles sampling')
+        if self.window and self.start_after == 0:
+            self.start()
+
+    def spider_closed(self, spider):
+        if self.running:
+            self.stop()
+        if self.previous_handler is not None:
+            signal.signal(self.signum, self.previous_handler)
+            self.previous_handler = None
+
+    def response_received(self, response, request, spider):
+        self.responses += 1
+        if self.responses == self.start_after and self.start_after:
+            self.start()
+        elif self.responses == self.start_after + self.window and self.running:
+            self.stop()
+
+    def handle_signal(self, signum, frame):
+        from twisted.internet import reactor
+        reactor.callFromThread(self.toggle)
+
+    def toggle(self):
+        if self.running:
+            return self.stop()
+        return self.start()
+
+    def start(self, seconds=None):
+        """Start a session, stopped after ``seconds`` if given"""
+        if self.running:
+            return None
+        self.sampler = StackSampler(self.thread_id, self.interval)
+        self.sampler.start()
+        if seconds:
+            from twisted.internet import reactor
+            self.stop_call = reactor.callLater(seconds, self.stop)
+        logger.info(f'Profiler started, sampling every {self.interval * 1000:g}ms')
+        return None
+
+    def stop(self):
+        """Stop the session and write its collapsed stacks, returning the file path"""
+        if not self.running:
+            return None
+        if self.stop_call is not None and self.stop_call.active():
+            self.stop_call.cancel()
+        self.stop_call = None
+        sampler, self.sampler = self.sampler, None
+        sampler.stop()
+        return self.report(sampler)
+
+    def report(self, sampler):
+        spider = self.crawler.spider
+        name = spider.name if spider else 'crawl'
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{name}-{datetime.now():%Y%m%d-%H%M%S-%f}.collapsed")
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(f'{line}\n' for line in collapse(sampler.counts))
+        os.replace(tmp_path, path)
+        self.files.append(path)
+
+        self.stats.inc_value('profiler/sessions')
+        self.stats.inc_value('profiler/samples', sampler.samples)
+        self.stats.inc_value('profiler/overhead', round(sampler.busy, 4))
+        totals = hot_spots(sampler.counts)
+        lines = [
+            f'{sampler.samples} samples over {sampler.elapsed:.1f}s, '
+            f'sampling took {sampler.busy / max(sampler.elapsed, 1e-9):.2%}, written to {path}'
+        ]
+        # The sampling thread wakes up a little later than asked
+        period = sampler.elapsed / sampler.samples if sampler.samples else self.interval
+        for spot, count in totals.most_common(self.top):
+            seconds = count * period
+            self.stats.inc_value(f'profiler/time/{spot}', round(seconds, 3))
+            lines.append(f'  {count / max(sampler.samples, 1):6.1%} {seconds:8.2f}s  {spot}')
+        logger.info('Profile:\n' + '\n'.join(lines))
+        return path
+
+
+def job_files_dir(settings):
+    """Directory where running crawls write their remote control job files"""
+    try:
+        # Private to Scrapy; the fallback below mirrors what it does
+        from scrapy.utils._remote_control import job_files_dir
+    except ImportError:
+        from platformdirs import user_state_dir
+        if settings.get('REMOTE_CONTROL_JOBS_DIR'):
+            return Path(settings.get('REMOTE_CONTROL_JOBS_DIR'))
+        return Path(user_state_dir('scrapy', appauthor=False), 'job_files')
+    return job_files_dir(settings)
+
+
+def remote_execute(code, job_file=None):
+    """Run ``code`` in the newest running crawl through its remote control endpoint"""
+    if job_file is None:
+        from scrapy.utils.project import get_project_settings
+        directory = job_files_dir(get_project_settings())
+        jobs = sorted(directory.glob('*.json'), key=os.path.getmtime) if directory.exists() else []
+        if not jobs:
+            raise SystemExit(f'No running crawl found in {directory}')
+        job_file = jobs[-1]
+    with open(job_file) as f:
+        job = json.load(f)
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{job['port']}/execute",
+        data=json.dumps({'code': code}).encode(),
+        headers={'Authorization': f"Bearer {job['token']}", 'Content-Type': 'application/json'},
+    )
+    # The endpoint is local, never go through the http_proxy of the environment
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    with opener.open(request) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start or stop the profiler of a running crawl')
+    parser.add_argument('action', choices=['start', 'stop'])
+    parser.add_argument('--seconds', type=float, help='stop the session after this many seconds')
+    parser.add_argument('--job-file', help='job file of the crawl (default: the newest one)')
+    args = parser.parse_args()
+
+    call = f'start({args.seconds!r})' if args.action == 'start' else 'stop()'
+    result = remote_execute(
+        'from coupon_scraper.profiler import SamplingProfiler\n'
+        f'print(SamplingProfiler.find(crawler).{call})',
+        args.job_file,
+    )
+    if result['status'] != 'ok':
+        raise SystemExit(result.get('traceback') or result['status'])
+    if args.action == 'stop':
+        print(result['output'].strip() or 'The profiler was not running')
+    else:
+        print('Profiler started')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on Windows; concurrent writers may drop an entry
+    fcntl = None
+
+from scrapy.resolver import CachingThreadedResolver, dnscache
+from twisted.internet.threads import deferToThread
+
+
+def load_dns_cache(path, ttl):
+    """Read the unexpired entries of a persistent DNS cache file"""
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {
+        name: entry for name, entry in entries.items()
+        if now - entry['resolved_at'] <= ttl
+    }
+
+
+def save_dns_entries(path, new_entries):
+    """Merge lookups into the cache file shared by the spider processes"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        entries.update(new_entries)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+
+
+class PersistentCachingResolver(CachingThreadedResolver):
+    """Scrapy's caching resolver, warmed from and persisted to ``DNSCACHE_FILE``
+
+    Entries younger than ``DNSCACHE_TTL`` seconds are loaded into Scrapy's
+    DNS cache when the resolver is installed, so the first request to a
+    known domain does not wait for a lookup. Real lookups are merged back
+    into the file under a lock, so concurrent spider processes on the same
+    host share one cache. The file is written in a thread, one batch at a
+    time, and pending lookups are written before the reactor shuts down.
+
+    The resolver is shared by every crawler of the process; the DNSCacheWarmup
+    extension reports, per crawl, the hosts it requested that were
+    ``preloaded`` or ``looked_up``.
+    """
+
+    def __init__(self, reactor, cache_size, timeout, cache_file=None, ttl=3600):
+        super().__init__(reactor, cache_size, timeout)
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.preloaded = {}
+        self.looked_up = {}
+        self.pending = {}
+        self.saving = None
+        if cache_file and dnscache.limit:
+            self.preloaded = load_dns_cache(cache_file, ttl)
+            for name, entry in self.preloaded.items():
+                dnscache[name] = entry['address']
+
+    @classmethod
+    def from_crawler(cls, crawler, reactor):
+        settings = crawler.settings
+        if settings.getbool('DNSCACHE_ENABLED'):
+            cache_size = settings.getint('DNSCACHE_SIZE')
+        else:
+            cache_size = 0
+        return cls(
+            reactor,
+            cache_size,
+            settings.getfloat('DNS_TIMEOUT'),
+            cache_file=settings.get('DNSCACHE_FILE'),
+            ttl=settings.getint('DNSCACHE_TTL', 3600),
+        )
+
+    def install_on_reactor(self):
+        super().install_on_reactor()
+        if self.cache_file:
+            self.reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def getHostByName(self, name, timeout=()):
+        if name in dnscache:
+            return super().getHostByName(name, timeout)
+
+        started = time.perf_counter()
+        d = super().getHostByName(name, timeout)
+        if self.cache_file:
+            d.addCallback(self._persist_result, name, started)
+        return d
+
+    def _persist_result(self, address, name, started):
+        entry = {
+            'address': address,
+            'resolved_at': time.time(),
+            'latency': time.perf_counter() - started,
+        }
+        self.looked_up[name] = entry
+        self.pending[name] = entry
+        self.flush()
+        return address
+
+    def flush(self):
+        """Write the pending lookups in a thread; lookups made meanwhile go in the next batch"""
+        if self.saving is None and self.pending:
+            entries, self.pending = self.pending, {}
+            self.saving = deferToThread(save_dns_entries, self.cache_file, entries)
+            self.saving.addErrback(lambda failure: failure.trap(OSError))
+            self.saving.addBoth(self._saved)
+        return self.saving
+
+    def _saved(self, _):
+        self.saving = None
+        return self.flush()
@@ -33,15 +33,34 @@ USER_AGENT_LIST = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Edge/120.0.0.0 Safari/537.36'
 ]
 
+# Keep one identity (user agent, headers, cookie jar) per domain slot
+# instead of a random user agent per request
+SESSION_AFFINITY_ENABLED = False
+# Replace a slot's identity after this many requests (0 = never)
+SESSION_MAX_REQUESTS = 200
+# Replace a slot's identity when a response looks like a block
+SESSION_BLOCK_STATUSES = [403, 429]
+
+# Maximum pages scheduled per listing when numbered pagination is found
+PAGINATION_MAX_PAGES = 50
+
 # Configure pipelines
 ITEM_PIPELINES = {
     'coupon_scraper.pipelines.CouponValidationPipeline': 300,
+    'coupon_scraper.store.CouponStorePipeline': 350,
     'coupon_scraper.pipelines.DuplicatesPipeline': 400,
+    'coupon_scraper.sinks.SinkFanoutPipeline': 800,
 }
 
 # Configure middlewares
 DOWNLOADER_MIDDLEWARES = {
+    'coupon_scraper.middlewares.PersistentRobotsTxtCacheMiddleware': 50,
     'coupon_scraper.middlewares.RotateUserAgentMiddleware': 400,
+    'coupon_scraper.middlewares.RenderOnDemandMiddleware': 560,
+}
+
+SPIDER_MIDDLEWARES = {
+    'coupon_scraper.checkpoint.CheckpointMiddleware': 25,
 }
 
 # Configure caching (disable in production)
@@ -60,3 +79,155 @@ FEEDS = {
         'indent': 4,
     },
 }
+
+# Sitemap discovery (or run with -a discovery=sitemap)
+SITEMAP_DISCOVERY_ENABLED = False
+# Only page URLs matching one of these patterns are crawled
+SITEMAP_FOLLOW = [
+    r'/coupon-codes/',
+    r'/coupons/',
+    r'/store/',
+    r'/view/',
+]
+# Skip pages whose lastmod has not changed since they were last crawled
+SITEMAP_SKIP_UNCHANGED = True
+SITEMAP_STATE_FILE = '.scrapy/sitemap_state.json'
+# Maximum page URLs scheduled from sitemaps per run (0 = no limit)
+SITEMAP_MAX_URLS = 0
+
+# Churn-aware revisit scheduling (or run with -a discovery=revisit)
+REVISIT_ENABLED = False
+REVISIT_STATE_FILE = '.scrapy/revisit_state.json'
+# Maximum start requests per run (0 = revisit every known URL)
+REVISIT_BUDGET = 0
+# Assumed change interval, in hours, for URLs with little history
+REVISIT_PRIOR_INTERVAL = 24
+
+# Extensions
+EXTENSIONS = {
+    'coupon_scraper.extensions.MemoryDiagnostics': 500,
+    'coupon_scraper.extensions.DNSCacheWarmup': 500,
+    'coupon_scraper.feeds.SegmentedFeed': 500,
+    'coupon_scraper.checkpoint.CrawlCheckpoint': 500,
+    'coupon_scraper.profiler.SamplingProfiler': 500,
+}
+
+# Memory diagnostics (tracemalloc snapshots and live object counts)
+MEMDIAG_ENABLED = False
+MEMDIAG_INTERVAL = 500
+# Responses traced before each snapshot; tracemalloc is off in between
+MEMDIAG_WINDOW = 50
+MEMDIAG_TOP = 10
+MEMDIAG_FILE = 'memdiag.log'
+
+# robots.txt cache shared by runs and spider processes on this host
+ROBOTSCACHE_ENABLED = True
+ROBOTSCACHE_DIR = '.scrapy/robots'
+ROBOTSCACHE_TTL = 24 * 3600
+
+# DNS cache persisted between runs and warmed at spider open
+DNS_RESOLVER = 'coupon_scraper.resolver.PersistentCachingResolver'
+DNSCACHE_FILE = '.scrapy/dnscache.json'
+DNSCACHE_TTL = 3600
+
+# Columnar feed formats (require pyarrow), e.g. -o coupons.parquet
+# Roll over every N rows with the feed option 'batch_item_count' and a
+# '%(batch_id)d' placeholder in the feed URI
+FEED_EXPORTERS = {
+    'parquet': 'coupon_scraper.exporters.ParquetItemExporter',
+    'arrow': 'coupon_scraper.exporters.ArrowItemExporter',
+}
+
+# Compressed, rotating JSON lines segments with a manifest (set a directory to enable)
+SEGMENTED_FEED_DIR = None
+# gzip, zstd (Python 3.14+, backports.zstd or zstandard, see requirements.txt) or none
+SEGMENTED_FEED_COMPRESSION = 'gzip'
+# Rotate after this many bytes of JSON or seconds, whichever comes first
+SEGMENTED_FEED_MAX_BYTES = 64 * 1024 * 1024
+SEGMENTED_FEED_MAX_SECONDS = 300
+
+# Render pages with no statically extractable coupons through a Splash
+# compatible render service (GET /render.html)
+RENDER_ENABLED = False
+RENDER_URL = 'http://localhost:8050'
+RENDER_WAIT = 0.5
+RENDER_TIMEOUT = 30
+# Maximum pages sent to the render service per run (0 = no limit)
+RENDER_BUDGET = 50
+RENDER_CACHE_DIR = '.scrapy/render_cache'
+RENDER_CACHE_TTL = 24 * 3600
+# Render pool size: the concurrency of the 'render' download slot
+DOWNLOAD_SLOTS = {
+    'render': {'concurrency': 2, 'delay': 0},
+}
+
+# Crash-safe checkpointing (set a directory to enable); resume with
+# CHECKPOINT_RESUME or run_coupons_scraper.py --resume DIR
+CHECKPOINT_DIR = None
+# Seconds between commits of the journal and the items feed
+CHECKPOINT_INTERVAL = 10
+CHECKPOINT_RESUME = False
+# JSON lines feed written by the checkpoint (default: DIR/items.jsonl)
+CHECKPOINT_FEED = None
+
+# Expiry-indexed coupon store (set a file to enable); expired coupons are
+# evicted incrementally and appended to COUPON_STORE_ARCHIVE if set
+COUPON_STORE_FILE = None
+COUPON_STORE_ARCHIVE = None
+# Drop coupons that are already expired when scraped (works without a store)
+COUPON_STORE_DROP_EXPIRED = False
+
+# Asynchronous output fan-out: name -> {'class': ..., sink options}, see
+# coupon_scraper/sinks.py (empty = disabled)
+SINKS = {}
+SINK_QUEUE_SIZE = 1000
+SINK_BATCH_SIZE = 100
+# Seconds to wait for a batch to fill up before writing it anyway
+SINK_FLUSH_INTERVAL = 1.0
+SINK_RETRIES = 3
+SINK_RETRY_DELAY = 1.0
+# Batches a sink couldn't take are kept here and written again later
+SINK_SPILL_DIR = '.scrapy/sink_spill'
+# Pause the engine when a sink queue is this full, resume below SINK_RESUME_AT
+SINK_PAUSE_AT = 0.8
+SINK_RESUME_AT = 0.5
+
+# LRU cache of the fields extracted from coupon cards, keyed by the card
+# markup; saved to CARD_CACHE_FILE between runs (None = this run only)
+CARD_CACHE_ENABLED = False
+CARD_CACHE_SIZE = 10000
+CARD_CACHE_FILE = '.scrapy/card_cache.json'
+
+# HTTP/2 for https downloads: requests to a host are multiplexed over one
+# connection (requires h2, pip install 'Twisted[http2]'). Hosts that don't
+# negotiate HTTP/2, plain http and proxied requests use HTTP/1.1
+DOWNLOAD_HANDLERS = {
+    'https': 'coupon_scraper.http2.FallbackH2DownloadHandler',
+}
+HTTP2_ENABLED = False
+# Maximum concurrent streams per host, on top of CONCURRENT_REQUESTS_PER_DOMAIN
+HTTP2_MAX_STREAMS = 8
+
+# Sampling profiler of the reactor thread; once enabled it stays idle until
+# switched on with kill -USR2 <pid>, python -m coupon_scraper.profiler
+# start|stop or PROFILER_RESPONSES; sessions are written to PROFILER_DIR as
+# collapsed stacks
+PROFILER_ENABLED = False
+PROFILER_INTERVAL = 0.005
+PROFILER_DIR = 'profiles'
+PROFILER_SIGNAL = 'SIGUSR2'
+# Profile this many responses after the first PROFILER_START_AFTER (0 = off)
+PROFILER_RESPONSES = 0
+PROFILER_START_AFTER = 0
+
+# Crawl worker (python -m coupon_scraper.worker): feeds and the files in
+# coupon_scraper.worker.JOB_PATH_SETTINGS go to WORKER_JOBS_DIR/<run>/job-<id>
+# unless the job sets them
+WORKER_JOBS_DIR = '.scrapy/worker'
+
+# Request fingerprints kept as 8-byte integers in a hash table instead of
+# Scrapy's set of bytes objects; with JOBDIR the table is a memory-mapped
+# file (requests.seen.table) that resumed crawls map back
+DUPEFILTER_CLASS = 'coupon_scraper.dupefilters.CompactDupeFilter'
+# Initial table slots, doubled when 70% full (~1.5x the expected requests)
+DUPEFILTER_CAPACITY = 65536
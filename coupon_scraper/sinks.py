@@ -0,0 +1,390 @@
+"""
+Asynchronous output fan-out.
+
+SinkFanoutPipeline hands every item to several sinks at once (files,
+databases, message queues). Each sink has its own bounded queue and a
+task writing batches from it, so a slow sink only delays its own writes;
+when any queue fills up the engine is paused until the queues drain.
+Configure the sinks with the SINKS setting::
+
+    SINKS = {
+        'file': {'class': 'coupon_scraper.sinks.JsonLinesSink', 'path': 'output/coupons.jsonl'},
+        'db': {'class': 'coupon_scraper.sinks.SqliteSink', 'path': 'output/coupons.db'},
+        'queue': {'class': 'coupon_scraper.sinks.SpoolQueueSink', 'directory': 'output/queue',
+                  'batch_size': 500},
+    }
+
+``queue_size`` and ``batch_size`` override SINK_QUEUE_SIZE and
+SINK_BATCH_SIZE for one sink; the other keys are passed to the sink class.
+
+Requires the asyncio reactor (the default).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+
+from coupon_scraper.pipelines import DuplicatesPipeline
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sink:
+    """Destination for batches of items
+
+    Subclasses implement write() and may override open() and close().
+    Slow blocking calls (network, fsync) should go through
+    asyncio.to_thread() so they don't stall the reactor; short buffered
+    writes are cheaper done directly. ``latency`` adds a simulated delay to every batch, for
+    load tests.
+    """
+
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.latency = latency
+
+    async def open(self):
+        pass
+
+    async def write(self, items):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class JsonLinesSink(Sink):
+    """Append items to a JSON lines file"""
+
+    def __init__(self, name, path, **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = path
+        self.file = None
+
+    async def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, 'a')
+
+    async def write(self, items):
+        # A buffered append is cheaper than a hop to a worker thread
+        self.file.write(''.join(json.dumps(item) + '\n' for item in items))
+        self.file.flush()
+
+    async def close(self):
+        self.file.close()
+
+
+class SqliteSink(Sink):
+    """Upsert items into a SQLite table keyed by DuplicatesPipeline's id"""
+
+    def __init__(self, name, path, table='coupons', **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = path
+        self.table = table
+        self.connection = None
+
+    async def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Only ever used by one thread at a time: the sink writes one batch at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, item TEXT)')
+
+    async def write(self, items):
+        rows = [(DuplicatesPipeline.item_id(item), json.dumps(item)) for item in items]
+        await asyncio.to_thread(self.write_rows, rows)
+
+    def write_rows(self, rows):
+        with self.connection:
+            self.connection.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)', rows)
+
+    async def close(self):
+        self.connection.close()
+
+
+class SpoolQueueSink(Sink):
+    """Message queue stand-in: every batch becomes one message file in a spool directory
+
+    Messages are written under a temporary name and renamed, so a consumer
+    never sees a partial message.
+    """
+
+    def __init__(self, name, directory, **kwargs):
+        super().__init__(name, **kwargs)
+        self.directory = directory
+        self.sequence = 0
+
+    async def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    async def write(self, items):
+        self.sequence += 1
+        path = os.path.join(self.directory, f'{time.time_ns()}-{self.sequence:06d}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(json.dumps(items))
+        os.replace(f'{path}.tmp', path)
+
+
+class SinkWriter:
+    """Bounded queue and batching writer task of one sink
+
+    A batch that still fails after the retries is appended to a spill file
+    and the sink is considered down: until a probe write succeeds, which is
+    tried again after the longest retry delay, batches go straight to the
+    spill file. Spilled items are written to the sink again after its next
+    successful write, or when the next crawl opens it.
+    """
+
+    def __init__(self, sink, stats, queue_size, batch_size, flush_interval, retries, retry_delay, spill_dir,
+                 on_batch_done=None):
+        self.sink = sink
+        self.stats = stats
+        self.queue = asyncio.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.spill_path = os.path.join(spill_dir, f'{sink.name}.jsonl') if spill_dir else None
+        self.on_batch_done = on_batch_done
+        self.prefix = f'sinks/{sink.name}'
+        self.task = None
+        self.down_until = None
+        self.batches = 0
+        self.write_time = 0.0
+
+    def fill(self):
+        # A stopped writer fails its puts instead of holding the engine paused
+        if self.task is not None and self.task.done():
+            return 0.0
+        return self.queue.qsize() / self.queue.maxsize
+
+    async def start(self):
+        await self.sink.open()
+        await self.replay_spill()
+        self.task = asyncio.create_task(self.run())
+
+    async def enqueue(self, item):
+        """Queue ``item``, or return False if the writer task stops before there is room"""
+        if self.task.done():
+            return False
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return True
+        put = asyncio.ensure_future(self.queue.put(item))
+        await asyncio.wait([put, self.task], return_when=asyncio.FIRST_COMPLETED)
+        if put.done():
+            return True
+        put.cancel()
+        return False
+
+    async def put(self, item):
+        if not await self.enqueue(item):
+            error = None if self.task.cancelled() else self.task.exception()
+            raise RuntimeError(f'Sink {self.sink.name} writer has stopped') from error
+        depth = self.queue.qsize()
+        self.stats.set_value(f'{self.prefix}/queue_depth', depth)
+        self.stats.max_value(f'{self.prefix}/queue_depth_max', depth)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            closing = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    if self.queue.empty():
+                        item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                    else:
+                        item = self.queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            try:
+                await self.write(batch)
+            finally:
+                self.stats.set_value(f'{self.prefix}/queue_depth', self.queue.qsize())
+                if self.on_batch_done:
+                    self.on_batch_done()
+            if closing:
+                return
+
+    async def write(self, batch):
+        loop = asyncio.get_running_loop()
+        if self.down_until is not None and loop.time() < self.down_until:
+            self.spill(batch)
+            return
+        # A sink known to be down gets a single probe write
+        attempts = 1 if self.down_until is not None else self.retries + 1
+        for attempt in range(attempts):
+            if await self.try_write(batch):
+                self.down_until = None
+                await self.replay_spill()
+                return
+            if attempt < attempts - 1:
+                self.stats.inc_value(f'{self.prefix}/retries')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        self.down_until = loop.time() + self.retry_delay * 2 ** self.retries
+        self.spill(batch)
+
+    async def try_write(self, batch):
+        started = time.perf_counter()
+        try:
+            if self.sink.latency:
+                await asyncio.sleep(self.sink.latency)
+            await self.sink.write(batch)
+        except Exception as e:
+            logger.warning(f'Sink {self.sink.name} failed to write {len(batch)} items: {e}')
+            self.stats.inc_value(f'{self.prefix}/errors')
+            return False
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.write_time += elapsed
+        self.stats.inc_value(f'{self.prefix}/items', len(batch))
+        self.stats.inc_value(f'{self.prefix}/batches')
+        self.stats.set_value(f'{self.prefix}/write_latency_avg', round(self.write_time / self.batches, 4))
+        self.stats.max_value(f'{self.prefix}/write_latency_max', round(elapsed, 4))
+        return True
+
+    def spill(self, batch):
+        if not self.spill_path:
+            logger.error(f'Sink {self.sink.name} lost {len(batch)} items')
+            self.stats.inc_value(f'{self.prefix}/lost', len(batch))
+            return
+        os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+        with open(self.spill_path, 'a') as f:
+            for item in batch:
+                f.write(json.dumps(item) + '\n')
+        self.stats.inc_value(f'{self.prefix}/spilled', len(batch))
+
+    async def replay_spill(self):
+        """Write the spilled items to the sink, keeping them spilled if it fails again"""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        replay_path = f'{self.spill_path}.replay'
+        os.replace(self.spill_path, replay_path)
+        with open(replay_path, 'r') as f:
+            items = [json.loads(line) for line in f]
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            if not await self.try_write(batch):
+                self.spill(items[start:])
+                break
+            self.stats.inc_value(f'{self.prefix}/replayed', len(batch))
+        os.remove(replay_path)
+
+    async def close(self):
+        """Write what is still queued, without waiting for the flush interval
+
+        Raises the writer task's exception, after closing the sink.
+        """
+        try:
+            await self.enqueue(None)
+            await self.task
+        finally:
+            await self.sink.close()
+
+
+class SinkFanoutPipeline:
+    """Write every item to all the sinks in the ``SINKS`` setting
+
+    process_item only waits for room in the sink queues, not for the
+    writes. When a queue is more than ``SINK_PAUSE_AT`` full the engine is
+    paused, so no new requests are downloaded, and it is unpaused once
+    every queue is below ``SINK_RESUME_AT``. Closing the spider waits for
+    the queues to drain.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.pause_at = settings.getfloat('SINK_PAUSE_AT', 0.8)
+        self.resume_at = settings.getfloat('SINK_RESUME_AT', 0.5)
+        self.paused_since = None
+        self.writers = []
+        for name, options in settings.getdict('SINKS').items():
+            options = dict(options)
+            sinkcls = load_object(options.pop('class'))
+            queue_size = options.pop('queue_size', settings.getint('SINK_QUEUE_SIZE', 1000))
+            batch_size = options.pop('batch_size', settings.getint('SINK_BATCH_SIZE', 100))
+            self.writers.append(SinkWriter(
+                sinkcls(name, **options), self.stats,
+                queue_size=queue_size,
+                batch_size=batch_size,
+                flush_interval=settings.getfloat('SINK_FLUSH_INTERVAL', 1.0),
+                retries=settings.getint('SINK_RETRIES', 3),
+                retry_delay=settings.getfloat('SINK_RETRY_DELAY', 1.0),
+                spill_dir=settings.get('SINK_SPILL_DIR'),
+                on_batch_done=self.check_backpressure,
+            ))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getdict('SINKS'):
+            raise NotConfigured
+        if not is_asyncio_reactor_installed():
+            raise NotConfigured('SINKS requires the asyncio reactor')
+        return cls(crawler)
+
+    async def open_spider(self):
+        for writer in self.writers:
+            await writer.start()
+
+    async def process_item(self, item):
+        data = ItemAdapter(item).asdict()
+        try:
+            for writer in self.writers:
+                await writer.put(data)
+        finally:
+            self.check_backpressure()
+        return item
+
+    def check_backpressure(self):
+        engine = self.crawler.engine
+        fill = max(writer.fill() for writer in self.writers)
+        if self.paused_since is None and fill >= self.pause_at:
+            self.paused_since = time.perf_counter()
+            engine.pause()
+            self.stats.inc_value('sinks/pauses')
+        elif self.paused_since is not None and fill < self.resume_at:
+            self.stats.inc_value('sinks/paused_time', time.perf_counter() - self.paused_since)
+            self.paused_since = None
+            engine.unpause()
+            # unpause() alone waits for the engine's next heartbeat (5s).
+            # engine._slot.nextcall is private Scrapy API (2.x up to at least
+            # 2.19); without it the crawl resumes on the heartbeat
+            nextcall = getattr(getattr(engine, '_slot', None), 'nextcall', None)
+            if nextcall is not None:
+                nextcall.schedule()
+
+    async def close_spider(self):
+        # Every sink is closed even if another one's writer failed
+        results = await asyncio.gather(*(writer.close() for writer in self.writers), return_exceptions=True)
+        if self.paused_since is not None:
+            self.stats.inc_value('sinks/paused_time', time.perf_counter() - self.paused_since)
+            self.paused_since = None
+        errors = [(writer, result) for writer, result in zip(self.writers, results) if isinstance(result, Exception)]
+        for writer, error in errors:
+            logger.error(f'Sink {writer.sink.name} failed: {error!r}')
+            self.stats.inc_value(f'{writer.prefix}/failed')
+        if errors:
+            raise errors[0][1]
@@ -0,0 +1,300 @@
+import gzip
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import urljoin
+
+import scrapy
+from lxml import etree
+from scrapy import signals
+
+
+# Sitemap <lastmod> values use W3C datetime: a bare date, or a date and time
+# with an optional UTC offset ("Z" or "+hh:mm")
+LASTMOD_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M%z',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+]
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Pages without a lastmod are crawled after every dated page
+UNKNOWN_LASTMOD_PRIORITY = -10 ** 6
+
+
+def parse_lastmod(text):
+    """Parse a sitemap lastmod value into an aware UTC datetime"""
+    if not text:
+        return None
+
+    text = text.strip()
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+
+    for fmt in LASTMOD_FORMATS:
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+    return None
+
+
+def _local_name(tag):
+    if not isinstance(tag, str):
+        return ''
+    return tag.rpartition('}')[2]
+
+
+def iter_sitemap(source):
+    """Stream (kind, loc, lastmod) entries out of a sitemap or sitemap index
+
+    ``source`` is the raw body (bytes, optionally gzipped) or a file-like
+    object. Elements are cleared as soon as they are read so memory stays
+    flat no matter how many entries the sitemap holds. ``kind`` is
+    ``'sitemap'`` for sitemap index entries and ``'url'`` for page entries.
+    """
+    if isinstance(source, bytes):
+        if source[:2] == GZIP_MAGIC:
+            source = gzip.GzipFile(fileobj=BytesIO(source))
+        else:
+            source = BytesIO(source)
+
+    context = etree.iterparse(
+        source,
+        events=('end',),
+        recover=True,
+        resolve_entities=False,
+        no_network=True,
+        remove_comments=True,
+        remove_pis=True,
+    )
+
+    for _, elem in context:
+        kind = _local_name(elem.tag)
+        if kind not in ('url', 'sitemap'):
+            continue
+
+        loc = lastmod = None
+        for child in elem:
+            name = _local_name(child.tag)
+            if name == 'loc' and child.text:
+                loc = child.text.strip()
+            elif name == 'lastmod' and child.text:
+                lastmod = parse_lastmod(child.text)
+
+        # Drop the finished element and any already processed siblings
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        if loc:
+            yield kind, loc, lastmod
+
+
+def sitemap_urls_from_robots(body, base_url):
+    """Yield the Sitemap: entries of a robots.txt body"""
+    for line in body.splitlines():
+        if line.lstrip()[:8].lower() == b'sitemap:':
+            url = line.partition(b':')[2].strip().decode('utf-8', 'ignore')
+            if url:
+                yield urljoin(base_url, url)
+
+
+class SitemapState:
+    """Persistent map of URL -> lastmod seen on the previous runs"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lastmods = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.lastmods = json.load(f)
+
+    def is_unchanged(self, url, lastmod):
+        """True if the URL was crawled at or after its current lastmod"""
+        if lastmod is None:
+            return False
+        seen = parse_lastmod(self.lastmods.get(url))
+        return seen is not None and lastmod <= seen
+
+    def mark(self, url, lastmod):
+        if lastmod is None:
+            return
+        self.lastmods[url] = lastmod.isoformat()
+        self.dirty = True
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.lastmods, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class SitemapDiscovery:
+    """Discover store and coupon pages from a spider's sitemaps
+
+    Spiders list their sitemap (or robots.txt) URLs in ``sitemap_urls``.
+    Page URLs matching ``SITEMAP_FOLLOW`` are scheduled with a priority
+    derived from their lastmod (most recently changed first), and URLs
+    whose lastmod has not moved since the last successful crawl are
+    skipped. The lastmod of a page is only recorded once it has been
+    downloaded. The lastmod of a child sitemap is only recorded when the
+    crawl finishes, and only if every page it listed was scheduled and
+    downloaded, and so were the sitemaps it lists. A failed, interrupted
+    or budget-limited run therefore does not hide pages from the next one.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.follow = [re.compile(p) for p in settings.getlist('SITEMAP_FOLLOW')]
+        self.skip_unchanged = settings.getbool('SITEMAP_SKIP_UNCHANGED', True)
+        self.max_urls = settings.getint('SITEMAP_MAX_URLS', 0)
+        self.state = SitemapState(settings.get('SITEMAP_STATE_FILE'))
+        self.scheduled = 0
+        # Child sitemaps downloaded this run, recorded when the crawl finishes
+        self.sitemap_lastmods = {}
+        # Sitemap -> its scheduled pages not downloaded yet, and page -> the
+        # sitemaps waiting for it
+        self.pending = defaultdict(int)
+        self.page_sitemaps = defaultdict(list)
+        self.crawled = set()
+        # Sitemap -> child sitemaps followed, and sitemaps with pages left out
+        self.children = defaultdict(list)
+        self.incomplete = set()
+        self.now = datetime.now(timezone.utc)
+
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+        crawler.signals.connect(self.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def start_requests(self, spider):
+        """Yield requests for every sitemap listed on the spider"""
+        self.spider = spider
+        for url in getattr(spider, 'sitemap_urls', []):
+            if url.endswith('/robots.txt'):
+                yield scrapy.Request(url, callback=self.parse_robots, dont_filter=True)
+            else:
+                yield scrapy.Request(url, callback=self.parse_sitemap, dont_filter=True)
+
+    def parse_robots(self, response):
+        for url in sitemap_urls_from_robots(response.body, response.url):
+            yield scrapy.Request(url, callback=self.parse_sitemap)
+
+    def parse_sitemap(self, response):
+        """Follow changed child sitemaps and schedule changed pages by lastmod"""
+        sitemap = response.meta.get('sitemap_url', response.url) if response.request else response.url
+        pages = []
+        for kind, loc, lastmod in iter_sitemap(response.body):
+            if kind == 'sitemap':
+                if self.skip_unchanged and self.state.is_unchanged(loc, lastmod):
+                    self.stats.inc_value('sitemap/sitemaps_unchanged')
+                    continue
+                self.stats.inc_value('sitemap/sitemaps_followed')
+                self.children[sitemap].append(loc)
+                yield scrapy.Request(loc, callback=self.parse_sitemap,
+                                     meta={'child_sitemap_lastmod': lastmod, 'sitemap_url': loc})
+                continue
+
+            self.stats.inc_value('sitemap/urls_seen')
+            if self.follow and not any(p.search(loc) for p in self.follow):
+                continue
+            if self.skip_unchanged and self.state.is_unchanged(loc, lastmod):
+                self.stats.inc_value('sitemap/urls_unchanged')
+                continue
+            pages.append((loc, lastmod))
+
+        # Newest first, pages without a lastmod last
+        pages.sort(key=lambda page: page[1] or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+
+        for loc, lastmod in pages:
+            if self.max_urls and self.scheduled >= self.max_urls:
+                self.stats.inc_value('sitemap/urls_over_budget')
+                self.incomplete.add(sitemap)
+                continue
+            self.scheduled += 1
+            self.stats.inc_value('sitemap/urls_scheduled')
+            self.pending[sitemap] += 1
+            self.page_sitemaps[loc].append(sitemap)
+            yield scrapy.Request(
+                loc,
+                callback=self.spider.parse,
+                priority=self.lastmod_priority(lastmod),
+                meta={'sitemap_lastmod': lastmod, 'sitemap_page': loc},
+            )
+
+        self.spider.logger.info(f'Sitemap {response.url}: scheduled {len(pages)} changed URLs')
+
+    def lastmod_priority(self, lastmod):
+        """Request priority: 0 for pages changed now, minus one per hour of age"""
+        if lastmod is None:
+            return UNKNOWN_LASTMOD_PRIORITY
+        age_hours = int((self.now - lastmod).total_seconds() // 3600)
+        return max(-max(age_hours, 0), UNKNOWN_LASTMOD_PRIORITY + 1)
+
+    def response_received(self, response, request, spider):
+        if response.status != 200:
+            return
+        if 'sitemap_lastmod' in request.meta:
+            page = request.meta.get('sitemap_page', request.url)
+            self.state.mark(page, request.meta['sitemap_lastmod'])
+            self.page_crawled(page)
+        elif 'child_sitemap_lastmod' in request.meta:
+            self.sitemap_lastmods[request.meta.get('sitemap_url', request.url)] = request.meta['child_sitemap_lastmod']
+
+    def request_dropped(self, request, spider):
+        # A page listed by two sitemaps is only requested once
+        page = request.meta.get('sitemap_page')
+        if page in self.crawled:
+            self.page_crawled(page)
+
+    def page_crawled(self, page):
+        self.crawled.add(page)
+        for sitemap in self.page_sitemaps.pop(page, ()):
+            self.pending[sitemap] -= 1
+
+    def is_complete(self, sitemap, visiting=()):
+        """Whether every page and child sitemap listed by ``sitemap`` was downloaded"""
+        if sitemap in self.incomplete or self.pending[sitemap] > 0:
+            return False
+        visiting = {*visiting, sitemap}
+        return all(
+            child in visiting or (child in self.sitemap_lastmods and self.is_complete(child, visiting))
+            for child in self.children[sitemap]
+        )
+
+    def spider_closed(self, spider, reason):
+        # A sitemap is only unchanged for the next run once all of its pages
+        # have been crawled
+        if reason == 'finished':
+            for url, lastmod in self.sitemap_lastmods.items():
+                if self.is_complete(url):
+                    self.state.mark(url, lastmod)
+                else:
+                    self.stats.inc_value('sitemap/sitemaps_incomplete')
+        self.state.save()
@@ -1,8 +1,15 @@
 import scrapy
-import re
 from datetime import datetime
 from urllib.parse import urljoin, urlparse
-from coupon_scraper.items import CouponItem
+from coupon_scraper.cardcache import CardCache
+from coupon_scraper.items import NormalizedCouponItem
+from coupon_scraper.middlewares import render_request
+from coupon_scraper.normalize import clean_expiry, clean_text, squash_code
+from coupon_scraper.offers import offer_fields
+from coupon_scraper.pagination import planned_requests
+from coupon_scraper.revisit import RevisitScheduler
+from coupon_scraper.sitemaps import SitemapDiscovery
+from coupon_scraper.structured import extract_offers
 
 
 class CouponsComSpider(scrapy.Spider):
@@ -14,6 +21,9 @@ class CouponsComSpider(scrapy.Spider):
         'https://www.coupons.com/printable-coupons/',
         'https://www.coupons.com/deals/',
     ]
+    sitemap_urls = [
+        'https://www.coupons.com/robots.txt',
+    ]
     
     custom_settings = {
         'DOWNLOAD_DELAY': 3,
@@ -21,11 +31,48 @@ class CouponsComSpider(scrapy.Spider):
         'ROBOTSTXT_OBEY': True,
         'USER_AGENT': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
     }
+    
+    # Part of the card cache key: bump when extract_card_fields() changes
+    card_profile = 'coupons_com:4'
+    card_cache = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.card_cache = CardCache.from_crawler(crawler)
+        return spider
+
+    def start_requests(self):
+        """Start from the sitemaps or the revisit plan if enabled, else from start_urls"""
+        discovery = getattr(self, 'discovery', None)
+        if discovery == 'sitemap' or self.settings.getbool('SITEMAP_DISCOVERY_ENABLED'):
+            yield from SitemapDiscovery.from_crawler(self.crawler).start_requests(self)
+            return
+        
+        if discovery == 'revisit' or self.settings.getbool('REVISIT_ENABLED'):
+            yield from RevisitScheduler.from_crawler(self.crawler).start_requests(self)
+            return
+        
+        for url in self.start_urls:
+            yield scrapy.Request(url, dont_filter=True)
+    
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     def parse(self, response):
         """Parse coupons.com main pages"""
         self.logger.info(f'Parsing Coupons.com: {response.url}')
         
+        # Offers embedded as JSON (JSON-LD, __NEXT_DATA__) skip the selector cascade
+        items = self.parse_structured(response)
+        if items:
+            self.logger.info(f'Extracted {len(items)} coupons from embedded JSON on {response.url}')
+            yield from items
+            yield from self.follow_pagination(response)
+            return
+        self.crawler.stats.inc_value('structured/fallback_pages')
+        
         # Try multiple selectors that coupons.com might use
         coupon_selectors = [
             # Modern React-based selectors
@@ -84,12 +131,77 @@ class CouponsComSpider(scrapy.Spider):
         
         self.logger.info(f'Successfully extracted {coupon_count} valid coupons from {response.url}')
         
+        # Nothing extractable from the static HTML: the page is probably built by JavaScript
+        if coupon_count == 0 and self.settings.getbool('RENDER_ENABLED'):
+            request = render_request(response, self.parse)
+            if request:
+                self.logger.info(f'Rendering {response.url}')
+                yield request
+                return
+        
         # Look for pagination or more content
         yield from self.follow_pagination(response)
     
+    def parse_structured(self, response):
+        """Build valid items from the offers embedded as JSON in the page"""
+        items = []
+        for fields in extract_offers(response)[:30]:  # Same limit as the cards
+            item = self.structured_item(fields, response.url)
+            if item and self.is_valid_coupon(item):
+                items.append(item)
+        if items:
+            self.crawler.stats.inc_value('structured/pages')
+            self.crawler.stats.inc_value('structured/items', len(items))
+        return items
+    
+    def structured_item(self, fields, source_url):
+        """Map raw embedded offer fields to a CouponItem, cleaned like the card fields"""
+        title = clean_text(fields['title'])
+        if not title or len(title) < 5:
+            return None
+        
+        item = NormalizedCouponItem()
+        item['title'] = title
+        
+        code = squash_code(fields.get('code'))
+        if code and len(code) >= 3:
+            item['code'] = code
+        
+        if fields.get('description'):
+            item['description'] = clean_text(fields['description'])
+        
+        item['store'] = clean_text(fields.get('store')) or 'Coupons.com'
+        
+        if fields.get('expiry_date'):
+            item['expiry_date'] = clean_expiry(fields['expiry_date'])
+        
+        item.update(offer_fields(item['title'], item.get('description')))
+        
+        all_text = f"{item.get('title', '')} {item.get('description', '')}"
+        item['url'] = source_url
+        item['category'] = self.categorize_coupon(all_text)
+        
+        if fields.get('terms_conditions'):
+            item['terms_conditions'] = clean_text(fields['terms_conditions'])
+        
+        return item
+    
     def extract_coupon_info(self, coupon_element, source_url):
-        """Extract coupon information with comprehensive selectors"""
-        item = CouponItem()
+        """Build a coupon item from a card, reusing the fields cached for an identical card"""
+        if self.card_cache is not None:
+            fields = self.card_cache.extract(coupon_element, self.card_profile, self.extract_card_fields)
+        else:
+            fields = self.extract_card_fields(coupon_element)
+        if fields is None:
+            return None
+        
+        item = NormalizedCouponItem(fields)
+        item['url'] = source_url
+        return item
+    
+    def extract_card_fields(self, coupon_element):
+        """Extract coupon fields with comprehensive selectors"""
+        item = {}
         
         # Extract title (most important field)
         title = self.extract_text_from_selectors(coupon_element, [
@@ -108,10 +220,11 @@ class CouponsComSpider(scrapy.Spider):
             'b'
         ])
         
-        if not title or len(title.strip()) < 5:
+        title = clean_text(title)
+        if not title or len(title) < 5:
             return None
         
-        item['title'] = self.clean_text(title)
+        item['title'] = title
         
         # Extract coupon code
         code = self.extract_text_from_selectors(coupon_element, [
@@ -125,10 +238,9 @@ class CouponsComSpider(scrapy.Spider):
             '[class*="code"]'
         ], attr='data-clipboard-text')
         
-        if code:
-            clean_code = re.sub(r'[^\w\d]', '', code.upper())
-            if clean_code and len(clean_code) >= 3:
-                item['code'] = clean_code
+        code = squash_code(code)
+        if code and len(code) >= 3:
+            item['code'] = code
         
         # Extract description
         description = self.extract_text_from_selectors(coupon_element, [
@@ -144,7 +256,7 @@ class CouponsComSpider(scrapy.Spider):
         ])
         
         if description:
-            item['description'] = self.clean_text(description)
+            item['description'] = clean_text(description)
         
         # Extract store/brand
         store = self.extract_text_from_selectors(coupon_element, [
@@ -162,7 +274,7 @@ class CouponsComSpider(scrapy.Spider):
         ])
         
         if store:
-            item['store'] = self.clean_text(store)
+            item['store'] = clean_text(store)
         else:
             item['store'] = 'Coupons.com'
         
@@ -179,16 +291,13 @@ class CouponsComSpider(scrapy.Spider):
         ])
         
         if expiry:
-            item['expiry_date'] = self.parse_expiry_date(expiry)
+            item['expiry_date'] = clean_expiry(expiry)
         
-        # Extract discount percentage
+        # Discount, minimum spend, BOGO and free shipping terms
+        item.update(offer_fields(item.get('title'), item.get('description')))
         all_text = f"{item.get('title', '')} {item.get('description', '')}"
-        percentage = self.extract_percentage(all_text)
-        if percentage:
-            item['discount_percentage'] = percentage
         
         # Set other fields
-        item['url'] = source_url
         item['category'] = self.categorize_coupon(all_text)
         
         # Extract terms if available
@@ -202,7 +311,7 @@ class CouponsComSpider(scrapy.Spider):
         ])
         
         if terms:
-            item['terms_conditions'] = self.clean_text(terms)
+            item['terms_conditions'] = clean_text(terms)
         
         return item
     
@@ -221,67 +330,6 @@ class CouponsComSpider(scrapy.Spider):
                 continue
         return None
     
-    def clean_text(self, text):
-        """Clean and normalize text"""
-        if not text:
-            return None
-        
-        # Remove extra whitespace
-        text = ' '.join(text.split())
-        
-        # Remove common prefixes/suffixes
-        text = re.sub(r'^(deal|offer|coupon):\s*', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'\s*(deal|offer|coupon)$', '', text, flags=re.IGNORECASE)
-        
-        return text.strip()
-    
-    def parse_expiry_date(self, expiry_text):
-        """Parse and clean expiry date"""
-        if not expiry_text:
-            return None
-        
-        # Remove common prefixes
-        expiry_text = re.sub(r'^(expires?:?\s*|exp:?\s*|valid until:?\s*)', '', expiry_text, flags=re.IGNORECASE)
-        
-        # Look for date patterns
-        date_patterns = [
-            r'\d{1,2}/\d{1,2}/\d{4}',  # MM/DD/YYYY
-            r'\d{4}-\d{1,2}-\d{1,2}',  # YYYY-MM-DD
-            r'\d{1,2}-\d{1,2}-\d{4}',  # MM-DD-YYYY
-            r'\w+ \d{1,2}, \d{4}',     # Month DD, YYYY
-        ]
-        
-        for pattern in date_patterns:
-            match = re.search(pattern, expiry_text)
-            if match:
-                return match.group()
-        
-        return expiry_text.strip()
-    
-    def extract_percentage(self, text):
-        """Extract discount percentage from text"""
-        if not text:
-            return None
-        
-        # Look for percentage patterns
-        percentage_patterns = [
-            r'(\d+)%\s*off',
-            r'save\s*(\d+)%',
-            r'(\d+)%\s*discount',
-            r'(\d+)%\s*savings',
-            r'(\d+)%'
-        ]
-        
-        for pattern in percentage_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                try:
-                    return int(match.group(1))
-                except ValueError:
-                    continue
-        
-        return None
-    
     def categorize_coupon(self, text):
         """Categorize coupon based on text content"""
         text = text.lower()
@@ -322,7 +370,14 @@ class CouponsComSpider(scrapy.Spider):
         return True
     
     def follow_pagination(self, response):
-        """Follow pagination links"""
+        """Schedule all remaining listing pages at once, or follow the next page link"""
+        planned = planned_requests(response, self.parse, self.settings.getint('PAGINATION_MAX_PAGES', 50))
+        if planned is not None:
+            if planned:
+                self.logger.info(f'Scheduling {len(planned)} pagination pages from {response.url}')
+            yield from planned
+            return
+        
         pagination_selectors = [
             'a[aria-label="Next"]::attr(href)',
             '.pagination .next::attr(href)',
@@ -1,8 +1,15 @@
 import scrapy
-import re
 from datetime import datetime
 from urllib.parse import urljoin
-from coupon_scraper.items import CouponItem
+from coupon_scraper.cardcache import CardCache
+from coupon_scraper.items import CouponItem, NormalizedCouponItem
+from coupon_scraper.middlewares import render_request
+from coupon_scraper.normalize import clean_expiry, squash, squash_code
+from coupon_scraper.offers import offer_fields
+from coupon_scraper.pagination import planned_requests
+from coupon_scraper.revisit import RevisitScheduler
+from coupon_scraper.sitemaps import SitemapDiscovery
+from coupon_scraper.structured import extract_offers
 
 
 class CouponsSpider(scrapy.Spider):
@@ -13,6 +20,10 @@ class CouponsSpider(scrapy.Spider):
         'https://www.coupons.com/coupon-codes/',
         'https://www.coupons.com/printable-coupons/',
     ]
+    sitemap_urls = [
+        'https://www.coupons.com/robots.txt',
+        'https://www.retailmenot.com/robots.txt',
+    ]
     
     custom_settings = {
         'DOWNLOAD_DELAY': 3,
@@ -20,6 +31,34 @@ class CouponsSpider(scrapy.Spider):
         'ROBOTSTXT_OBEY': True,
     }
 
+    # Part of the card cache key: bump when extract_card_fields() changes
+    card_profile = 'coupons:4'
+    card_cache = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.card_cache = CardCache.from_crawler(crawler)
+        return spider
+
+    def start_requests(self):
+        """Start from the sitemaps or the revisit plan if enabled, else from start_urls"""
+        discovery = getattr(self, 'discovery', None)
+        if discovery == 'sitemap' or self.settings.getbool('SITEMAP_DISCOVERY_ENABLED'):
+            yield from SitemapDiscovery.from_crawler(self.crawler).start_requests(self)
+            return
+        
+        if discovery == 'revisit' or self.settings.getbool('REVISIT_ENABLED'):
+            yield from RevisitScheduler.from_crawler(self.crawler).start_requests(self)
+            return
+        
+        for url in self.start_urls:
+            yield scrapy.Request(url, dont_filter=True)
+    
+    async def start(self):
+        for request in self.start_requests():
+            yield request
+
     def parse(self, response):
         """Parse the main coupon listing pages"""
         self.logger.info(f'Parsing: {response.url}')
@@ -33,6 +72,15 @@ class CouponsSpider(scrapy.Spider):
         """Parse Coupons.com pages with updated selectors"""
         self.logger.info(f'Parsing Coupons.com: {response.url}')
         
+        # Offers embedded as JSON (JSON-LD, __NEXT_DATA__) skip the selector cascade
+        items = self.parse_structured(response, 'coupons.com')
+        if items:
+            self.logger.info(f'Extracted {len(items)} coupons from embedded JSON on {response.url}')
+            yield from items
+            yield from self.follow_pagination(response)
+            return
+        self.crawler.stats.inc_value('structured/fallback_pages')
+        
         # Modern coupons.com selectors based on actual site structure
         coupon_selectors = [
             '[data-testid="coupon-card"]',
@@ -57,16 +105,37 @@ class CouponsSpider(scrapy.Spider):
             coupons = response.css('[class*="card"], .item, [class*="tile"]')
             self.logger.info(f'Using fallback selector, found {len(coupons)} potential coupons')
         
+        coupon_count = 0
         for i, coupon in enumerate(coupons[:25]):  # Limit to 25 for testing
             try:
                 item = self.extract_coupon_data(coupon, response.url, 'coupons.com')
                 if item and item.get('title'):
+                    coupon_count += 1
                     yield item
                     
             except Exception as e:
                 self.logger.warning(f'Error parsing coupon {i}: {e}')
                 continue
         
+        # Nothing extractable from the static HTML: the page is probably built by JavaScript
+        if coupon_count == 0 and self.settings.getbool('RENDER_ENABLED'):
+            request = render_request(response, self.parse)
+            if request:
+                self.logger.info(f'Rendering {response.url}')
+                yield request
+                return
+        
+        yield from self.follow_pagination(response)
+    
+    def follow_pagination(self, response):
+        """Schedule all remaining listing pages at once, or follow the next page link"""
+        planned = planned_requests(response, self.parse, self.settings.getint('PAGINATION_MAX_PAGES', 50))
+        if planned is not None:
+            if planned:
+                self.logger.info(f'Scheduling {len(planned)} pagination pages from {response.url}')
+            yield from planned
+            return
+        
         # Look for pagination or "load more" links
         next_page_selectors = [
             'a[aria-label="Next"]::attr(href)',
@@ -99,7 +168,7 @@ class CouponsSpider(scrapy.Spider):
                 break
         
         for coupon in coupons[:20]:  # Limit to first 20 for demo
-            item = CouponItem()
+            item = NormalizedCouponItem()
             
             # Extract title
             title_selectors = [
@@ -113,7 +182,7 @@ class CouponsSpider(scrapy.Spider):
             if not title:
                 continue
                 
-            item['title'] = title.strip()
+            item['title'] = squash(title)
             
             # Extract coupon code
             code_selectors = [
@@ -122,9 +191,9 @@ class CouponsSpider(scrapy.Spider):
                 '[data-clipboard-text]::attr(data-clipboard-text)',
                 '.code::text'
             ]
-            code = self.extract_first_text(coupon, code_selectors)
-            if code:
-                item['code'] = code.strip()
+            code = squash_code(self.extract_first_text(coupon, code_selectors))
+            if code and len(code) >= 3:
+                item['code'] = code
             
             # Extract description
             desc_selectors = [
@@ -135,7 +204,7 @@ class CouponsSpider(scrapy.Spider):
             ]
             description = self.extract_first_text(coupon, desc_selectors)
             if description:
-                item['description'] = description.strip()
+                item['description'] = squash(description)
             
             # Extract store/brand
             store_selectors = [
@@ -145,7 +214,7 @@ class CouponsSpider(scrapy.Spider):
             ]
             store = self.extract_first_text(coupon, store_selectors)
             if store:
-                item['store'] = store.strip()
+                item['store'] = squash(store)
             
             # Extract expiry date
             expiry_selectors = [
@@ -157,14 +226,80 @@ class CouponsSpider(scrapy.Spider):
             if expiry:
                 item['expiry_date'] = expiry.strip()
             
+            item.update(offer_fields(item['title'], item.get('description')))
+            
             item['url'] = response.url
             item['category'] = 'general'
             
             yield item
     
+    def parse_structured(self, response, site_name):
+        """Build items from the offers embedded as JSON in the page"""
+        items = []
+        for fields in extract_offers(response)[:25]:  # Same limit as the cards
+            item = self.structured_item(fields, response.url, site_name)
+            if item:
+                items.append(item)
+        if items:
+            self.crawler.stats.inc_value('structured/pages')
+            self.crawler.stats.inc_value('structured/items', len(items))
+        return items
+    
+    def structured_item(self, fields, source_url, site_name):
+        """Map raw embedded offer fields to a CouponItem, cleaned like the card fields"""
+        title = squash(fields['title'])
+        if not title or len(title) < 3:
+            return None
+        
+        item = NormalizedCouponItem()
+        item['title'] = title
+        
+        code = squash_code(fields.get('code'))
+        if code and len(code) >= 3:
+            item['code'] = code
+        
+        description = squash(fields.get('description'))
+        if description:
+            item['description'] = description
+        
+        item['store'] = squash(fields.get('store')) or site_name
+        
+        if fields.get('expiry_date'):
+            item['expiry_date'] = clean_expiry(fields['expiry_date'])
+        
+        item.update(offer_fields(title, description))
+        
+        if fields.get('category'):
+            item['category'] = fields['category'].lower()
+        else:
+            item['category'] = self.guess_category(title, description or '')
+        
+        if fields.get('terms_conditions'):
+            item['terms_conditions'] = squash(fields['terms_conditions'])
+        
+        item['url'] = source_url
+        
+        return item
+    
     def extract_coupon_data(self, coupon_element, source_url, site_name):
-        """Enhanced method to extract coupon data from various selectors"""
-        item = CouponItem()
+        """Build a coupon item from a card, reusing the fields cached for an identical card"""
+        def extract(card):
+            return self.extract_card_fields(card, site_name)
+        
+        if self.card_cache is not None:
+            fields = self.card_cache.extract(coupon_element, f'{self.card_profile}:{site_name}', extract)
+        else:
+            fields = extract(coupon_element)
+        if fields is None:
+            return None
+        
+        item = NormalizedCouponItem(fields)
+        item['url'] = source_url
+        return item
+    
+    def extract_card_fields(self, coupon_element, site_name):
+        """Enhanced method to extract coupon fields from various selectors"""
+        item = {}
         
         # Extract title with multiple fallback selectors
         title_selectors = [
@@ -179,11 +314,11 @@ class CouponsSpider(scrapy.Spider):
             'b::text'
         ]
         
-        title = self.extract_first_text(coupon_element, title_selectors)
-        if not title or len(title.strip()) < 3:
+        title = squash(self.extract_first_text(coupon_element, title_selectors))
+        if not title or len(title) < 3:
             return None
         
-        item['title'] = title.strip()
+        item['title'] = title
         
         # Extract coupon code
         code_selectors = [
@@ -197,11 +332,9 @@ class CouponsSpider(scrapy.Spider):
         ]
         
         code = self.extract_first_text(coupon_element, code_selectors)
-        if code:
-            # Clean up the code
-            clean_code = re.sub(r'[^\w\d]', '', code.strip().upper())
-            if clean_code and len(clean_code) >= 3:
-                item['code'] = clean_code
+        code = squash_code(code)
+        if code and len(code) >= 3:
+            item['code'] = code
         
         # Extract description
         description_selectors = [
@@ -214,9 +347,9 @@ class CouponsSpider(scrapy.Spider):
             '[class*="description"]::text'
         ]
         
-        description = self.extract_first_text(coupon_element, description_selectors)
+        description = squash(self.extract_first_text(coupon_element, description_selectors))
         if description:
-            item['description'] = description.strip()
+            item['description'] = description
         
         # Extract store/brand
         store_selectors = [
@@ -231,7 +364,7 @@ class CouponsSpider(scrapy.Spider):
         
         store = self.extract_first_text(coupon_element, store_selectors)
         if store:
-            item['store'] = store.strip()
+            item['store'] = squash(store)
         else:
             item['store'] = site_name
         
@@ -247,13 +380,10 @@ class CouponsSpider(scrapy.Spider):
         
         expiry = self.extract_first_text(coupon_element, expiry_selectors)
         if expiry:
-            item['expiry_date'] = self.clean_expiry_date(expiry.strip())
+            item['expiry_date'] = clean_expiry(expiry)
         
-        # Extract discount percentage
-        discount_text = f"{title} {description or ''}"
-        percentage = self.extract_discount_percentage(discount_text)
-        if percentage:
-            item['discount_percentage'] = percentage
+        # Discount, minimum spend, BOGO and free shipping terms
+        item.update(offer_fields(title, description))
         
         # Extract category
         category_selectors = [
@@ -278,34 +408,10 @@ class CouponsSpider(scrapy.Spider):
         
         terms = self.extract_first_text(coupon_element, terms_selectors)
         if terms:
-            item['terms_conditions'] = terms.strip()
-        
-        item['url'] = source_url
+            item['terms_conditions'] = squash(terms)
         
         return item
     
-    def clean_expiry_date(self, expiry_text):
-        """Clean and standardize expiry date format"""
-        if not expiry_text:
-            return None
-        
-        # Remove common prefixes
-        expiry_text = re.sub(r'^(expires?:?\s*|exp:?\s*|until:?\s*)', '', expiry_text, flags=re.IGNORECASE)
-        
-        # Look for date patterns
-        date_patterns = [
-            r'\d{1,2}/\d{1,2}/\d{4}',  # MM/DD/YYYY
-            r'\d{4}-\d{1,2}-\d{1,2}',  # YYYY-MM-DD
-            r'\d{1,2}-\d{1,2}-\d{4}',  # MM-DD-YYYY
-        ]
-        
-        for pattern in date_patterns:
-            match = re.search(pattern, expiry_text)
-            if match:
-                return match.group()
-        
-        return expiry_text.strip()
-    
     def guess_category(self, title, description):
         """Guess category based on title and description"""
         text = f"{title} {description}".lower()
@@ -336,16 +442,6 @@ class CouponsSpider(scrapy.Spider):
             except:
                 continue
         return None
-    
-    def extract_discount_percentage(self, text):
-        """Extract discount percentage from text"""
-        if not text:
-            return None
-        
-        match = re.search(r'(\d+)%', text)
-        if match:
-            return int(match.group(1))
-        return None
 
 
 # Alternative spider for demo data
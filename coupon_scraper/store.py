@@ -0,0 +1,191 @@
+import bisect
+import json
+import os
+from datetime import date
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
+
+from coupon_scraper.normalize import parse_expiry_date
+from coupon_scraper.pipelines import DuplicatesPipeline
+
+
+class CouponStore:
+    """Coupons indexed by their normalized expiry date
+
+    Coupons are kept in one bucket per expiry day, with the bucket days in
+    a sorted list. Adding, replacing or removing a coupon is O(1), plus a
+    sorted insert into the (short) day list when it creates a new day;
+    evicting everything expired pops whole buckets off the front,
+    and "active as of T" only visits the buckets from T on. Coupons without
+    a parsable expiry date never expire.
+
+    The expiry date is parsed once, when a coupon is added, and saved with
+    it, so reloading the store doesn't parse the free-form strings again.
+    """
+
+    def __init__(self, path=None, archive_path=None):
+        self.path = path
+        self.archive_path = archive_path
+        self.coupons = {}       # id -> (expiry date or None, item dict)
+        self.buckets = {}       # expiry date -> set of ids
+        self.days = []          # sorted bucket dates
+        self.open_ended = set()
+        self.evicted = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.coupons)
+
+    def __contains__(self, coupon_id):
+        return coupon_id in self.coupons
+
+    def add(self, coupon_id, item, expires=None):
+        """Add or replace a coupon expiring at the end of ``expires``"""
+        self.discard(coupon_id)
+        self.coupons[coupon_id] = (expires, item)
+        if expires is None:
+            self.open_ended.add(coupon_id)
+            return
+        bucket = self.buckets.get(expires)
+        if bucket is None:
+            bucket = self.buckets[expires] = set()
+            bisect.insort(self.days, expires)
+        bucket.add(coupon_id)
+
+    def discard(self, coupon_id):
+        entry = self.coupons.pop(coupon_id, None)
+        if entry is None:
+            return None
+        expires, item = entry
+        if expires is None:
+            self.open_ended.discard(coupon_id)
+        else:
+            bucket = self.buckets[expires]
+            bucket.discard(coupon_id)
+            if not bucket:
+                del self.buckets[expires]
+                del self.days[bisect.bisect_left(self.days, expires)]
+        return item
+
+    def evict(self, as_of):
+        """Remove the coupons that expired before ``as_of`` and return them
+
+        Evicted coupons are appended to the archive file when one is set.
+        """
+        expired = []
+        cut = bisect.bisect_left(self.days, as_of)
+        for day in self.days[:cut]:
+            for coupon_id in self.buckets.pop(day):
+                expired.append(self.coupons.pop(coupon_id)[1])
+        del self.days[:cut]
+        if expired and self.archive_path:
+            with open(self.archive_path, 'a') as f:
+                for item in expired:
+                    f.write(json.dumps(item) + '\n')
+        self.evicted += len(expired)
+        return expired
+
+    def active(self, as_of):
+        """Coupons still valid on ``as_of``, soonest to expire first"""
+        for day in self.days[bisect.bisect_left(self.days, as_of):]:
+            for coupon_id in self.buckets[day]:
+                yield self.coupons[coupon_id][1]
+        for coupon_id in self.open_ended:
+            yield self.coupons[coupon_id][1]
+
+    def count_active(self, as_of):
+        start = bisect.bisect_left(self.days, as_of)
+        return sum(len(self.buckets[day]) for day in self.days[start:]) + len(self.open_ended)
+
+    def expiring_between(self, start, end):
+        """Coupons expiring on a day in [start, end)"""
+        for day in self.days[bisect.bisect_left(self.days, start):bisect.bisect_left(self.days, end)]:
+            for coupon_id in self.buckets[day]:
+                yield self.coupons[coupon_id][1]
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                expires = date.fromisoformat(record['expires']) if record['expires'] else None
+                self.add(record['id'], record['item'], expires)
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for coupon_id, (expires, item) in self.coupons.items():
+                record = {'id': coupon_id, 'expires': expires.isoformat() if expires else None, 'item': item}
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+class CouponStorePipeline:
+    """Keep scraped coupons in a CouponStore indexed by expiry date
+
+    Runs after CouponValidationPipeline and before DuplicatesPipeline.
+    Coupons are stored under DuplicatesPipeline's id, so a coupon seen again
+    replaces the stored one. Coupons that expired before today are evicted
+    (and archived to ``COUPON_STORE_ARCHIVE``) when the store is opened and
+    whenever the date changes; with ``COUPON_STORE_DROP_EXPIRED`` items that
+    are already expired when scraped are dropped here, before deduplication
+    and storage.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.drop_expired = settings.getbool('COUPON_STORE_DROP_EXPIRED')
+        self.store = CouponStore(settings.get('COUPON_STORE_FILE'), settings.get('COUPON_STORE_ARCHIVE'))
+        self.today = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get('COUPON_STORE_FILE') and not settings.getbool('COUPON_STORE_DROP_EXPIRED'):
+            raise NotConfigured
+        pipeline = cls(crawler)
+        crawler.signals.connect(pipeline.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def evict_expired(self):
+        today = date.today()
+        if today == self.today:
+            return
+        self.today = today
+        expired = self.store.evict(today)
+        if expired:
+            self.stats.inc_value('coupon_store/evicted', len(expired))
+
+    def spider_opened(self, spider):
+        self.evict_expired()
+
+    def process_item(self, item, spider):
+        self.evict_expired()
+        adapter = ItemAdapter(item)
+        expires = parse_expiry_date(adapter.get('expiry_date'))
+        if expires is None:
+            self.stats.inc_value('coupon_store/no_expiry')
+        elif expires < self.today:
+            if self.drop_expired:
+                self.stats.inc_value('coupon_store/dropped_expired')
+                raise DropItem(f"Coupon expired on {expires}: {adapter.get('title')}")
+            # Passed on, but not worth storing only to evict it
+            return item
+        if self.store.path:
+            self.store.add(DuplicatesPipeline.item_id(item), adapter.asdict(), expires)
+            self.stats.inc_value('coupon_store/stored')
+        return item
+
+    def spider_closed(self, spider):
+        self.evict_expired()
+        self.store.save()
+        self.stats.set_value('coupon_store/active', len(self.store))
@@ -0,0 +1,127 @@
+import json
+import re
+
+from w3lib.html import remove_tags, replace_entities
+
+
+# Markers checked on the raw body before any parsing, so pages without
+# embedded data cost one substring scan
+PAYLOAD_MARKERS = [b'application/ld+json', b'__NEXT_DATA__', b'_STATE__']
+
+PAYLOAD_XPATH = (
+    '//script[@type="application/ld+json" or @id="__NEXT_DATA__" '
+    'or contains(., "_STATE__")]'
+)
+# window.__INITIAL_STATE__ = {...}; / window.__APOLLO_STATE__ = {...}
+STATE_ASSIGNMENT = re.compile(r'window\.__[A-Z_]+_STATE__\s*=\s*')
+
+TITLE_KEYS = ['title', 'headline', 'offerTitle', 'name']
+CODE_KEYS = ['code', 'couponCode', 'promoCode', 'discountCode', 'offerCode']
+DESCRIPTION_KEYS = ['description', 'offerDescription', 'details', 'summary']
+EXPIRY_KEYS = ['validThrough', 'expirationDate', 'expiryDate', 'expiresAt', 'expires', 'endDate', 'expiration']
+STORE_KEYS = ['store', 'storeName', 'merchant', 'merchantName', 'retailer', 'brand', 'seller', 'offeredBy']
+CATEGORY_KEYS = ['category', 'categoryName']
+TERMS_KEYS = ['terms', 'termsAndConditions', 'restrictions', 'exclusions', 'finePrint']
+
+
+def iter_payloads(response):
+    """Decoded JSON payloads embedded in ``response`` (JSON-LD, __NEXT_DATA__, window state)"""
+    if not any(marker in response.body for marker in PAYLOAD_MARKERS):
+        return
+    decoder = json.JSONDecoder()
+    for script in response.xpath(PAYLOAD_XPATH):
+        text = script.xpath('string()').get() or ''
+        if script.attrib.get('type') == 'application/ld+json' or script.attrib.get('id') == '__NEXT_DATA__':
+            try:
+                yield json.loads(text)
+            except ValueError:
+                continue
+            continue
+        for match in STATE_ASSIGNMENT.finditer(text):
+            try:
+                yield decoder.raw_decode(text, match.end())[0]
+            except ValueError:
+                continue
+
+
+def is_offer(node):
+    """Whether a JSON object describes a single coupon or offer"""
+    types = node.get('@type')
+    if isinstance(types, str):
+        types = [types]
+    if isinstance(types, list) and 'Offer' in types:
+        return True
+    if not first_value(node, TITLE_KEYS):
+        return False
+    return any(key in node for key in CODE_KEYS + EXPIRY_KEYS)
+
+
+def iter_offers(data):
+    """Offer objects anywhere in a decoded payload (offers are not descended into)"""
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if is_offer(node):
+                yield node
+                continue
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+
+
+def first_value(node, keys):
+    """First non-empty string found under ``keys`` (following nested names and lists)
+
+    Hydration state often carries rich text, so markup and entities are
+    stripped.
+    """
+    for key in keys:
+        value = node.get(key)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if isinstance(value, dict):
+            value = value.get('name') or value.get('title')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        if isinstance(value, str):
+            if '<' in value or '&' in value:
+                value = replace_entities(remove_tags(value))
+            value = ' '.join(value.split())
+            if value:
+                return value
+    return None
+
+
+def offer_fields(offer):
+    """Map an offer object to raw CouponItem field values"""
+    fields = {
+        'title': first_value(offer, TITLE_KEYS) or first_value(offer, DESCRIPTION_KEYS),
+        'code': first_value(offer, CODE_KEYS),
+        'description': first_value(offer, DESCRIPTION_KEYS),
+        'expiry_date': first_value(offer, EXPIRY_KEYS),
+        'store': first_value(offer, STORE_KEYS),
+        'category': first_value(offer, CATEGORY_KEYS),
+        'terms_conditions': first_value(offer, TERMS_KEYS),
+    }
+    return {name: value for name, value in fields.items() if value}
+
+
+def extract_offers(response):
+    """Raw field dicts of the offers embedded in ``response``, without duplicates
+
+    The same offers are often present both as JSON-LD and in the
+    hydration state, so they are deduplicated by title and code.
+    """
+    offers = []
+    seen = set()
+    for payload in iter_payloads(response):
+        for offer in iter_offers(payload):
+            fields = offer_fields(offer)
+            if not fields.get('title'):
+                continue
+            key = (fields['title'], fields.get('code'))
+            if key not in seen:
+                seen.add(key)
+                offers.append(fields)
+    return offers
@@ -0,0 +1,269 @@
+"""
+Long-lived crawl worker.
+
+Keeps a running reactor, the project settings and the imported spider
+classes and components, and runs crawl jobs sent over a local UNIX socket
+so small targeted crawls don't pay the interpreter, Scrapy and Twisted
+start-up cost every time.
+
+Start it from the project directory::
+
+    python -m coupon_scraper.worker --socket .scrapy/worker.sock
+
+A client sends one JSON line per connection::
+
+    {"spider": "coupons_com", "start_urls": ["https://www.coupons.com/deals/"],
+     "settings": {"CLOSESPIDER_PAGECOUNT": 5}, "args": {}}
+
+and reads JSON lines back: ``started`` (with the job's directory), one
+``item`` per scraped item as it is scraped, then ``finished`` (with the
+crawl stats and the first request's latency from the worker's start and
+from the job's receipt) or ``error``. Closing the connection stops the
+job's crawl.
+
+Feeds and state files that the job doesn't set itself are written to its
+own directory under WORKER_JOBS_DIR, so concurrent jobs don't overwrite
+each other's output.
+"""
+
+import argparse
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+# Taken before Scrapy and Twisted are imported
+PROCESS_STARTED = time.perf_counter()
+
+from scrapy import signals
+from scrapy.crawler import Crawler, CrawlerRunner
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.log import configure_logging
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.reactor import install_reactor
+from scrapy.utils.serialize import ScrapyJSONEncoder
+from twisted.internet import defer, protocol
+from twisted.protocols.basic import LineReceiver
+
+
+DEFAULT_SOCKET = '.scrapy/worker.sock'
+
+# Component settings whose classes are imported when the worker starts
+COMPONENT_SETTINGS = ['DOWNLOADER_MIDDLEWARES', 'SPIDER_MIDDLEWARES', 'ITEM_PIPELINES', 'EXTENSIONS']
+
+# Per-run files and directories moved to the job's directory unless the job sets them
+JOB_PATH_SETTINGS = [
+    'JOBDIR', 'SITEMAP_STATE_FILE', 'REVISIT_STATE_FILE', 'CHECKPOINT_DIR', 'CHECKPOINT_FEED',
+    'COUPON_STORE_FILE', 'COUPON_STORE_ARCHIVE', 'SEGMENTED_FEED_DIR', 'SINK_SPILL_DIR',
+    'CARD_CACHE_FILE', 'MEMDIAG_FILE', 'PROFILER_DIR',
+]
+
+encoder = ScrapyJSONEncoder()
+
+
+def encode(message):
+    return encoder.encode(message).encode('utf8') + b'\n'
+
+
+class CrawlJob:
+    """One crawl requested by a client, streaming its items back over the connection"""
+
+    def __init__(self, job_id, spec, connection, directory):
+        self.job_id = job_id
+        self.spec = spec
+        self.connection = connection
+        self.directory = directory
+        self.crawler = None
+        self.received = time.perf_counter()
+        self.first_request_latency = None
+        self.job_first_request_latency = None
+        self.items = 0
+
+    def attach(self, crawler):
+        self.crawler = crawler
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+
+    def request_reached_downloader(self, request, spider):
+        if self.first_request_latency is None:
+            now = time.perf_counter()
+            self.first_request_latency = now - PROCESS_STARTED
+            self.job_first_request_latency = now - self.received
+            stats = self.crawler.stats
+            stats.set_value('worker/first_request_latency', round(self.first_request_latency, 4))
+            stats.set_value('worker/job_first_request_latency', round(self.job_first_request_latency, 4))
+
+    def item_scraped(self, item, spider):
+        self.items += 1
+        self.connection.send({'type': 'item', 'job': self.job_id, 'item': item})
+
+    def finished(self, _):
+        self.connection.send({
+            'type': 'finished',
+            'job': self.job_id,
+            'items': self.items,
+            'first_request_latency': self.first_request_latency,
+            'job_first_request_latency': self.job_first_request_latency,
+            'elapsed': time.perf_counter() - self.received,
+            'stats': self.crawler.stats.get_stats(),
+        })
+
+
+class WorkerConnection(LineReceiver):
+    """A client connection carrying one crawl job"""
+
+    delimiter = b'\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.job = None
+        self.closed = False
+
+    def lineReceived(self, line):
+        if self.job is not None:
+            return
+        try:
+            spec = json.loads(line)
+        except ValueError as e:
+            self.send({'type': 'error', 'error': f'Invalid job: {e}'})
+            self.transport.loseConnection()
+            return
+        self.job = self.worker.submit(self, spec)
+
+    def send(self, message):
+        if not self.closed:
+            self.transport.write(encode(message))
+
+    def connectionLost(self, reason):
+        self.closed = True
+        # Nobody is reading the results any more
+        if self.job is not None and self.job.crawler is not None and self.job.crawler.crawling:
+            self.job.crawler.stop()
+
+
+class WorkerFactory(protocol.Factory):
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def buildProtocol(self, addr):
+        return WorkerConnection(self.worker)
+
+
+class CrawlWorker:
+    """Run crawl jobs concurrently in one warm process
+
+    At most ``max_jobs`` crawls run at the same time; further jobs wait.
+    Each job gets its own Crawler with the project settings plus the job's
+    overrides, so jobs don't share stats, feeds or state.
+    """
+
+    def __init__(self, settings, max_jobs=4, jobs_dir=None):
+        self.settings = settings
+        run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.jobs_dir = os.path.join(jobs_dir or settings.get('WORKER_JOBS_DIR'), run_id)
+        self.runner = CrawlerRunner(settings)
+        self.semaphore = defer.DeferredSemaphore(max_jobs)
+        self.job_count = 0
+        self.spiders = {name: self.runner.spider_loader.load(name) for name in self.runner.spider_loader.list()}
+        self.preload_components()
+
+    def preload_components(self):
+        """Import the configured components now instead of during the first crawl"""
+        for name in COMPONENT_SETTINGS:
+            for path in build_component_list(self.settings.getwithbase(name)):
+                try:
+                    load_object(path)
+                except Exception:
+                    # Reported by the crawl that actually needs it
+                    continue
+
+    @staticmethod
+    def job_path(job, path):
+        """``path`` moved to the job's directory; remote feed URIs are kept"""
+        parsed = urlparse(path)
+        if parsed.scheme == 'file':
+            path = parsed.path
+        elif len(parsed.scheme) > 1:
+            return path
+        return os.path.join(job.directory, os.path.basename(os.path.normpath(path)))
+
+    def job_settings(self, job):
+        overrides = job.spec.get('settings') or {}
+        settings = self.settings.copy()
+        # Above 'project', which CrawlerRunner.crawl() merges into the crawler
+        # again; spider custom_settings still win
+        for name in JOB_PATH_SETTINGS:
+            if settings.get(name) and name not in overrides:
+                settings.set(name, self.job_path(job, settings[name]), priority='spider')
+        if 'FEEDS' not in overrides:
+            feeds = {self.job_path(job, str(uri)): options for uri, options in settings.getdict('FEEDS').items()}
+            settings.set('FEEDS', feeds, priority='spider')
+        settings.setdict(overrides, priority='cmdline')
+        return settings
+
+    def submit(self, connection, spec):
+        self.job_count += 1
+        directory = os.path.join(self.jobs_dir, f'job-{self.job_count}')
+        job = CrawlJob(self.job_count, spec, connection, directory)
+        d = self.semaphore.run(self.run_job, job)
+        d.addErrback(lambda failure: connection.send({
+            'type': 'error', 'job': job.job_id, 'error': failure.getErrorMessage(),
+        }))
+        d.addBoth(lambda _: connection.transport.loseConnection())
+        return job
+
+    def run_job(self, job):
+        spidercls = self.spiders.get(job.spec.get('spider'))
+        if spidercls is None:
+            raise ValueError(f"Unknown spider: {job.spec.get('spider')}")
+        if job.connection.closed:
+            return None
+
+        os.makedirs(job.directory, exist_ok=True)
+        crawler = Crawler(spidercls, self.job_settings(job))
+        job.attach(crawler)
+        kwargs = dict(job.spec.get('args') or {})
+        if job.spec.get('start_urls'):
+            kwargs['start_urls'] = job.spec['start_urls']
+
+        job.connection.send({
+            'type': 'started', 'job': job.job_id, 'spider': spidercls.name, 'directory': job.directory,
+        })
+        d = self.runner.crawl(crawler, **kwargs)
+        d.addCallback(job.finished)
+        return d
+
+
+def serve(socket_path=DEFAULT_SOCKET, max_jobs=4, jobs_dir=None):
+    settings = get_project_settings()
+    install_reactor(settings['TWISTED_REACTOR'])
+    configure_logging(settings)
+    from twisted.internet import endpoints, reactor
+
+    worker = CrawlWorker(settings, max_jobs, jobs_dir)
+
+    directory = os.path.dirname(socket_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    endpoints.UNIXServerEndpoint(reactor, socket_path).listen(WorkerFactory(worker))
+    print(f'Crawl worker ready on {socket_path} in {time.perf_counter() - PROCESS_STARTED:.2f}s '
+          f'({len(worker.spiders)} spiders, {max_jobs} concurrent jobs)', flush=True)
+    reactor.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run crawl jobs in a warm, long-lived process')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='UNIX socket to listen on')
+    parser.add_argument('--max-jobs', type=int, default=4, help='Crawls run at the same time')
+    parser.add_argument('--jobs-dir', help='Directory of the jobs\' feeds and state (default: WORKER_JOBS_DIR)')
+    args = parser.parse_args()
+    serve(args.socket, args.max_jobs, args.jobs_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Benchmark Regression Gate
+Run a fixed offline workload - the spiders' parse methods on stored pages,
+the item pipelines on a synthetic item stream and the offer parser on a
+synthetic title corpus - and compare it against the baseline in
+benchmarks/baseline.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from coupon_scraper.mocksite import PRODUCTS, MockSiteConfig, card_data, render_page
+
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+PAGES_DIR = os.path.join(BENCHMARK_DIR, 'pages')
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+SITE_BASE_URL = 'http://www.coupons.com'
+
+# Stored pages: name -> (spider, mock site options, listing path, page)
+PAGES = {
+    'coupons_com_numbered': ('coupons_com', {'cards_per_page': 25, 'pagination': 'numbered', 'depth': 20}, '/deals/', 3),
+    'coupons_com_next': ('coupons_com', {'cards_per_page': 20}, '/coupon-codes/', 1),
+    'coupons_com_structured': ('coupons_com', {'cards_per_page': 25, 'structured': True}, '/printable-coupons/', 2),
+    'coupons_numbered': ('coupons', {'cards_per_page': 25, 'pagination': 'numbered', 'depth': 20}, '/deals/', 3),
+    'coupons_structured': ('coupons', {'cards_per_page': 25, 'structured': True}, '/coupon-codes/', 1),
+}
+
+# Allowed relative change before a metric counts as a regression
+DEFAULT_TOLERANCES = {
+    'items_per_sec': 0.15,
+    'p95_ms': 0.50,
+    'peak_mb': 0.20,
+}
+# Metrics where a higher value is better
+HIGHER_IS_BETTER = {'items_per_sec'}
+METRIC_LABELS = {
+    'items_per_sec': 'items/s',
+    'p95_ms': 'p95 ms/page',
+    'peak_mb': 'peak MB',
+}
+
+
+def record_pages():
+    """Write the stored pages from the mock site generator (only when the workload changes)"""
+    os.makedirs(PAGES_DIR, exist_ok=True)
+    for name, (spider, options, path, page) in PAGES.items():
+        html = render_page(MockSiteConfig(**options), path, page)
+        with open(os.path.join(PAGES_DIR, f'{name}.html'), 'w') as f:
+            f.write(html)
+        print(f"Recorded {name}.html for {spider}")
+
+
+def load_pages():
+    """Stored pages per spider: {spider: [(url, body)]}"""
+    pages = {}
+    for name, (spider, options, path, page) in PAGES.items():
+        with open(os.path.join(PAGES_DIR, f'{name}.html'), 'rb') as f:
+            body = f.read()
+        url = f'{SITE_BASE_URL}{path}?page={page}' if page > 1 else f'{SITE_BASE_URL}{path}'
+        pages.setdefault(spider, []).append((url, body))
+    return pages
+
+
+def make_crawler(spidercls=None):
+    """Unstarted crawler with the project settings (but Scrapy's test defaults for the reactor)"""
+    from scrapy.settings import SETTINGS_PRIORITIES
+    from scrapy.utils.project import get_project_settings
+    from scrapy.utils.test import get_crawler
+
+    settings = get_project_settings()
+    project = {name: settings[name] for name in settings
+               if settings.getpriority(name) == SETTINGS_PRIORITIES['project']}
+    return get_crawler(spidercls, project)
+
+
+def parse_workload(spider_name, pages, iterations):
+    """Return a function running ``iterations`` parses of every page: (items, per-page seconds)"""
+    from itemadapter import is_item
+    from scrapy.http import HtmlResponse, Request
+    from scrapy.spiderloader import SpiderLoader
+    from scrapy.utils.project import get_project_settings
+
+    spidercls = SpiderLoader.from_settings(get_project_settings()).load(spider_name)
+
+    def run():
+        spider = spidercls.from_crawler(make_crawler(spidercls))
+        items = 0
+        timings = []
+        for _ in range(iterations):
+            for url, body in pages:
+                # A fresh response per parse, so no selector state is reused
+                response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+                started = time.process_time()
+                items += sum(1 for output in spider.parse(response) if is_item(output))
+                timings.append(time.process_time() - started)
+        return items, timings
+
+    return run
+
+
+def synthetic_items(count, duplicate_rate=0.1, seed=42):
+    """Deterministic stream of raw CouponItems with some duplicates
+
+    The fields are as scraped, before any normalization, so the pipelines
+    do all of their cleaning and validation work on them.
+    """
+    from coupon_scraper.items import CouponItem
+
+    rng = random.Random(seed)
+    fields = []
+    for index in range(count):
+        if fields and rng.random() < duplicate_rate:
+            fields.append(rng.choice(fields))
+            continue
+        card = card_data(rng, index)
+        fields.append({
+            'title': f"  Deal: {card['title']}\n  ",
+            'code': f" {card['code'].lower()} ",
+            'description': f"  {card['description']}\n",
+            'expiry_date': f"Expires {card['expires']}",
+            'store': f"{card['store']} ",
+            'url': f'{SITE_BASE_URL}/deals/',
+        })
+    return [CouponItem(**item) for item in fields]
+
+
+def pipeline_workload(count):
+    """Return a function pushing ``count`` synthetic items through the enabled ITEM_PIPELINES
+
+    CleanDataPipeline is added when it isn't enabled: it is what cleans the
+    items of spiders that don't normalize their fields.
+    """
+    from inspect import iscoroutinefunction
+    from scrapy.exceptions import DropItem, NotConfigured
+    from scrapy.utils.conf import build_component_list
+    from scrapy.utils.misc import build_from_crawler, load_object
+
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+
+    def run():
+        crawler = make_crawler(CouponsComSpider)
+        spider = CouponsComSpider.from_crawler(crawler)
+        pipelines = []
+        components = crawler.settings.getwithbase('ITEM_PIPELINES').copy_to_dict()
+        components.setdefault('coupon_scraper.pipelines.CleanDataPipeline', 450)
+        for path in build_component_list(components):
+            try:
+                pipeline = build_from_crawler(load_object(path), crawler)
+            except NotConfigured:
+                continue
+            if not iscoroutinefunction(pipeline.process_item):
+                pipelines.append(pipeline)
+
+        items = synthetic_items(count)
+        started = time.process_time()
+        for item in items:
+            try:
+                for pipeline in pipelines:
+                    item = pipeline.process_item(item, spider)
+            except DropItem:
+                continue
+        # Throughput counts every item offered to the pipelines, dropped ones included
+        return len(items), [time.process_time() - started]
+
+    return run
+
+
+# Offer phrasings of the title corpus, on top of the mock site's
+OFFER_TEMPLATES = [
+    'Extra {n}% Off {product} Orders of ${m} or More',
+    'Spend ${m}, Get ${d} Off {product}',
+    '{n}% Off {product} + Free Shipping',
+    'Buy 2, Get 1 {n}% Off {product}',
+    'BOGO {product}',
+    'Free Shipping on {product} Orders Over ${m}',
+    'Up to {n}% Off {product}, Save {n}% Today',
+    '{product} From ${d}',
+]
+
+
+def offer_corpus(count, seed=42):
+    """Deterministic (title, description) pairs, repeating like real listings"""
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        card = card_data(rng, index)
+        if rng.random() < 0.5:
+            title = rng.choice(OFFER_TEMPLATES).format(
+                n=rng.choice([5, 10, 15, 20, 25, 30, 40, 50]), m=rng.choice([25, 35, 50, 75, 100]),
+                d=rng.choice([5, 10, 15, 20]), product=rng.choice(PRODUCTS))
+            card['description'] = f'Get {title.lower()} at {card["store"]}. Limited time offer.'
+        else:
+            title = card['title']
+        corpus.append((title, card['description']))
+    return corpus
+
+
+def offers_workload(count):
+    """Return a function parsing the offer terms of ``count`` corpus titles, from a cold cache"""
+    from coupon_scraper.offers import offer_fields, scan_offer
+
+    corpus = offer_corpus(count)
+
+    def run():
+        scan_offer.cache_clear()
+        started = time.process_time()
+        for title, description in corpus:
+            offer_fields(title, description)
+        return len(corpus), [time.process_time() - started]
+
+    return run
+
+
+def memdiag_overhead(pages, iterations, rounds, interval):
+    """CPU ms per response of the coupons_com parses without and with MemoryDiagnostics
+
+    With the extension on, tracemalloc traces the MEMDIAG_WINDOW responses
+    before each snapshot, taken every ``interval`` responses as in a crawl.
+    Returns the medians of ``rounds`` runs of each, and the time of one
+    snapshot report.
+    """
+    import tracemalloc
+    from scrapy.http import HtmlResponse, Request
+    from coupon_scraper.extensions import MemoryDiagnostics
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+
+    def run(enabled):
+        crawler = make_crawler(CouponsComSpider)
+        crawler.settings.frozen = False
+        crawler.settings.setdict({'MEMDIAG_ENABLED': enabled, 'MEMDIAG_INTERVAL': interval, 'MEMDIAG_FILE': None})
+        spider = CouponsComSpider.from_crawler(crawler)
+        extension = MemoryDiagnostics.from_crawler(crawler) if enabled else None
+        started = time.process_time()
+        if extension:
+            extension.spider_opened(spider)
+        for _ in range(iterations):
+            for url, body in pages:
+                response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+                for _ in spider.parse(response):
+                    pass
+                if extension:
+                    extension.response_received(response, response.request, spider)
+        if extension:
+            extension.spider_closed(spider)
+        elapsed = (time.process_time() - started) * 1000 / (iterations * len(pages))
+        report_ms = 0.0
+        if extension:
+            report_ms = crawler.stats.get_value('memdiag/report_time') * 1000 / crawler.stats.get_value('memdiag/snapshots')
+        return elapsed, report_ms
+
+    run(False)  # warm-up
+    off = statistics.median(run(False)[0] for _ in range(rounds))
+    on_runs = [run(True) for _ in range(rounds)]
+    assert not tracemalloc.is_tracing()
+    return {
+        'off_ms': round(off, 3),
+        'on_ms': round(statistics.median(r[0] for r in on_runs), 3),
+        'report_ms': round(statistics.median(r[1] for r in on_runs), 2),
+    }
+
+
+def measure(workload, rounds, per_page, calibration):
+    """Median throughput and p95 per page of ``rounds`` runs, then peak memory of one more run
+
+    Times are CPU times of this process, and every run starts from a
+    collected heap. Each run is scaled to the reference machine by the
+    calibration runs on either side of it, so a machine whose speed drifts
+    during the benchmark is corrected run by run, and the median of the
+    scaled runs is kept.
+    """
+    workload()  # warm-up: imports, regex and XPath compilation
+    rates = []
+    p95s = []
+    before = calibration.run()
+    for _ in range(rounds):
+        gc.collect()
+        items, timings = workload()
+        after = calibration.run()
+        speed = calibration.reference / ((before + after) / 2)
+        before = after
+        rates.append(items / sum(timings) / speed)
+        if per_page:
+            p95s.append(statistics.quantiles(timings, n=20)[-1] * 1000 * speed)
+
+    tracemalloc.start()
+    workload()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {'items_per_sec': round(statistics.median(rates), 1)}
+    if per_page:
+        result['p95_ms'] = round(statistics.median(p95s), 3)
+    result['peak_mb'] = round(peak / 1024 / 1024, 2)
+    return result
+
+
+class Calibration:
+    """CPU time (ms) of a fixed workload that doesn't use this project's code
+
+    It runs between the benchmark rounds, so it sees the same machine
+    conditions. Its ratio to ``reference`` (the baseline's calibration, or
+    the median of a few runs up front when there is no baseline) is the
+    speed of this machine relative to the reference one at that moment.
+    """
+
+    def __init__(self, reference=None):
+        with open(os.path.join(PAGES_DIR, f'{next(iter(PAGES))}.html'), 'r') as f:
+            self.html = f.read()
+        self.timings = []
+        self.run()  # warm-up
+        self.timings.clear()
+        self.reference = reference or statistics.median(self.run() for _ in range(5))
+
+    def run(self):
+        import re
+        from parsel import Selector
+
+        started = time.process_time()
+        for _ in range(20):
+            selector = Selector(text=self.html)
+            json.dumps(selector.css('a::attr(href)').getall() + selector.css('h3::text').getall())
+            re.findall(r'\w+', self.html)
+        elapsed = (time.process_time() - started) * 1000
+        self.timings.append(elapsed)
+        return elapsed
+
+    @property
+    def speed(self):
+        """Median speed of this machine relative to the reference one"""
+        return self.reference / statistics.median(self.timings)
+
+
+def run_benchmarks(rounds, iterations, pipeline_items, offer_titles, calibration):
+    results = {}
+    for spider, pages in load_pages().items():
+        print(f"Benchmarking parse/{spider} ({len(pages)} pages x {iterations})...")
+        results[f'parse/{spider}'] = measure(parse_workload(spider, pages, iterations), rounds, True, calibration)
+    print(f"Benchmarking pipelines ({pipeline_items} items)...")
+    results['pipelines'] = measure(pipeline_workload(pipeline_items), rounds, False, calibration)
+    print(f"Benchmarking offers ({offer_titles} titles)...")
+    results['offers'] = measure(offers_workload(offer_titles), rounds, False, calibration)
+    return results
+
+
+def compare(baseline, results, tolerances):
+    """Rows of (benchmark, metric, baseline, current, change, status)"""
+    rows = []
+    for name, metrics in results.items():
+        for metric, current in metrics.items():
+            expected = baseline.get(name, {}).get(metric)
+            if expected is None:
+                rows.append((name, metric, None, current, None, 'new'))
+                continue
+            change = (current - expected) / expected if expected else 0.0
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerances[metric]:
+                status = 'REGRESSION'
+            elif worse < -tolerances[metric]:
+                status = 'improved'
+            else:
+                status = 'ok'
+            rows.append((name, metric, expected, current, change, status))
+    return rows
+
+
+def print_table(rows):
+    header = f"{'benchmark':<20}{'metric':<14}{'baseline':>12}{'current':>12}{'change':>9}  status"
+    print(header)
+    print('-' * len(header))
+    for name, metric, expected, current, change, status in rows:
+        expected = '-' if expected is None else expected
+        change = '-' if change is None else f'{change:+.1%}'
+        print(f"{name:<20}{METRIC_LABELS[metric]:<14}{expected:>12}{current:>12}{change:>9}  {status}")
+
+
+def parse_tolerances(values, tolerances):
+    tolerances = dict(tolerances)
+    for value in values or []:
+        metric, _, fraction = value.partition('=')
+        if metric not in DEFAULT_TOLERANCES:
+            raise SystemExit(f"Unknown metric {metric!r}, expected one of {', '.join(DEFAULT_TOLERANCES)}")
+        tolerances[metric] = float(fraction)
+    return tolerances
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the offline benchmarks and compare them against a baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Write the results as the new baseline instead of comparing')
+    parser.add_argument('--tolerance', '-t', action='append', metavar='METRIC=FRACTION',
+                        help='Allowed relative slowdown, e.g. items_per_sec=0.1 (repeatable)')
+    parser.add_argument('--rounds', type=int, default=9,
+                        help='Timed runs per benchmark, three times as many when recording a baseline (the median is kept)')
+    parser.add_argument('--iterations', type=int, default=20, help='Parses of every stored page per run')
+    parser.add_argument('--pipeline-items', type=int, default=20000, help='Synthetic items per pipeline run')
+    parser.add_argument('--offer-titles', type=int, default=50000, help='Corpus titles per offer parser run')
+    parser.add_argument('--memdiag', type=int, metavar='INTERVAL', nargs='?', const=500,
+                        help='Only measure the overhead of MemoryDiagnostics, with a snapshot every INTERVAL responses')
+    parser.add_argument('--record-pages', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--report', help='Write the results and comparison as JSON to this file')
+    args = parser.parse_args()
+
+    if args.record_pages:
+        record_pages()
+        return 0
+
+    if args.memdiag:
+        pages = load_pages()['coupons_com']
+        print(f"Measuring MemoryDiagnostics overhead (snapshot every {args.memdiag} responses)...")
+        overhead = memdiag_overhead(pages, args.iterations * 10, args.rounds, args.memdiag)
+        print(f"off: {overhead['off_ms']} ms/response, on: {overhead['on_ms']} ms/response "
+              f"({overhead['on_ms'] / overhead['off_ms'] - 1:+.1%}), {overhead['report_ms']} ms per snapshot")
+        return 0
+
+    baseline = {}
+    baseline_calibration = None
+    tolerances = DEFAULT_TOLERANCES
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            stored = json.load(f)
+        baseline = stored.get('benchmarks', {})
+        baseline_calibration = stored.get('calibration_ms')
+        tolerances = {**DEFAULT_TOLERANCES, **stored.get('tolerances', {})}
+    tolerances = parse_tolerances(args.tolerance, tolerances)
+
+    print("⏱️  Benchmark Regression Gate")
+    print("=" * 40)
+    calibration = Calibration(baseline_calibration)
+    # Every later run is compared to the baseline, so it is measured longer
+    rounds = args.rounds * 3 if args.update_baseline else args.rounds
+    results = run_benchmarks(rounds, args.iterations, args.pipeline_items, args.offer_titles, calibration)
+
+    machine = f'{platform.python_implementation()} {platform.python_version()} on {platform.machine()}'
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine, 'calibration_ms': round(calibration.reference, 3), 'tolerances': tolerances,
+                       'benchmarks': results}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    rows = compare(baseline, results, tolerances)
+    print()
+    print(f"Machine speed vs baseline: {calibration.speed:.2f}x (timings below are scaled to the baseline machine)")
+    print_table(rows)
+    regressions = [row for row in rows if row[-1] == 'REGRESSION']
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'machine': machine, 'speed': round(calibration.speed, 3), 'tolerances': tolerances, 'results': results,
+                       'regressions': [{'benchmark': r[0], 'metric': r[1], 'baseline': r[2], 'current': r[3]}
+                                       for r in regressions]}, f, indent=2)
+        print(f"Report written to {args.report}")
+
+    print()
+    if not baseline:
+        print(f"⚠️  No baseline at {args.baseline}; record one with --update-baseline")
+        return 0
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) beyond tolerance ({', '.join(f'{m} {t:.0%}' for m, t in tolerances.items())})")
+        return 1
+    print("✅ No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
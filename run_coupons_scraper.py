@@ -8,26 +8,231 @@ import subprocess
 import sys
 import json
 import argparse
+import glob
+import os
+import socket
+import time
 from datetime import datetime
 
 
-def run_scraper(spider_name='coupons_com', output_file=None, max_pages=None, category=None):
+COLUMNAR_FORMATS = ('.parquet', '.arrow')
+
+# Keep in sync with coupon_scraper.worker.DEFAULT_SOCKET (not imported, so
+# talking to a warm worker doesn't import Scrapy here)
+WORKER_SOCKET = '.scrapy/worker.sock'
+
+FEED_FORMATS = {
+    '.json': 'json',
+    '.jsonl': 'jsonlines',
+    '.jl': 'jsonlines',
+    '.csv': 'csv',
+    '.xml': 'xml',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+}
+
+
+def output_files(output_file):
+    """List the files written for an output name (several with row rollover)"""
+    if '%(batch_id)' in output_file:
+        pattern = output_file.replace('%(batch_id)05d', '*').replace('%(batch_id)d', '*')
+        return sorted(glob.glob(pattern))
+    return [output_file] if os.path.exists(output_file) else []
+
+
+def read_columns(path, columns):
+    """Read only the given columns of a Parquet or Arrow file"""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=columns).to_pydict()
+    
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().select(columns).to_pydict()
+
+
+def summarize_columnar(files):
+    """Summarize columnar output reading only the category and code columns"""
+    categories = {}
+    codes_found = 0
+    total = 0
+    
+    for path in files:
+        columns = read_columns(path, ['category', 'code'])
+        total += len(columns['code'])
+        codes_found += sum(1 for code in columns['code'] if code)
+        for cat in columns['category']:
+            cat = cat or 'unknown'
+            categories[cat] = categories.get(cat, 0) + 1
+    
+    print(f"\n📊 Results Summary:")
+    print(f"   Total coupons: {total}")
+    if total:
+        print(f"   Coupons with codes: {codes_found}")
+        print(f"   Categories: {categories}")
+
+
+def load_items(output_file):
+    """Read a JSON array or JSON lines output file"""
+    with open(output_file, 'r') as f:
+        if output_file.endswith(('.jsonl', '.jl')):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def summarize_json(output_file):
+    """Summarize JSON output"""
+    data = load_items(output_file)
+    
+    print(f"\n📊 Results Summary:")
+    print(f"   Total coupons: {len(data)}")
+    
+    if data:
+        categories = {}
+        codes_found = 0
+        
+        for item in data:
+            cat = item.get('category', 'unknown')
+            categories[cat] = categories.get(cat, 0) + 1
+            
+            if item.get('code'):
+                codes_found += 1
+        
+        print(f"   Coupons with codes: {codes_found}")
+        print(f"   Categories: {categories}")
+        
+        # Show first coupon as example
+        print(f"\n📋 Example coupon:")
+        example = data[0]
+        print(f"   Title: {example.get('title', 'N/A')}")
+        if example.get('code'):
+            print(f"   Code: {example['code']}")
+        if example.get('description'):
+            print(f"   Description: {example['description'][:100]}...")
+
+
+def summarize_output(output_file):
+    """Print a summary of the scraped output"""
+    files = output_files(output_file)
+    if not files:
+        print(f"Warning: Output file {output_file} not found")
+    elif output_file.endswith(COLUMNAR_FORMATS):
+        summarize_columnar(files)
+    else:
+        summarize_json(output_file)
+
+
+def submit_job(job, socket_path=WORKER_SOCKET):
+    """Send a crawl job to a running worker and yield its messages as they arrive"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job).encode('utf8') + b'\n')
+        with sock.makefile('rb') as stream:
+            for line in stream:
+                yield json.loads(line)
+
+
+def run_in_worker(spider_name, output_file, settings, socket_path):
+    """Run the crawl in a warm worker, printing items as they stream back"""
+    ext = os.path.splitext(output_file)[1].lower()
+    if 'CHECKPOINT_DIR' not in settings:
+        settings = dict(settings, FEEDS={
+            os.path.abspath(output_file): {'format': FEED_FORMATS.get(ext, 'json'), 'overwrite': True},
+        })
+    job = {'spider': spider_name, 'settings': settings}
+    
+    print(f"Running {spider_name} in worker {socket_path}")
+    print(f"Output: {output_file}")
+    print("-" * 50)
+    
+    submitted = time.perf_counter()
+    try:
+        for message in submit_job(job, socket_path):
+            if message['type'] == 'item':
+                print(f"   + {message['item'].get('title', 'N/A')}")
+            elif message['type'] == 'error':
+                print(f"❌ Scraping failed: {message['error']}")
+                return
+            elif message['type'] == 'finished':
+                print("✅ Scraping completed successfully!")
+                latency = message.get('job_first_request_latency')
+                if latency is not None:
+                    print(f"   First request {latency:.3f}s after the job was received, "
+                          f"{message['first_request_latency']:.3f}s after the worker started")
+                print(f"   {message['items']} items in {time.perf_counter() - submitted:.2f}s")
+    except OSError as e:
+        print(f"❌ Could not reach the crawl worker at {socket_path}: {e}")
+        print("   Start it with: python -m coupon_scraper.worker")
+        return
+    
+    try:
+        summarize_output(output_file)
+    except Exception as e:
+        print(f"Could not read output file: {e}")
+
+
+def checkpoint_spider(checkpoint_dir):
+    """Spider and feed of the crawl checkpointed in ``checkpoint_dir``"""
+    with open(os.path.join(checkpoint_dir, 'checkpoint.json'), 'r') as f:
+        meta = json.load(f)
+    return meta['spider'], meta['feed']
+
+
+def run_scraper(spider_name='coupons_com', output_file=None, max_pages=None, category=None,
+                rows_per_file=None, worker=None, checkpoint=None, resume=None):
     """Run the coupons.com scraper with specified options"""
     
+    if resume:
+        try:
+            spider_name, output_file = checkpoint_spider(resume)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"❌ No checkpoint to resume in {resume}: {e}")
+            return
+        checkpoint = resume
+    
+    if checkpoint and not output_file:
+        output_file = os.path.join(checkpoint, 'items.jsonl')
+    
     if not output_file:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = f"coupons_com_{timestamp}.json"
     
-    # Build scrapy command
-    cmd = ['scrapy', 'crawl', spider_name, '-o', output_file]
+    if rows_per_file and output_file.endswith(COLUMNAR_FORMATS) and '%(batch_id)' not in output_file:
+        base, ext = os.path.splitext(output_file)
+        output_file = f"{base}-%(batch_id)05d{ext}"
+    
+    settings = {}
+    if checkpoint:
+        # The checkpoint writes its own JSON lines feed, which survives a crash
+        if not output_file.endswith(('.jsonl', '.jl')):
+            output_file = os.path.splitext(output_file)[0] + '.jsonl'
+        settings['CHECKPOINT_DIR'] = checkpoint
+        settings['CHECKPOINT_FEED'] = output_file
+        settings['FEEDS'] = '{}'
+        if resume:
+            settings['CHECKPOINT_RESUME'] = True
+    
+    if rows_per_file:
+        settings['FEED_EXPORT_BATCH_ITEM_COUNT'] = rows_per_file
     
     # Add custom settings
     if max_pages:
-        cmd.extend(['-s', f'CLOSESPIDER_PAGECOUNT={max_pages}'])
+        settings['CLOSESPIDER_PAGECOUNT'] = max_pages
     
     if category:
         print(f"Note: Category filtering for '{category}' will be applied during scraping")
     
+    if worker:
+        run_in_worker(spider_name, output_file, settings, worker)
+        return
+    
+    # Build scrapy command
+    cmd = ['scrapy', 'crawl', spider_name]
+    if not checkpoint:
+        cmd.extend(['-o', output_file])
+    for name, value in settings.items():
+        cmd.extend(['-s', f'{name}={value}'])
+    
     print(f"Running: {' '.join(cmd)}")
     print(f"Output: {output_file}")
     print("-" * 50)
@@ -44,39 +249,7 @@ def run_scraper(spider_name='coupons_com', output_file=None, max_pages=None, cat
             
             # Try to read and display summary
             try:
-                import os
-                if os.path.exists(output_file):
-                    with open(output_file, 'r') as f:
-                        data = json.load(f)
-                    
-                    print(f"\n📊 Results Summary:")
-                    print(f"   Total coupons: {len(data)}")
-                    
-                    if data:
-                        categories = {}
-                        codes_found = 0
-                        
-                        for item in data:
-                            cat = item.get('category', 'unknown')
-                            categories[cat] = categories.get(cat, 0) + 1
-                            
-                            if item.get('code'):
-                                codes_found += 1
-                        
-                        print(f"   Coupons with codes: {codes_found}")
-                        print(f"   Categories: {categories}")
-                        
-                        # Show first coupon as example
-                        print(f"\n📋 Example coupon:")
-                        example = data[0]
-                        print(f"   Title: {example.get('title', 'N/A')}")
-                        if example.get('code'):
-                            print(f"   Code: {example['code']}")
-                        if example.get('description'):
-                            print(f"   Description: {example['description'][:100]}...")
-                else:
-                    print(f"Warning: Output file {output_file} not found")
-                
+                summarize_output(output_file)
             except Exception as e:
                 print(f"Could not read output file: {e}")
         else:
@@ -87,18 +260,28 @@ def run_scraper(spider_name='coupons_com', output_file=None, max_pages=None, cat
     except subprocess.TimeoutExpired:
         print("⏰ Scraping timed out after 60 seconds")
         process.kill()
+        if checkpoint:
+            print(f"   Continue with: python run_coupons_scraper.py --resume {checkpoint}")
     except Exception as e:
         print(f"❌ Error running scraper: {e}")
 
 
 def main():
     parser = argparse.ArgumentParser(description='Scrape coupons from coupons.com')
-    parser.add_argument('--output', '-o', help='Output JSON file name')
+    parser.add_argument('--output', '-o', help='Output file name (.json, .parquet or .arrow)')
     parser.add_argument('--pages', '-p', type=int, help='Maximum pages to scrape')
     parser.add_argument('--category', '-c', help='Filter by category (food, clothing, electronics, etc.)')
     parser.add_argument('--spider', '-s', default='coupons_com', 
                        choices=['coupons_com', 'coupons', 'demo_coupons'],
                        help='Spider to use')
+    parser.add_argument('--rows-per-file', type=int,
+                       help='Start a new .parquet/.arrow file every N rows')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                       help='Checkpoint the crawl to DIR so it can be resumed after a crash')
+    parser.add_argument('--resume', metavar='DIR',
+                       help='Resume the crawl checkpointed in DIR where it stopped')
+    parser.add_argument('--worker', nargs='?', const=WORKER_SOCKET, metavar='SOCKET',
+                       help='Run in a warm crawl worker (python -m coupon_scraper.worker) instead of a new scrapy process')
     
     args = parser.parse_args()
     
@@ -109,7 +292,11 @@ def main():
         spider_name=args.spider,
         output_file=args.output,
         max_pages=args.pages,
-        category=args.category
+        category=args.category,
+        rows_per_file=args.rows_per_file,
+        worker=args.worker,
+        checkpoint=args.checkpoint,
+        resume=args.resume
     )
 
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Dupefilter Benchmark
+Fill Scrapy's RFPDupeFilter and CompactDupeFilter with the same request
+fingerprints and compare memory per request, lookup speed and the time to
+reopen a JOBDIR
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from coupon_scraper.extensions import get_rss
+
+
+RESULT_PREFIX = 'DUPEFILTER_RESULT '
+VARIANTS = ['default', 'default-jobdir', 'compact', 'compact-jobdir']
+BATCH = 100000
+
+
+class IdentityFingerprinter:
+    """The benchmark passes fingerprints as the requests, so only the filters are timed"""
+
+    def fingerprint(self, request):
+        return request
+
+
+def fingerprints(start, count):
+    return [hashlib.sha1(b'https://www.coupons.com/coupon-codes/?page=%d' % i).digest()
+            for i in range(start, start + count)]
+
+
+def make_filter(variant, jobdir):
+    from scrapy.dupefilters import RFPDupeFilter
+    from coupon_scraper.dupefilters import CompactDupeFilter
+
+    path = jobdir if variant.endswith('-jobdir') else None
+    if variant.startswith('compact'):
+        return CompactDupeFilter(path, fingerprinter=IdentityFingerprinter())
+    return RFPDupeFilter(path, fingerprinter=IdentityFingerprinter())
+
+
+def timed_seen(dupefilter, batch):
+    """Seconds to call request_seen on every fingerprint of ``batch``, and how many were seen"""
+    request_seen = dupefilter.request_seen
+    started = time.perf_counter()
+    seen = sum(1 for fp in batch if request_seen(fp))
+    return time.perf_counter() - started, seen
+
+
+def bench_one(variant, count, lookups):
+    """Run one variant in this process and print its measurements"""
+    jobdir = tempfile.mkdtemp(prefix='dupefilter-')
+    rss_before = get_rss()
+    dupefilter = make_filter(variant, jobdir)
+    insert_time = 0.0
+    for start in range(0, count, BATCH):
+        elapsed, seen = timed_seen(dupefilter, fingerprints(start, min(BATCH, count - start)))
+        insert_time += elapsed
+        assert seen == 0, f'{seen} new fingerprints reported as seen'
+    rss = get_rss() - rss_before
+
+    hit_time, seen = timed_seen(dupefilter, fingerprints(0, lookups))
+    assert seen == lookups, f'{lookups - seen} fingerprints missed'
+    miss_time, _ = timed_seen(dupefilter, fingerprints(count, lookups))
+    dupefilter.close('finished')
+
+    reopen = None
+    if variant.endswith('-jobdir'):
+        started = time.perf_counter()
+        make_filter(variant, jobdir).close('finished')
+        reopen = round(time.perf_counter() - started, 3)
+    disk = sum(os.path.getsize(os.path.join(jobdir, name)) for name in os.listdir(jobdir))
+
+    result = {
+        'variant': variant,
+        'fingerprints': count,
+        'rss_mb': round(rss / 1024 / 1024, 1),
+        'bytes_per_url': round(rss / count, 1),
+        'insert_ns': round(insert_time / count * 1e9),
+        'hit_ns': round(hit_time / lookups * 1e9),
+        'miss_ns': round(miss_time / lookups * 1e9),
+        'disk_mb': round(disk / 1024 / 1024, 1),
+        'reopen_s': reopen,
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def run_variant(variant, count, lookups):
+    """Run one variant in a fresh interpreter, so its RSS is measured alone"""
+    cmd = [sys.executable, os.path.abspath(__file__), '--bench-one', variant,
+           '--fingerprints', str(count), '--lookups', str(lookups)]
+    completed = subprocess.run(cmd, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    print(f"❌ {variant} failed")
+    print("STDERR:", completed.stderr[-1000:] if completed.stderr else "None")
+    return None
+
+
+def print_table(results):
+    header = (f"{'variant':<16}{'urls':>11}{'rss MB':>9}{'B/url':>8}{'insert ns':>11}{'hit ns':>8}"
+              f"{'miss ns':>9}{'disk MB':>9}{'reopen s':>10}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        reopen = '-' if r['reopen_s'] is None else r['reopen_s']
+        print(f"{r['variant']:<16}{r['fingerprints']:>11}{r['rss_mb']:>9}{r['bytes_per_url']:>8}{r['insert_ns']:>11}"
+              f"{r['hit_ns']:>8}{r['miss_ns']:>9}{r['disk_mb']:>9}{reopen:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the default and compact dupefilters')
+    parser.add_argument('--fingerprints', type=int, default=10000000, help='Fingerprints to fill each filter with')
+    parser.add_argument('--lookups', type=int, default=1000000, help='Seen and new fingerprints looked up after')
+    parser.add_argument('--variant', action='append', choices=VARIANTS, help='Filter to run (repeatable, default: all)')
+    parser.add_argument('--report', help='Write the results as JSON to this file')
+    parser.add_argument('--bench-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bench_one:
+        bench_one(args.bench_one, args.fingerprints, args.lookups)
+        return 0
+
+    print("🧮 Dupefilter Benchmark")
+    print("=" * 40)
+    results = []
+    for variant in args.variant or VARIANTS:
+        print(f"Filling {variant} with {args.fingerprints} fingerprints...")
+        result = run_variant(variant, args.fingerprints, args.lookups)
+        if result:
+            results.append(result)
+    print()
+    print_table(results)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Report written to {args.report}")
+    return 0 if len(results) == len(args.variant or VARIANTS) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Crawl Load Test
+Run the real spiders against a local mock coupon site and report throughput
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from coupon_scraper.mocksite import MockSite, MockSiteConfig
+
+
+RESULT_PREFIX = 'LOADTEST_RESULT '
+
+# The mock site is reached as the spiders' HTTP proxy, so they crawl their
+# usual host and their URL-based dispatching works unchanged
+SITE_BASE_URL = 'http://www.coupons.com'
+# Over TLS it is reached directly, with the spiders' host resolved to it
+TLS_HOST = 'www.coupons.com'
+
+
+def crawl_one(job):
+    """Run a single crawl in this process and print its measurements"""
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    settings.setdict({
+        'CONCURRENT_REQUESTS': job['concurrency'],
+        'CONCURRENT_REQUESTS_PER_DOMAIN': job['concurrency'],
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'LOG_LEVEL': job['log_level'],
+        'FEEDS': {job['feed']: {'format': 'jsonlines', 'overwrite': True}} if job['feed'] else {},
+        **job['settings'],
+    }, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(job['spider'])
+    latencies = []
+
+    def response_received(response, request, spider):
+        if 'download_latency' in request.meta:
+            latencies.append(request.meta['download_latency'])
+
+    crawler.signals.connect(response_received, signal=signals.response_received)
+    process.crawl(crawler, start_urls=job['start_urls'])
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    process.start()
+    wall = time.perf_counter() - wall_start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    stats = crawler.stats.get_stats()
+    start_time = stats.get('start_time')
+    finish_time = stats.get('finish_time')
+    elapsed = (finish_time - start_time).total_seconds() if start_time and finish_time else wall
+    elapsed = max(elapsed, 1e-6)
+    requests = stats.get('downloader/request_count', 0)
+    items = stats.get('item_scraped_count', 0)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+
+    latencies.sort()
+    result = {
+        'spider': job['spider'],
+        'protocol': job.get('protocol', 'http'),
+        'concurrency': job['concurrency'],
+        'elapsed': round(elapsed, 3),
+        'requests': requests,
+        'items': items,
+        'errors': stats.get('downloader/response_status_count/500', 0),
+        'requests_per_sec': round(requests / elapsed, 2),
+        'items_per_sec': round(items / elapsed, 2),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'max_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'rendered': stats.get('render/rendered', 0),
+        'latency_avg_ms': round(1000 * statistics.fmean(latencies), 1) if latencies else 0.0,
+        'latency_p95_ms': round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1) if latencies else 0.0,
+        'http2_requests': stats.get('http2/requests', 0),
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def run_crawl(job, proxy_url=None):
+    """Run one crawl in a fresh interpreter so measurements don't bleed between runs"""
+    env = dict(os.environ)
+    if proxy_url:
+        env.update(http_proxy=proxy_url, HTTP_PROXY=proxy_url)
+        env.pop('no_proxy', None)
+        env.pop('NO_PROXY', None)
+    cmd = [sys.executable, os.path.abspath(__file__), '--crawl-one', json.dumps(job)]
+    completed = subprocess.run(cmd, capture_output=True, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+
+    print(f"❌ Crawl failed: {job['spider']} ({job.get('protocol', 'http')}) at concurrency {job['concurrency']}")
+    print("STDERR:", completed.stderr[-1000:] if completed.stderr else "None")
+    return None
+
+
+def find_ceiling(results, min_gain=0.05):
+    """The lowest concurrency after which more concurrency stops paying off"""
+    results = sorted(results, key=lambda r: r['concurrency'])
+    best = results[0]
+    for result in results[1:]:
+        if result['items_per_sec'] < best['items_per_sec'] * (1 + min_gain):
+            break
+        best = result
+    return best
+
+
+def print_table(results):
+    header = (f"{'spider':<14}{'proto':>8}{'conc':>6}{'req/s':>10}{'items/s':>10}{'lat ms':>8}{'p95 ms':>8}"
+              f"{'cpu%':>8}{'rss MB':>9}{'requests':>10}{'items':>8}{'5xx':>6}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['spider']:<14}{r['protocol']:>8}{r['concurrency']:>6}{r['requests_per_sec']:>10}{r['items_per_sec']:>10}"
+              f"{r['latency_avg_ms']:>8}{r['latency_p95_ms']:>8}"
+              f"{r['cpu_percent']:>8}{r['max_rss_mb']:>9}{r['requests']:>10}{r['items']:>8}{r['errors']:>6}")
+
+
+def print_protocol_comparison(results):
+    """HTTP/2 against HTTP/1.1 for every spider and concurrency run with both"""
+    runs = {(r['spider'], r['concurrency'], r['protocol']): r for r in results}
+    for (spider, concurrency, protocol), h2 in runs.items():
+        h1 = runs.get((spider, concurrency, 'http1.1'))
+        if protocol != 'h2' or not h1 or not h1['items_per_sec'] or not h1['latency_avg_ms']:
+            continue
+        throughput = 100 * (h2['items_per_sec'] / h1['items_per_sec'] - 1)
+        latency = 100 * (h2['latency_avg_ms'] / h1['latency_avg_ms'] - 1)
+        print(f"🔀 {spider} at concurrency {concurrency}: HTTP/2 items/s {throughput:+.1f}%, "
+              f"latency {latency:+.1f}% ({h2['http2_requests']} of {h2['requests']} requests over HTTP/2)")
+
+
+def seed_dns_cache(path, host, address):
+    """DNS cache file (see DNSCACHE_FILE) resolving ``host`` to ``address``"""
+    with open(path, 'w') as f:
+        json.dump({host: {'address': address, 'resolved_at': time.time()}}, f)
+
+
+def parse_overrides(values):
+    overrides = {}
+    for value in values or []:
+        key, _, setting = value.partition('=')
+        overrides[key] = setting
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the spiders against a local mock coupon site')
+    parser.add_argument('--spider', action='append', choices=['coupons_com', 'coupons'],
+                        help='Spider to run (repeatable, default: both)')
+    parser.add_argument('--sections', type=int, default=4, help='Listing sections (start URLs)')
+    parser.add_argument('--depth', type=int, default=10, help='Pagination depth per section')
+    parser.add_argument('--cards', type=int, default=20, help='Coupon cards per page')
+    parser.add_argument('--latency', default='fixed:0',
+                        help="Response latency: fixed:S, uniform:A:B, exp:MEAN or lognormal:MU:SIGMA")
+    parser.add_argument('--pagination', choices=['next', 'numbered'], default='next',
+                        help='Listing pagination markup: next link only, or numbered pages')
+    parser.add_argument('--structured', action='store_true',
+                        help='Also embed the cards as __NEXT_DATA__ JSON')
+    parser.add_argument('--js-only-rate', type=float, default=0.0,
+                        help='Fraction of pages served as JavaScript shells (rendered through /render.html)')
+    parser.add_argument('--render-delay', type=float, default=0.0, help='Extra seconds per /render.html request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of pages answered with HTTP 500')
+    parser.add_argument('--concurrency', default='1,2,4,8,16',
+                        help='Comma separated CONCURRENT_REQUESTS values to sweep')
+    parser.add_argument('--protocols',
+                        help='Serve the site over TLS and compare these protocols: http1.1, h2 or both (comma separated)')
+    parser.add_argument('--site-http1-only', action='store_true',
+                        help='With --protocols, the TLS site only offers HTTP/1.1 (tests the HTTP/2 fallback)')
+    parser.add_argument('--set', '-s', action='append', metavar='NAME=VALUE',
+                        help='Extra Scrapy setting for the crawls (repeatable)')
+    parser.add_argument('--feed', default=None, help='Also write items to this feed file')
+    parser.add_argument('--report', help='Write the results as JSON to this file')
+    parser.add_argument('--loglevel', default='ERROR')
+    parser.add_argument('--crawl-one', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.crawl_one:
+        crawl_one(json.loads(args.crawl_one))
+        return 0
+
+    config = MockSiteConfig(
+        sections=args.sections,
+        depth=args.depth,
+        cards_per_page=args.cards,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        pagination=args.pagination,
+        structured=args.structured,
+        js_only_rate=args.js_only_rate,
+        render_delay=args.render_delay,
+    )
+    spiders = args.spider or ['coupons_com', 'coupons']
+    concurrencies = [int(c) for c in args.concurrency.split(',')]
+
+    print("🏋️  Crawl Load Test")
+    print("=" * 40)
+    print(f"Mock site: {config.total_pages()} pages, {config.cards_per_page} cards/page, "
+          f"latency {config.latency}, error rate {config.error_rate}")
+
+    protocols = args.protocols.split(',') if args.protocols else ['http']
+    tls = args.protocols is not None
+
+    results = []
+    with MockSite(config, tls=tls, http2=not args.site_http1_only) as site, \
+            tempfile.TemporaryDirectory() as temp_dir:
+        settings = {}
+        if config.js_only_rate:
+            # The mock site is also the render service; every run renders from scratch
+            settings = {'RENDER_ENABLED': True, 'RENDER_URL': site.base_url,
+                        'RENDER_CACHE_DIR': '', 'RENDER_BUDGET': 0}
+        if tls:
+            dns_cache = os.path.join(temp_dir, 'dnscache.json')
+            seed_dns_cache(dns_cache, TLS_HOST, site.host)
+            settings.update({'DNSCACHE_FILE': dns_cache, 'HTTPPROXY_ENABLED': False})
+            start_urls = site.start_urls(f'https://{TLS_HOST}:{site.port}')
+        else:
+            start_urls = site.start_urls(SITE_BASE_URL)
+        settings.update(parse_overrides(args.set))
+        for spider in spiders:
+            for concurrency in concurrencies:
+                for protocol in protocols:
+                    job = {
+                        'spider': spider,
+                        'protocol': protocol,
+                        'concurrency': concurrency,
+                        'start_urls': start_urls,
+                        'settings': dict(settings, HTTP2_ENABLED=protocol == 'h2') if tls else settings,
+                        'feed': args.feed,
+                        'log_level': args.loglevel,
+                    }
+                    print(f"Running {spider} ({protocol}) at concurrency {concurrency}...")
+                    result = run_crawl(job, None if tls else site.base_url)
+                    if result:
+                        results.append(result)
+
+    if not results:
+        return 1
+
+    print()
+    print_table(results)
+    print()
+    print_protocol_comparison(results)
+    for spider in spiders:
+        spider_results = [r for r in results if r['spider'] == spider and r['protocol'] == protocols[0]]
+        if spider_results:
+            ceiling = find_ceiling(spider_results)
+            print(f"📈 {spider}: throughput ceiling ~{ceiling['items_per_sec']} items/s "
+                  f"({ceiling['requests_per_sec']} req/s) at concurrency {ceiling['concurrency']}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'config': config.to_dict(), 'results': results}, f, indent=2)
+        print(f"Report written to {args.report}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,11 +3,16 @@
 Test script for the coupon scraper
 """
 
+import gzip
 import json
+import os
 import subprocess
 import sys
+import tempfile
 from pathlib import Path
 
+FIXTURES = Path(__file__).parent / "fixtures"
+
 
 def run_command(cmd):
     """Run a shell command and return the result"""
@@ -102,6 +107,1237 @@ def test_project_structure():
         return True
 
 
+def test_sitemap_discovery():
+    """Test sitemap discovery against the local sitemap fixtures"""
+    print("\nTesting sitemap discovery...")
+    
+    from scrapy.http import Response
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.sitemaps import SitemapDiscovery, parse_lastmod
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = str(Path(tmp) / "sitemap_state.json")
+        settings = {
+            "SITEMAP_FOLLOW": [r"/coupon-codes/"],
+            "SITEMAP_STATE_FILE": state_file,
+        }
+        
+        def run_discovery(url, body):
+            crawler = get_crawler(CouponsComSpider, settings)
+            crawler.spider = CouponsComSpider.from_crawler(crawler)
+            discovery = SitemapDiscovery.from_crawler(crawler)
+            list(discovery.start_requests(crawler.spider))
+            requests = list(discovery.parse_sitemap(Response(url, body=body)))
+            return discovery, requests
+        
+        index_body = (FIXTURES / "sitemap_index.xml").read_bytes()
+        stores_body = gzip.compress((FIXTURES / "sitemap_stores.xml").read_bytes())
+        
+        discovery, children = run_discovery("https://www.coupons.com/sitemap.xml", index_body)
+        if len(children) != 2:
+            print(f"✗ Expected 2 child sitemaps, got {len(children)}")
+            return False
+        
+        # An interrupted crawl leaves the child sitemaps to be read again
+        for request in children:
+            discovery.response_received(Response(request.url), request, None)
+        discovery.spider_closed(None, "shutdown")
+        discovery, children = run_discovery("https://www.coupons.com/sitemap.xml", index_body)
+        if len(children) != 2:
+            print(f"✗ Sitemaps of an interrupted crawl were skipped: {len(children)} followed")
+            return False
+        for request in children:
+            discovery.response_received(Response(request.url), request, None)
+        discovery.spider_closed(None, "finished")
+        _, children = run_discovery("https://www.coupons.com/sitemap.xml", index_body)
+        if children:
+            print("✗ Sitemaps of a finished crawl were followed again")
+            return False
+        
+        # A child sitemap whose pages were left out by the budget or failed
+        # is read again by the next run
+        for max_urls, status in ((1, 200), (0, 404)):
+            settings["SITEMAP_MAX_URLS"] = max_urls
+            settings["SITEMAP_STATE_FILE"] = str(Path(tmp) / f"partial_{max_urls}.json")
+            discovery, children = run_discovery("https://www.coupons.com/sitemap.xml", index_body)
+            for child in children:
+                discovery.response_received(Response(child.url), child, None)
+            stores = next(child for child in children if "stores" in child.url)
+            pages = list(discovery.parse_sitemap(Response(stores.url, body=stores_body, request=stores)))
+            for request in pages:
+                discovery.response_received(Response(request.url, status=status), request, None)
+            discovery.spider_closed(None, "finished")
+            _, children = run_discovery("https://www.coupons.com/sitemap.xml", index_body)
+            if [child.url for child in children] != [stores.url]:
+                print(f"✗ Partly crawled sitemap skipped (max_urls={max_urls}, status {status}): "
+                      f"{[child.url for child in children]} followed")
+                return False
+        settings["SITEMAP_MAX_URLS"] = 0
+        settings["SITEMAP_STATE_FILE"] = state_file
+        
+        discovery, pages = run_discovery("https://www.coupons.com/sitemap-stores.xml.gz", stores_body)
+        urls = [request.url for request in pages]
+        expected = [
+            "https://www.coupons.com/coupon-codes/target/",
+            "https://www.coupons.com/coupon-codes/old-navy/",
+            "https://www.coupons.com/coupon-codes/walmart/",
+        ]
+        if urls != expected:
+            print(f"✗ Unexpected discovery order: {urls}")
+            return False
+        if not pages[0].priority > pages[1].priority > pages[2].priority:
+            print("✗ Pages are not prioritized by lastmod")
+            return False
+        
+        # Crawl the pages, then the next run only sees the page without a lastmod
+        for request in pages:
+            discovery.response_received(Response(request.url), request, None)
+        discovery.spider_closed(None, "finished")
+        _, pages = run_discovery("https://www.coupons.com/sitemap-stores.xml.gz", stores_body)
+        if [request.url for request in pages] != ["https://www.coupons.com/coupon-codes/walmart/"]:
+            print(f"✗ Unchanged URLs were not skipped: {[request.url for request in pages]}")
+            return False
+    
+    if parse_lastmod("2025-07-01T06:30:00Z") != parse_lastmod("2025-07-01T08:30:00+02:00"):
+        print("✗ lastmod timezones are not normalized")
+        return False
+    
+    print("✓ Sitemap discovery prioritizes and skips URLs by lastmod")
+    return True
+
+
+def test_revisit_scheduler():
+    """Test that the revisit scheduler spends its budget on churning URLs"""
+    print("\nTesting revisit scheduler...")
+    
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.revisit import RevisitScheduler
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    
+    day = 24 * 3600
+    crawler = get_crawler(CouponsComSpider, {"REVISIT_BUDGET": 2, "REVISIT_STATE_FILE": None})
+    scheduler = RevisitScheduler.from_crawler(crawler)
+    scheduler.state.urls = {
+        # Changed on 9 of 10 daily visits
+        "https://www.coupons.com/coupon-codes/hot/": {
+            "first_visit": 0, "last_visit": 10 * day, "visits": 10, "changes": 9, "fingerprint": "a",
+        },
+        # Never changed in 60 days
+        "https://www.coupons.com/coupon-codes/cold/": {
+            "first_visit": 0, "last_visit": 60 * day, "visits": 60, "changes": 0, "fingerprint": "b",
+        },
+    }
+    urls = ["https://www.coupons.com/coupon-codes/cold/",
+            "https://www.coupons.com/coupon-codes/hot/",
+            "https://www.coupons.com/coupon-codes/new/"]
+    selected, expected_stale = scheduler.plan(urls, now=61 * day)
+    
+    if selected != ["https://www.coupons.com/coupon-codes/new/", "https://www.coupons.com/coupon-codes/hot/"]:
+        print(f"✗ Unexpected revisit plan: {selected}")
+        return False
+    if not 0 < expected_stale < 0.1:
+        print(f"✗ Unexpected staleness estimate: {expected_stale}")
+        return False
+    
+    print(f"✓ Revisit plan selected {len(selected)} URLs, {expected_stale:.3f} expected stale")
+    return True
+
+
+def test_memory_diagnostics():
+    """Test that a memory snapshot reports the allocation sites that grew"""
+    print("\nTesting memory diagnostics...")
+    
+    import tracemalloc
+    from scrapy import Spider
+    from scrapy.http import Request, Response
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.extensions import MemoryDiagnostics
+    
+    leaked = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report_file = os.path.join(temp_dir, "memdiag.log")
+        crawler = get_crawler(Spider, {"MEMDIAG_ENABLED": True, "MEMDIAG_INTERVAL": 50, "MEMDIAG_WINDOW": 10,
+                                       "MEMDIAG_TOP": 5, "MEMDIAG_FILE": report_file})
+        spider = Spider("memdiag")
+        diagnostics = MemoryDiagnostics.from_crawler(crawler)
+        diagnostics.spider_opened(spider)
+        tracing = []
+        for i in range(100):
+            response = Response(f"https://www.coupons.com/deals/?page={i}", request=Request("https://www.coupons.com/"))
+            leaked.append(bytearray(10000))  # 10 kB kept per response
+            diagnostics.response_received(response, response.request, spider)
+            tracing.append(tracemalloc.is_tracing())
+        diagnostics.spider_closed(spider)
+        with open(report_file) as f:
+            reports = f.read().split("\n\n")
+    
+    stats = crawler.stats.get_stats()
+    if tracemalloc.is_tracing():
+        print("✗ tracemalloc left running after the spider closed")
+        return False
+    # Traced from the 40th response to the snapshot at the 50th, and from the 90th to the 100th
+    if sum(tracing) != 20 or any(tracing[:39]) or not all(tracing[39:49]) or tracing[49]:
+        print(f"✗ tracemalloc was on after {[i + 1 for i, on in enumerate(tracing) if on]} responses")
+        return False
+    if stats.get("memdiag/snapshots") != 2 or "memdiag/rss_max" not in stats or "memdiag/live/Response" not in stats:
+        print(f"✗ Unexpected memdiag stats: {stats}")
+        return False
+    top = reports[0].splitlines()[2]
+    if "test_scraper.py" not in top or not 9000 <= float(top.split("(")[1].split("B/")[0]) <= 11000:
+        print(f"✗ The leaking line is not the top allocation site: {top}")
+        return False
+    
+    print("✓ Snapshots of short tracing windows report the leaking line with its growth per response")
+    return True
+
+
+def test_mock_site_markup():
+    """Test that both spiders extract every card of a mock site page"""
+    print("\nTesting mock site markup...")
+    
+    from scrapy.http import HtmlResponse, Request
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.mocksite import MockSiteConfig, render_page
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    from coupon_scraper.spiders.coupons_spider import CouponsSpider
+    
+    config = MockSiteConfig(depth=2, cards_per_page=12)
+    html = render_page(config, "/coupon-codes/", 1)
+    response = HtmlResponse("http://www.coupons.com/coupon-codes/", body=html, encoding="utf-8")
+    
+    for spidercls in (CouponsComSpider, CouponsSpider):
+        spider = spidercls.from_crawler(get_crawler(spidercls))
+        results = list(spider.parse(response))
+        items = [r for r in results if not isinstance(r, Request)]
+        requests = [r for r in results if isinstance(r, Request)]
+        if len(items) != 12 or not all(item.get("code") and item.get("expiry_date") for item in items):
+            print(f"✗ {spider.name} extracted {len(items)} complete items from a 12 card page")
+            return False
+        if [r.url for r in requests] != ["http://www.coupons.com/coupon-codes/?page=2"]:
+            print(f"✗ {spider.name} did not follow the mock pagination")
+            return False
+    
+    print("✓ Mock site pages match the spiders' selectors")
+    return True
+
+
+def test_persistent_caches():
+    """Test the DNS cache warm-up and the robots.txt cache shared between runs"""
+    print("\nTesting persistent DNS and robots.txt caches...")
+    
+    import time
+    from scrapy.http import Request, Response
+    from scrapy.resolver import dnscache
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.extensions import DNSCacheWarmup
+    from coupon_scraper.middlewares import PersistentRobotsTxtCacheMiddleware
+    from coupon_scraper.resolver import PersistentCachingResolver, load_dns_cache, save_dns_entries
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_file = os.path.join(temp_dir, "dns", "dnscache.json")
+        save_dns_entries(cache_file, {
+            "www.coupons.com": {"address": "10.0.0.1", "resolved_at": time.time(), "latency": 0.25},
+            "stale.example": {"address": "10.0.0.2", "resolved_at": time.time() - 7200},
+        })
+        save_dns_entries(cache_file, {"www.retailmenot.com": {"address": "10.0.0.3", "resolved_at": time.time()}})
+        if set(load_dns_cache(cache_file, 3600)) != {"www.coupons.com", "www.retailmenot.com"}:
+            print(f"✗ Unexpected cache entries: {load_dns_cache(cache_file, 3600)}")
+            return False
+        
+        cache_limit = dnscache.limit
+        resolver = PersistentCachingResolver(None, 100, 5.0, cache_file=cache_file, ttl=3600)
+        warmed = dict(dnscache)
+        dnscache.clear()
+        dnscache.limit = cache_limit
+        if warmed.get("www.coupons.com") != "10.0.0.1" or "stale.example" in warmed:
+            print("✗ The resolver was not warmed from the unexpired entries")
+            return False
+        resolver.looked_up["new.example"] = {"address": "10.0.0.4", "resolved_at": time.time(), "latency": 0.1}
+        
+        # Two crawls sharing the resolver each count only the hosts they requested
+        crawls = []
+        for urls in (["https://www.coupons.com/deals/", "https://new.example/"], ["https://www.retailmenot.com/"]):
+            crawler = get_crawler(settings_dict={"DNSCACHE_FILE": cache_file})
+            warmup = DNSCacheWarmup.from_crawler(crawler)
+            warmup.resolver = resolver
+            for url in urls:
+                warmup.request_reached_downloader(Request(url), None)
+            warmup.spider_closed(None)
+            crawls.append({key.split("/")[1]: value for key, value in crawler.stats.get_stats().items()})
+        if crawls != [{"preloaded": 2, "hits": 1, "lookups": 1, "time_saved": 0.25},
+                      {"preloaded": 2, "hits": 1, "lookups": 0, "time_saved": 0.0}]:
+            print(f"✗ Unexpected per-crawl DNS stats: {crawls}")
+            return False
+        
+        # A second run answers the robots.txt download from the first run's copy
+        robots_url = "https://www.coupons.com/robots.txt"
+        request = Request(robots_url, meta={"dont_obey_robotstxt": True, "download_latency": 0.2})
+        settings = {"ROBOTSTXT_OBEY": True, "ROBOTSCACHE_ENABLED": True,
+                    "ROBOTSCACHE_DIR": os.path.join(temp_dir, "robots"), "ROBOTSCACHE_TTL": 3600}
+        first = get_crawler(settings_dict=settings)
+        middleware = PersistentRobotsTxtCacheMiddleware.from_crawler(first)
+        if middleware.process_request(request, None) is not None:
+            print("✗ robots.txt served from an empty cache")
+            return False
+        middleware.process_response(request, Response(robots_url, body=b"User-agent: *\nDisallow: /admin"), None)
+        middleware.process_response(request, Response(robots_url, status=503), None)
+        
+        second = get_crawler(settings_dict=settings)
+        cached = PersistentRobotsTxtCacheMiddleware.from_crawler(second).process_request(request, None)
+        if cached is None or cached.body != b"User-agent: *\nDisallow: /admin" or "robotscache" not in cached.flags:
+            print("✗ robots.txt was not reused by the next run")
+            return False
+        if second.stats.get_value("robotscache/time_saved") != 0.2 or first.stats.get_value("robotscache/stored") != 1:
+            print(f"✗ Unexpected robots cache stats: {first.stats.get_stats()} {second.stats.get_stats()}")
+            return False
+        
+        expired = get_crawler(settings_dict={**settings, "ROBOTSCACHE_TTL": 0})
+        time.sleep(0.01)
+        if PersistentRobotsTxtCacheMiddleware.from_crawler(expired).process_request(request, None) is not None:
+            print("✗ An expired robots.txt was served")
+            return False
+    
+    print("✓ DNS cache warmed and counted per crawl, robots.txt reused across runs")
+    return True
+
+
+def test_columnar_exporters():
+    """Test the Parquet and Arrow feeds: typed columns, row groups and file rollover"""
+    print("\nTesting columnar exporters...")
+    
+    from coupon_scraper import exporters
+    from coupon_scraper.mocksite import MockSite, MockSiteConfig
+    import run_load_test
+    
+    if exporters.pa is None:
+        print("⚠ pyarrow not installed, skipping")
+        return True
+    pa, pq = exporters.pa, exporters.pq
+    
+    with tempfile.TemporaryDirectory() as tmp, MockSite(MockSiteConfig(depth=2)) as site:
+        feed_options = {"batch_item_count": 64, "item_export_kwargs": {"row_group_size": 25}}
+        job = {
+            "spider": "coupons_com",
+            "concurrency": 4,
+            "start_urls": site.start_urls(run_load_test.SITE_BASE_URL),
+            "settings": {"FEEDS": {
+                os.path.join(tmp, "coupons-%(batch_id)02d.parquet"): {"format": "parquet", **feed_options},
+                os.path.join(tmp, "coupons-%(batch_id)02d.arrow"): {"format": "arrow", **feed_options},
+            }},
+            "feed": None,
+            "log_level": "ERROR",
+        }
+        result = run_load_test.run_crawl(job, proxy_url=site.base_url)
+        if not result or result["items"] != 160:
+            print(f"✗ Crawl failed: {result}")
+            return False
+        
+        parquet_files = sorted(Path(tmp).glob("coupons-*.parquet"))
+        arrow_files = sorted(Path(tmp).glob("coupons-*.arrow"))
+        row_groups = [[pq.ParquetFile(path).metadata.row_group(i).num_rows
+                       for i in range(pq.ParquetFile(path).num_row_groups)] for path in parquet_files]
+        batches = []
+        arrow_rows = []
+        for path in arrow_files:
+            with pa.ipc.open_file(path) as reader:
+                batches.append([reader.get_batch(i).num_rows for i in range(reader.num_record_batches)])
+                arrow_table = reader.read_all()
+                arrow_rows += arrow_table.to_pylist()
+        if row_groups != [[25, 25, 14], [25, 25, 14], [25, 7]] or batches != row_groups:
+            print(f"✗ Unexpected files and batches: parquet {row_groups}, arrow {batches}")
+            return False
+        
+        table = pq.read_table(parquet_files[0])
+        expected_types = {
+            "expiry_date": pa.date32(),
+            "scraped_at": pa.timestamp("us"),
+            "discount_percentage": pa.int32(),
+            "free_shipping": pa.bool_(),
+            "store": pa.dictionary(pa.int32(), pa.string()),
+        }
+        for name, expected in expected_types.items():
+            if table.schema.field(name).type != expected or arrow_table.schema.field(name).type != expected:
+                print(f"✗ Column {name} is {table.schema.field(name).type}, expected {expected}")
+                return False
+        rows = [row for path in parquet_files for row in pq.read_table(path).to_pylist()]
+        if not all(row["title"] and row["store"] and row["scraped_at"] for row in rows) or \
+                not any(row["expiry_date"] for row in rows) or arrow_rows != rows:
+            print(f"✗ Columns lost their values: {rows[0]}")
+            return False
+    
+    print("✓ Typed Parquet and Arrow files, rolled over every 64 rows in row groups of 25")
+    return True
+
+
+def test_segmented_feed():
+    """Test segment rotation, the .part rename and the manifest checksums"""
+    print("\nTesting segmented feed...")
+    
+    import hashlib
+    from scrapy import Spider
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper import feeds
+    from coupon_scraper.items import CouponItem
+    
+    codecs = {"gzip": gzip.decompress}
+    if feeds.zstd is not None:
+        codecs["zstd"] = feeds.zstd.decompress
+    
+    spider = Spider("segments")
+    for compression, decompress in codecs.items():
+        with tempfile.TemporaryDirectory() as temp_dir:
+            crawler = get_crawler(settings_dict={
+                "SEGMENTED_FEED_DIR": temp_dir,
+                "SEGMENTED_FEED_COMPRESSION": compression,
+                "SEGMENTED_FEED_MAX_BYTES": 4000,
+                "SEGMENTED_FEED_MAX_SECONDS": 0,
+            })
+            feed = feeds.SegmentedFeed.from_crawler(crawler)
+            feed.spider_opened(spider)
+            for i in range(50):
+                feed.item_scraped(CouponItem(title=f"Coupon {i}", code=f"CODE{i}", store="Target",
+                                             description="Get 20% off " * 5), spider)
+            
+            # The open segment is only visible under its .part name
+            open_name = feed.segment.name
+            if not os.path.exists(os.path.join(temp_dir, open_name + ".part")) or \
+                    os.path.exists(os.path.join(temp_dir, open_name)):
+                print(f"✗ Open {compression} segment is not a .part file")
+                return False
+            
+            # An old segment is rotated by age
+            feed.max_seconds = 60
+            feed.segment.started -= 61
+            feed.check_age()
+            feed.item_scraped(CouponItem(title="Last coupon"), spider)
+            feed.spider_closed(spider)
+            
+            with open(os.path.join(temp_dir, "manifest.json")) as f:
+                manifest = json.load(f)
+            segments = manifest["segments"]
+            names = sorted(name for name in os.listdir(temp_dir) if name != "manifest.json")
+            if not manifest["complete"] or len(segments) < 3 or names != sorted(s["name"] for s in segments):
+                print(f"✗ Unexpected {compression} segments: {names}, manifest {manifest}")
+                return False
+            if sum(s["items"] for s in segments) != 51 or segments[-1]["items"] != 1:
+                print(f"✗ {compression} segments hold {[s['items'] for s in segments]} items")
+                return False
+            for segment in segments:
+                data = Path(temp_dir, segment["name"]).read_bytes()
+                lines = decompress(data).splitlines()
+                if hashlib.sha256(data).hexdigest() != segment["sha256"] or len(data) != segment["bytes"] or \
+                        len(lines) != segment["items"] or not segment["name"].endswith(feeds.SEGMENT_EXTENSIONS[compression]):
+                    print(f"✗ {segment['name']} doesn't match its manifest entry")
+                    return False
+            if any(s["uncompressed_bytes"] > 4000 + 400 for s in segments) or \
+                    crawler.stats.get_value("segmented_feed/items") != 51:
+                print(f"✗ Segments were not rotated by size: {segments}")
+                return False
+    
+    print(f"✓ Segments rotated by size and age, renamed when complete and checksummed ({', '.join(codecs)})")
+    return True
+
+
+def test_session_affinity():
+    """Test that each download slot keeps one identity until it's recycled or blocked"""
+    print("\nTesting session affinity...")
+    
+    from scrapy.http import Request, Response
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.middlewares import RotateUserAgentMiddleware
+    
+    user_agents = [f"Mozilla/5.0 (Test {i}) Firefox/1{i}0.0" for i in range(5)] + ["Mozilla/5.0 Chrome/120.0"]
+    crawler = get_crawler(settings_dict={
+        "USER_AGENT_LIST": user_agents,
+        "SESSION_AFFINITY_ENABLED": True,
+        "SESSION_MAX_REQUESTS": 5,
+        "SESSION_BLOCK_STATUSES": [403, 429],
+    })
+    middleware = RotateUserAgentMiddleware.from_crawler(crawler)
+    
+    def fetch(url, status=200):
+        request = Request(url)
+        middleware.process_request(request, None)
+        middleware.process_response(request, Response(url, status=status, request=request), None)
+        return request
+    
+    coupons = [fetch(f"https://www.coupons.com/deals/?page={i}") for i in range(5)]
+    other = fetch("https://www.retailmenot.com/")
+    if len({(r.headers["User-Agent"], r.headers["Accept-Language"], r.meta["cookiejar"]) for r in coupons}) != 1:
+        print("✗ Identity changed within a download slot")
+        return False
+    if other.meta["session_id"] == coupons[0].meta["session_id"]:
+        print("✗ Two download slots share a session")
+        return False
+    
+    # The 6th request of a slot starts a new identity
+    recycled = fetch("https://www.coupons.com/deals/?page=5")
+    if recycled.meta["session_id"] == coupons[0].meta["session_id"] or \
+            recycled.headers["User-Agent"] == coupons[0].headers["User-Agent"]:
+        print("✗ Session was not recycled after SESSION_MAX_REQUESTS")
+        return False
+    
+    # A block response rotates the identity for the next request of the slot
+    blocked = fetch("https://www.coupons.com/deals/?page=6", status=429)
+    after_block = fetch("https://www.coupons.com/deals/?page=7")
+    if after_block.meta["session_id"] == blocked.meta["session_id"] or \
+            after_block.headers["User-Agent"] == blocked.headers["User-Agent"] or \
+            fetch("https://www.retailmenot.com/").meta["session_id"] != other.meta["session_id"]:
+        print("✗ Block response did not rotate only the blocked slot's identity")
+        return False
+    
+    stats = crawler.stats.get_stats()
+    if stats.get("session/recycled") != 1 or stats.get("session/rotated_blocked") != 1 or \
+            stats.get("session/blocked/429") != 1 or stats.get("session/created") != 4:
+        print(f"✗ Unexpected session stats: {stats}")
+        return False
+    
+    print("✓ One identity per slot, recycled after 5 requests and rotated on a 429")
+    return True
+
+
+def test_pagination_planner():
+    """Test pagination fan-out against the local multi-page fixtures"""
+    print("\nTesting pagination planner...")
+    
+    from scrapy.http import HtmlResponse, Request
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.pagination import plan_pagination
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    
+    def fixture_response(name, url):
+        return HtmlResponse(url, body=(FIXTURES / name).read_bytes(), encoding="utf-8")
+    
+    numbered = fixture_response("pagination_numbered.html", "https://www.coupons.com/coupon-codes/target/?page=2")
+    expected = expected_numbered = [f"https://www.coupons.com/coupon-codes/target/?page={n}" for n in range(3, 10)]
+    if plan_pagination(numbered) != expected:
+        print(f"✗ Numbered pagination planned {plan_pagination(numbered)}")
+        return False
+    if plan_pagination(numbered, budget=3) != expected[:3]:
+        print("✗ Pagination budget not applied")
+        return False
+    
+    offset = fixture_response("pagination_offset.html", "https://www.coupons.com/printable-coupons/")
+    expected = [f"https://www.coupons.com/printable-coupons/?offset={n}" for n in (20, 40, 60, 80)]
+    if plan_pagination(offset) != expected:
+        print(f"✗ Offset pagination planned {plan_pagination(offset)}")
+        return False
+    
+    # Only the first page seen plans the listing, and the budget covers the whole listing
+    def follow(max_pages, url, request=None):
+        spider = CouponsComSpider.from_crawler(get_crawler(CouponsComSpider, {"PAGINATION_MAX_PAGES": max_pages}))
+        response = HtmlResponse(url, body=numbered.body, encoding="utf-8", request=request or Request(url))
+        return [r for r in spider.follow_pagination(response) if isinstance(r, Request)]
+    
+    planned = follow(6, numbered.url)
+    if [r.url for r in planned] != expected_numbered[:6]:
+        print(f"✗ First page planned {[r.url for r in planned]}")
+        return False
+    if follow(6, planned[1].url, planned[1]):
+        print("✗ A planned page planned the listing again")
+        return False
+    continued = follow(8, planned[-1].url, planned[-1])
+    if [r.url for r in continued] != expected_numbered[-1:] or follow(6, planned[-1].url, planned[-1]):
+        print(f"✗ The last planned page continued the listing with {[r.url for r in continued]}")
+        return False
+    
+    # Without a recognizable pattern the spider chains through the next link
+    next_only = fixture_response("pagination_next_only.html", "https://www.coupons.com/deals/")
+    spider = CouponsComSpider.from_crawler(get_crawler(CouponsComSpider))
+    requests = [r.url for r in spider.follow_pagination(next_only) if isinstance(r, Request)]
+    if plan_pagination(next_only) or requests != ["https://www.coupons.com/deals/more-deals-abc123/"]:
+        print(f"✗ Next link fallback produced {requests}")
+        return False
+    
+    print("✓ Numbered and offset pagination are fanned out, others chained")
+    return True
+
+
+def test_structured_offers():
+    """Test the embedded JSON fast path on a page without coupon card markup"""
+    print("\nTesting embedded JSON extraction...")
+    
+    from scrapy.http import HtmlResponse
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    from coupon_scraper.spiders.coupons_spider import CouponsSpider
+    
+    body = (FIXTURES / "structured_offers.html").read_bytes()
+    response = HtmlResponse("https://www.coupons.com/coupon-codes/target/", body=body, encoding="utf-8")
+    
+    for spidercls in (CouponsComSpider, CouponsSpider):
+        crawler = get_crawler(spidercls)
+        spider = spidercls.from_crawler(crawler)
+        items = {item["title"]: item for item in spider.parse(response) if "title" in item}
+        # JSON-LD and __NEXT_DATA__ repeat the furniture offer; it is kept once
+        if len(items) != 4:
+            print(f"✗ {spidercls.name} extracted {sorted(items)}")
+            return False
+        vitamins = items["15% Off Vitamins & Supplements"]
+        if (vitamins.get("code"), vitamins.get("store"), vitamins.get("description")) != (
+                "VITA-15", "Target", "Valid on health products in store ."):
+            print(f"✗ {spidercls.name} mapped {dict(vitamins)}")
+            return False
+        if items["Free Shipping on Tires"].get("code") != "SHIPFREE":
+            print(f"✗ {spidercls.name} missed the window state offer")
+            return False
+        if crawler.stats.get_value("structured/items") != 4:
+            print(f"✗ {spidercls.name} did not count the structured items")
+            return False
+    
+    print("✓ Offers are extracted from JSON-LD, __NEXT_DATA__ and window state")
+    return True
+
+
+def test_render_on_demand():
+    """Test that only pages without static coupons go to the render service"""
+    print("\nTesting render on demand...")
+    
+    from urllib.parse import parse_qs, urlparse
+    from scrapy.exceptions import IgnoreRequest
+    from scrapy.http import HtmlResponse, Request
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.middlewares import RenderOnDemandMiddleware
+    from coupon_scraper.mocksite import MockSiteConfig, render_page
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    
+    config = MockSiteConfig(js_only_rate=1.0)
+    url = "http://www.coupons.com/deals/"
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        crawler = get_crawler(CouponsComSpider, {
+            "RENDER_ENABLED": True,
+            "RENDER_URL": "http://render:8050",
+            "RENDER_BUDGET": 1,
+            "RENDER_CACHE_DIR": cache_dir,
+        })
+        spider = CouponsComSpider.from_crawler(crawler)
+        middleware = RenderOnDemandMiddleware.from_crawler(crawler)
+        
+        # The static shell has no coupons, so the spider asks for a render
+        shell = HtmlResponse(url, body=render_page(config, "/deals/", 1).encode(), encoding="utf-8",
+                             request=Request(url))
+        middleware.process_response(shell.request, shell, spider)
+        requests = [r for r in spider.parse(shell) if isinstance(r, Request)]
+        if len(requests) != 1 or not requests[0].meta.get("render"):
+            print(f"✗ Shell page produced {requests}")
+            return False
+        
+        endpoint = middleware.process_request(requests[0], spider)
+        if endpoint.meta.get("download_slot") != "render" or \
+                parse_qs(urlparse(endpoint.url).query)["url"] != [url]:
+            print(f"✗ Render request not rewritten: {endpoint}")
+            return False
+        
+        body = render_page(config, "/deals/", 1, rendered=True).encode()
+        rendered = middleware.process_response(
+            endpoint, HtmlResponse(endpoint.url, body=body, encoding="utf-8"), spider)
+        items = [i for i in spider.parse(rendered) if not isinstance(i, Request)]
+        if rendered.url != url or len(items) != config.cards_per_page:
+            print(f"✗ Rendered page gave {len(items)} items at {rendered.url}")
+            return False
+        
+        # Rendered pages are served from the cache without using the budget
+        cached = middleware.process_request(Request(url, meta={"render": True}), spider)
+        if not isinstance(cached, HtmlResponse) or "render_cache" not in cached.flags:
+            print("✗ Rendered page was not cached")
+            return False
+        try:
+            middleware.process_request(Request(url + "?page=2", meta={"render": True}), spider)
+            print("✗ Render budget not enforced")
+            return False
+        except IgnoreRequest:
+            pass
+        
+        # Two distinct pages needed rendering, out of two listing pages
+        middleware.spider_closed(spider)
+        if crawler.stats.get_value("render/requested") != 3 or crawler.stats.get_value("render/pages") != 2 or \
+                crawler.stats.get_value("render/share") != 1.0:
+            print(f"✗ Unexpected render share {crawler.stats.get_value('render/share')}")
+            return False
+        
+        # Then 2 of 4 fetched pages needed rendering
+        for page in range(2, 5):
+            middleware.process_response(shell.request, shell.replace(url=f"{url}?page={page}"), spider)
+        middleware.spider_closed(spider)
+        if crawler.stats.get_value("render/share") != 0.5:
+            print(f"✗ Unexpected render share {crawler.stats.get_value('render/share')} for 2 of 4 pages")
+            return False
+    
+    print("✓ Empty pages are rendered within budget and cached by URL")
+    return True
+
+
+def test_crawl_worker():
+    """Test that a warm worker runs jobs and streams their items back"""
+    print("\nTesting crawl worker...")
+    
+    from coupon_scraper.mocksite import MockSite, MockSiteConfig
+    from run_coupons_scraper import submit_job
+    
+    settings = {
+        "DOWNLOAD_DELAY": 0,
+        "AUTOTHROTTLE_ENABLED": False,
+        "ROBOTSTXT_OBEY": False,
+        "LOG_LEVEL": "ERROR",
+    }
+    with tempfile.TemporaryDirectory() as tmp, MockSite(MockSiteConfig(depth=2)) as site:
+        socket_path = os.path.join(tmp, "worker.sock")
+        env = dict(os.environ, http_proxy=site.base_url)
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "coupon_scraper.worker", "--socket", socket_path,
+             "--jobs-dir", os.path.join(tmp, "jobs")],
+            cwd=Path(__file__).parent, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            if "ready" not in worker.stdout.readline():
+                print("✗ Worker did not start")
+                return False
+            feeds = set()
+            for _ in range(2):
+                job = {"spider": "coupons_com", "start_urls": ["http://www.coupons.com/deals/"], "settings": settings}
+                messages = list(submit_job(job, socket_path))
+                items = [m for m in messages if m["type"] == "item"]
+                finished = messages[-1]
+                if finished["type"] != "finished" or len(items) != 40 or finished["items"] != 40:
+                    print(f"✗ Worker job ended with {finished} after {len(items)} items")
+                    return False
+                if not finished["job_first_request_latency"] <= finished["first_request_latency"]:
+                    print(f"✗ First request latency not reported: {finished}")
+                    return False
+                
+                # The project feed goes to the job's own directory
+                feed = os.path.join(messages[0]["directory"], "coupons.json")
+                with open(feed, "r", encoding="utf-8") as f:
+                    if len(json.load(f)) != 40:
+                        print(f"✗ Job feed {feed} is incomplete")
+                        return False
+                feeds.add(feed)
+            if len(feeds) != 2:
+                print(f"✗ Jobs shared a feed: {feeds}")
+                return False
+            
+            error = list(submit_job({"spider": "missing"}, socket_path))
+            if error[-1]["type"] != "error":
+                print(f"✗ Unknown spider not reported: {error}")
+                return False
+        finally:
+            worker.terminate()
+            worker.wait()
+    
+    print(f"✓ Worker streamed 40 items per job to their own feeds, "
+          f"first request {finished['job_first_request_latency']:.3f}s after the job was received")
+    return True
+
+
+def test_checkpoint_resume():
+    """Test that an interrupted crawl resumes without duplicate or missing items"""
+    print("\nTesting checkpoint and resume...")
+    
+    from coupon_scraper.mocksite import MockSite, MockSiteConfig
+    from run_coupons_scraper import load_items, submit_job
+    
+    settings = {
+        "DOWNLOAD_DELAY": 0,
+        "AUTOTHROTTLE_ENABLED": False,
+        "ROBOTSTXT_OBEY": False,
+        "LOG_LEVEL": "ERROR",
+        "FEEDS": {},
+        "CONCURRENT_REQUESTS": 1,
+    }
+    with tempfile.TemporaryDirectory() as tmp, MockSite(MockSiteConfig(depth=4)) as site:
+        socket_path = os.path.join(tmp, "worker.sock")
+        checkpoint_dir = os.path.join(tmp, "checkpoint")
+        env = dict(os.environ, http_proxy=site.base_url)
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "coupon_scraper.worker", "--socket", socket_path],
+            cwd=Path(__file__).parent, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            if "ready" not in worker.stdout.readline():
+                print("✗ Worker did not start")
+                return False
+            
+            def crawl(extra):
+                job = {"spider": "coupons_com", "start_urls": ["http://www.coupons.com/deals/"],
+                       "settings": dict(settings, **extra)}
+                return list(submit_job(job, socket_path))[-1]
+            
+            # Stopped after two pages, then resumed from the checkpoint
+            crawl({"CHECKPOINT_DIR": checkpoint_dir, "CLOSESPIDER_PAGECOUNT": 2})
+            partial = len(load_items(os.path.join(checkpoint_dir, "items.jsonl")))
+            finished = crawl({"CHECKPOINT_DIR": checkpoint_dir, "CHECKPOINT_RESUME": True})
+            if finished["type"] != "finished" or not finished["stats"].get("checkpoint/resumed_pending"):
+                print(f"✗ Crawl was not resumed: {finished}")
+                return False
+            resumed = load_items(os.path.join(checkpoint_dir, "items.jsonl"))
+            
+            full_dir = os.path.join(tmp, "full")
+            crawl({"CHECKPOINT_DIR": full_dir})
+            full = load_items(os.path.join(full_dir, "items.jsonl"))
+        finally:
+            worker.terminate()
+            worker.wait()
+    
+    keys = [(item["title"], item.get("code"), item["store"]) for item in resumed]
+    if not 0 < partial < len(full):
+        print(f"✗ Interrupted crawl exported {partial} of {len(full)} items")
+        return False
+    if len(keys) != len(set(keys)) or set(keys) != {(i["title"], i.get("code"), i["store"]) for i in full}:
+        print(f"✗ Resumed crawl exported {len(keys)} items ({len(set(keys))} unique), expected {len(full)}")
+        return False
+    
+    print(f"✓ Resumed after {partial} items and finished with the same {len(full)} items")
+    return True
+
+
+def test_coupon_store():
+    """Test the expiry-indexed coupon store and its pipeline"""
+    print("\nTesting coupon store...")
+    
+    from datetime import date, timedelta
+    from scrapy.exceptions import DropItem
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.items import CouponItem
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    from coupon_scraper.store import CouponStore, CouponStorePipeline
+    from run_coupons_scraper import load_items
+    
+    today = date.today()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "store.jsonl")
+        archive = os.path.join(tmp, "archive.jsonl")
+        store = CouponStore(path, archive)
+        for days in (-2, -1, 0, 3, 3, 10):
+            store.add(f"c{days}:{len(store)}", {"title": f"In {days} days"}, today + timedelta(days=days))
+        store.add("open", {"title": "No expiry"})
+        
+        if store.count_active(today) != 5 or len(list(store.active(today + timedelta(days=4)))) != 2:
+            print(f"✗ Active counts wrong: {store.count_active(today)}")
+            return False
+        expired = store.evict(today)
+        if len(expired) != 2 or len(store) != 5 or len(load_items(archive)) != 2:
+            print(f"✗ Evicted {len(expired)} coupons, {len(store)} left")
+            return False
+        store.save()
+        if CouponStore(path).count_active(today + timedelta(days=5)) != 2:
+            print("✗ Reloaded store lost its index")
+            return False
+        
+        crawler = get_crawler(CouponsComSpider, {"COUPON_STORE_FILE": path, "COUPON_STORE_DROP_EXPIRED": True})
+        spider = CouponsComSpider.from_crawler(crawler)
+        pipeline = CouponStorePipeline.from_crawler(crawler)
+        pipeline.spider_opened(spider)
+        pipeline.process_item(CouponItem(title="Fresh", store="Target",
+                                         expiry_date=f"Expires {today:%m/%d/%Y}"), spider)
+        try:
+            pipeline.process_item(CouponItem(title="Stale", store="Target", expiry_date="Expires 01/02/2020"), spider)
+            print("✗ Expired coupon was not dropped")
+            return False
+        except DropItem:
+            pass
+        pipeline.spider_closed(spider)
+        if crawler.stats.get_value("coupon_store/active") != 6:
+            print(f"✗ Store holds {crawler.stats.get_value('coupon_store/active')} coupons")
+            return False
+    
+    print("✓ Coupon store evicts, archives and answers active-as-of queries")
+    return True
+
+
+def test_sink_fanout():
+    """Test that sink writers batch items, spill them while a sink is down and replay them"""
+    print("\nTesting sink fan-out...")
+    
+    import asyncio
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.sinks import JsonLinesSink, Sink, SinkWriter
+    from run_coupons_scraper import load_items
+    
+    class FlakySink(Sink):
+        def __init__(self, name):
+            super().__init__(name)
+            self.down = True
+            self.received = []
+            self.closed = False
+        
+        async def write(self, items):
+            if self.down:
+                raise ConnectionError("sink is down")
+            self.received.extend(items)
+        
+        async def close(self):
+            self.closed = True
+    
+    stats = get_crawler().stats
+    items = [{"title": f"Coupon {i}"} for i in range(7)]
+    
+    async def run(tmp):
+        flaky = FlakySink("flaky")
+        options = dict(queue_size=10, batch_size=3, flush_interval=0.05, retries=1, retry_delay=0.01,
+                       spill_dir=os.path.join(tmp, "spill"))
+        writers = [SinkWriter(flaky, stats, **options),
+                   SinkWriter(JsonLinesSink("file", os.path.join(tmp, "items.jsonl")), stats, **options)]
+        for writer in writers:
+            await writer.start()
+        for item in items:
+            for writer in writers:
+                await writer.put(item)
+        for writer in writers:
+            await writer.close()
+        
+        # The next run finds the sink back up and writes the spilled items first
+        flaky.down = False
+        writer = SinkWriter(flaky, stats, **options)
+        await writer.start()
+        await writer.close()
+        
+        # A writer whose task died (its spill directory is a file) fails the
+        # puts instead of blocking them, and still closes its sink
+        broken = FlakySink("broken")
+        writer = SinkWriter(broken, stats, **dict(options, queue_size=2, batch_size=1, retries=0,
+                                                 spill_dir=os.path.join(tmp, "items.jsonl")))
+        await writer.start()
+        failures = []
+        for item in items:
+            try:
+                await asyncio.wait_for(writer.put(item), 5)
+            except RuntimeError as e:
+                failures.append(e)
+        try:
+            await writer.close()
+        except OSError as e:
+            failures.append(e)
+        return flaky.received, failures, broken.closed
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        received, failures, broken_closed = asyncio.run(run(tmp))
+        written = load_items(os.path.join(tmp, "items.jsonl"))
+        spill_left = os.path.exists(os.path.join(tmp, "spill", "flaky.jsonl"))
+    
+    if written != items or stats.get_value("sinks/file/batches") != 3:
+        print(f"✗ File sink wrote {len(written)} items in {stats.get_value('sinks/file/batches')} batches")
+        return False
+    if stats.get_value("sinks/flaky/spilled") != 7 or received != items or spill_left:
+        print(f"✗ Spilled {stats.get_value('sinks/flaky/spilled')} items, replayed {len(received)}")
+        return False
+    if not failures or not isinstance(failures[-1], OSError) or not broken_closed:
+        print(f"✗ Failed writer raised {failures}, closed its sink: {broken_closed}")
+        return False
+    
+    print(f"✓ Sinks batched, spilled and replayed {len(items)} items "
+          f"({stats.get_value('sinks/flaky/retries')} retries), a failed writer raised {len(failures)} times")
+    return True
+
+
+def test_benchmark_gate():
+    """Test the benchmark workload and the regression comparison"""
+    print("\nTesting benchmark gate...")
+    
+    import run_benchmarks
+    
+    pages = run_benchmarks.load_pages()
+    items, timings = run_benchmarks.parse_workload("coupons_com", pages["coupons_com"], 1)()
+    if items != 70 or len(timings) != 3:
+        print(f"✗ Stored pages gave {items} items in {len(timings)} parses")
+        return False
+    
+    baseline = {"parse/x": {"items_per_sec": 1000.0, "p95_ms": 10.0, "peak_mb": 1.0}}
+    tolerances = run_benchmarks.DEFAULT_TOLERANCES
+    
+    def statuses(results):
+        return [row[-1] for row in run_benchmarks.compare(baseline, results, tolerances)]
+    
+    if statuses({"parse/x": {"items_per_sec": 950.0, "p95_ms": 11.0, "peak_mb": 1.0}}) != ["ok", "ok", "ok"]:
+        print("✗ Change within tolerance flagged")
+        return False
+    if statuses({"parse/x": {"items_per_sec": 500.0, "p95_ms": 20.0, "peak_mb": 2.0}}) != ["REGRESSION"] * 3:
+        print("✗ Regression not flagged")
+        return False
+    
+    # Half as fast while the machine is half as fast is no regression, even
+    # when the machine only slows down halfway through the rounds
+    class DriftingCalibration:
+        reference = 10.0
+        timings = iter([10.0, 10.0, 20.0, 20.0, 20.0])
+        
+        def run(self):
+            return next(self.timings)
+    
+    speeds = iter([1, 1, 0.5, 0.5, 0.5])
+    
+    def workload():
+        return 100, [0.05 / next(speeds, 1)] * 20
+    
+    result = run_benchmarks.measure(workload, 4, True, DriftingCalibration())
+    if result["items_per_sec"] != 100.0 or result["p95_ms"] != 50.0:
+        print(f"✗ Machine speed not taken into account: {result}")
+        return False
+    
+    print(f"✓ Benchmark workload parsed {items} items, regressions flagged")
+    return True
+
+
+def test_normalization():
+    """Test the shared field normalization and the pipelines skipping normalized items"""
+    print("\nTesting normalization...")
+    
+    from itemadapter import ItemAdapter
+    from scrapy import Spider
+    from coupon_scraper.items import CouponItem, NormalizedCouponItem
+    from coupon_scraper.normalize import clean_code, clean_expiry, clean_text, parse_expiry_date, squash_code
+    from coupon_scraper.offers import offer_fields
+    from coupon_scraper.pipelines import CleanDataPipeline, CouponValidationPipeline, DuplicatesPipeline
+    
+    checks = [
+        (clean_text("  Deal:  20% off   shoes "), "20% off shoes"),
+        (clean_text("Free shipping coupon"), "Free shipping"),
+        (clean_code(" save-20 now! "), "SAVE20NOW"),
+        (squash_code(" save-20 now "), "SAVE-20NOW"),
+        (clean_expiry("Expires: Dec 31, 2025"), "Dec 31, 2025"),
+        (clean_expiry("valid until 12/31/2025"), "12/31/2025"),
+        (str(parse_expiry_date("Ends December 31, 2025")), "2025-12-31"),
+        (offer_fields("Up to 50% sitewide, save 20% today"), {"discount_percentage": 20}),
+        (offer_fields("No discount here"), {}),
+    ]
+    for value, expected in checks:
+        if value != expected:
+            print(f"✗ Normalized to {value!r}, expected {expected!r}")
+            return False
+    
+    item = NormalizedCouponItem(title="20% Off Shoes", code="SAVE-20", store="Demo Store")
+    unmarked = CouponItem(title=" 20% Off Shoes ", code="save20", store="Demo Store ")
+    if DuplicatesPipeline.item_id(item) != DuplicatesPipeline.item_id(unmarked):
+        print("✗ Normalized and raw items have different ids")
+        return False
+    if not isinstance(item.copy(), NormalizedCouponItem) or \
+            DuplicatesPipeline.item_id(ItemAdapter(item).asdict()) != DuplicatesPipeline.item_id(item):
+        print("✗ Normalization mark or deduplication key lost when the item is copied")
+        return False
+    
+    CleanDataPipeline().process_item(unmarked, None)
+    if unmarked.get("discount_percentage") != 20 or "discount_percentage" in item:
+        print("✗ CleanDataPipeline did not skip only the normalized item")
+        return False
+    
+    short = NormalizedCouponItem(title="Shoes", code="AB")
+    CouponValidationPipeline().process_item(short, Spider(name="test"))
+    CouponValidationPipeline().process_item(item, Spider(name="test"))
+    if "code" in short or item["code"] != "SAVE-20":
+        print("✗ Validation of normalized codes")
+        return False
+    
+    print("✓ Fields normalized once, pipelines skip normalized items")
+    return True
+
+
+def test_card_cache():
+    """Test that identical cards are extracted once, within and across runs"""
+    print("\nTesting card cache...")
+    
+    from itemadapter import is_item
+    from scrapy.http import HtmlResponse, Request
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    import run_benchmarks
+    
+    url, body = run_benchmarks.load_pages()["coupons_com"][0]
+    
+    def crawl(settings, profile=None):
+        crawler = get_crawler(CouponsComSpider, settings)
+        spider = CouponsComSpider.from_crawler(crawler)
+        if profile:
+            spider.card_profile = profile
+        items = []
+        for _ in range(2):
+            response = HtmlResponse(url, body=body, encoding="utf-8", request=Request(url))
+            items += [dict(item, scraped_at=None) for item in spider.parse(response) if is_item(item)]
+        if spider.card_cache:
+            spider.card_cache.spider_closed(spider)
+        return items, crawler.stats
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings = {"CARD_CACHE_ENABLED": True, "CARD_CACHE_FILE": os.path.join(temp_dir, "cards.json")}
+        plain, _ = crawl({})
+        cached, stats = crawl(settings)
+        if cached != plain or stats.get_value("card_cache/hits") < len(plain) // 2:
+            print(f"✗ Cached extraction differs or missed: {stats.get_value('card_cache/hits')} hits")
+            return False
+        
+        # The next run starts from the saved cache
+        _, stats = crawl(settings)
+        if stats.get_value("card_cache/misses") != 0:
+            print(f"✗ Saved cache not reused: {stats.get_value('card_cache/misses')} misses")
+            return False
+        
+        _, stats = crawl(settings, profile="coupons_com:test")
+        if stats.get_value("card_cache/misses") == 0:
+            print("✗ Entries of another extraction profile were used")
+            return False
+    
+    print(f"✓ {len(plain)} items extracted once per card and reused by the next run")
+    return True
+
+
+def test_http2_fallback():
+    """Test HTTP/2 downloads and the fallback to HTTP/1.1"""
+    print("\nTesting HTTP/2 downloads...")
+    
+    from coupon_scraper import http2
+    from coupon_scraper.mocksite import MockSite, MockSiteConfig
+    import run_load_test
+    
+    if http2.H2DownloadHandler is None:
+        print("⚠ h2 not installed, skipping")
+        return True
+    
+    for site_http2 in (True, False):
+        with tempfile.TemporaryDirectory() as tmp, \
+                MockSite(MockSiteConfig(depth=2), tls=True, http2=site_http2) as site:
+            dns_cache = os.path.join(tmp, "dnscache.json")
+            run_load_test.seed_dns_cache(dns_cache, run_load_test.TLS_HOST, site.host)
+            job = {
+                "spider": "coupons_com",
+                "protocol": "h2",
+                "concurrency": 4,
+                "start_urls": site.start_urls(f"https://{run_load_test.TLS_HOST}:{site.port}"),
+                "settings": {"HTTP2_ENABLED": True, "DNSCACHE_FILE": dns_cache, "HTTPPROXY_ENABLED": False},
+                "feed": None,
+                "log_level": "ERROR",
+            }
+            result = run_load_test.run_crawl(job)
+        if not result or result["items"] != 160 or \
+                result["http2_requests"] != (result["requests"] if site_http2 else 0):
+            print(f"✗ Crawl of {'an HTTP/2' if site_http2 else 'an HTTP/1.1 only'} site: {result}")
+            return False
+    
+    print("✓ 160 items over HTTP/2, and over HTTP/1.1 from a site without HTTP/2")
+    return True
+
+
+def test_sampling_profiler():
+    """Test that a profiling session writes collapsed stacks and attributes time"""
+    print("\nTesting sampling profiler...")
+    
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.profiler import SamplingProfiler
+    from coupon_scraper.spiders.coupons_com_spider import CouponsComSpider
+    import run_benchmarks
+    
+    pages = run_benchmarks.load_pages()["coupons_com"]
+    parse = run_benchmarks.parse_workload("coupons_com", pages, 20)
+    # Enough items for the pipelines to get samples at the 1 ms interval
+    pipelines = run_benchmarks.pipeline_workload(50000)
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        crawler = get_crawler(CouponsComSpider, {"PROFILER_ENABLED": True, "PROFILER_DIR": temp_dir,
+                                                 "PROFILER_INTERVAL": 0.001})
+        profiler = SamplingProfiler(crawler)
+        profiler.start()
+        parse()
+        pipelines()
+        path = profiler.stop()
+        with open(path) as f:
+            lines = f.read().splitlines()
+    
+    stats = crawler.stats.get_stats()
+    if not lines or not all(line.rsplit(" ", 1)[1].isdigit() for line in lines):
+        print(f"✗ Bad collapsed stacks: {lines[:3]}")
+        return False
+    spots = [key for key in ("CouponsComSpider.parse", "CouponsComSpider.extract_card_fields",
+                             "parsel Selector.css", "DuplicatesPipeline.process_item")
+             if f"profiler/time/{key}" not in stats]
+    if spots or not any("CouponsComSpider.parse" in line for line in lines):
+        print(f"✗ No time attributed to {spots}")
+        return False
+    
+    print(f"✓ {stats['profiler/samples']} samples written as {len(lines)} collapsed stacks")
+    return True
+
+
+def test_offer_grammar():
+    """Test the offer terms read from titles and descriptions"""
+    print("\nTesting offer grammar...")
+    
+    from coupon_scraper.offers import offer_fields, scan_offer
+    
+    checks = [
+        ("20% Off Shoes", None, {"discount_percentage": 20}),
+        ("Up to 50% sitewide, save 20% today", None, {"discount_percentage": 20}),
+        ("Spend $50, Get $10 Off", "Plus free shipping", {"discount_amount": 10.0, "minimum_spend": 50.0,
+                                                           "free_shipping": True}),
+        ("Extra 15% off orders of $1,000 or more", None, {"discount_percentage": 15, "minimum_spend": 1000.0}),
+        ("$5 off $25+", None, {"discount_amount": 5.0, "minimum_spend": 25.0}),
+        ("Buy Two, Get One 50% Off Tires", None, {"bogo": "buy 2 get 1 50% off"}),
+        ("BOGO Pizza", "Get 30% off sides", {"bogo": "buy 1 get 1 free", "discount_percentage": 30}),
+        ("Shoes from $19.99", "New arrivals", {}),
+        # A bare amount after "orders" is a discount, and "min" only counts as a word
+        ("Mobile orders $5 off", None, {"discount_amount": 5.0}),
+        ("App purchases $10 off", None, {"discount_amount": 10.0}),
+        ("Save 10 minutes, $5 off", None, {"discount_amount": 5.0}),
+        ("Admin $20 off", None, {"discount_amount": 20.0}),
+        ("Free shipping over $49", None, {"minimum_spend": 49.0, "free_shipping": True}),
+        ("Minimum purchase of $30", None, {"minimum_spend": 30.0}),
+    ]
+    for title, description, expected in checks:
+        fields = offer_fields(title, description)
+        if fields != expected:
+            print(f"✗ {title!r} gave {fields}, expected {expected}")
+            return False
+    
+    offer_fields("20% Off Shoes")
+    if scan_offer.cache_info().hits == 0:
+        print("✗ Repeated title scanned again")
+        return False
+    
+    print(f"✓ Offer terms extracted from {len(checks)} titles")
+    return True
+
+
+def test_compact_dupefilter():
+    """Test the compact dupefilter, its growth and its JOBDIR resume"""
+    print("\nTesting compact dupefilter...")
+    
+    from scrapy.dupefilters import RFPDupeFilter
+    from scrapy.http import Request
+    from scrapy.utils.test import get_crawler
+    from coupon_scraper.dupefilters import TABLE_FILE, CompactDupeFilter
+    
+    requests = [Request(f"https://www.coupons.com/deals/?page={i}") for i in range(500)]
+    
+    with tempfile.TemporaryDirectory() as jobdir:
+        crawler = get_crawler(settings_dict={"JOBDIR": jobdir, "DUPEFILTER_CAPACITY": 16})
+        dupefilter = CompactDupeFilter.from_crawler(crawler)
+        first = [dupefilter.request_seen(r) for r in requests[:300]]
+        again = [dupefilter.request_seen(r) for r in requests[:300]]
+        dupefilter.close("shutdown")
+        if any(first) or not all(again) or dupefilter.table.capacity < 300:
+            print(f"✗ {sum(first)} new requests seen, {300 - sum(again)} repeats missed")
+            return False
+        
+        # The resumed run maps the table back
+        dupefilter = CompactDupeFilter.from_crawler(crawler)
+        resumed = [dupefilter.request_seen(r) for r in requests]
+        dupefilter.close("finished")
+        if resumed != [True] * 300 + [False] * 200:
+            print(f"✗ Resumed filter saw {sum(resumed)} of 300 earlier requests")
+            return False
+    
+    with tempfile.TemporaryDirectory() as jobdir:
+        legacy = RFPDupeFilter(jobdir)
+        for request in requests[:100]:
+            legacy.request_seen(request)
+        legacy.close("shutdown")
+        dupefilter = CompactDupeFilter.from_crawler(get_crawler(settings_dict={"JOBDIR": jobdir}))
+        imported = len(dupefilter.table)
+        dupefilter.close("finished")
+        if imported != 100 or not os.path.exists(os.path.join(jobdir, TABLE_FILE)):
+            print(f"✗ Imported {imported} of 100 fingerprints from requests.seen")
+            return False
+    
+    print("✓ Duplicates filtered across table growth and a JOBDIR resume")
+    return True
+
+
 def main():
     """Run all tests"""
     print("Coupon Scraper Test Suite")
@@ -110,7 +1346,29 @@ def main():
     tests = [
         test_project_structure,
         test_scrapy_installation,
-        test_demo_spider
+        test_demo_spider,
+        test_sitemap_discovery,
+        test_revisit_scheduler,
+        test_memory_diagnostics,
+        test_mock_site_markup,
+        test_persistent_caches,
+        test_columnar_exporters,
+        test_segmented_feed,
+        test_session_affinity,
+        test_pagination_planner,
+        test_structured_offers,
+        test_render_on_demand,
+        test_crawl_worker,
+        test_checkpoint_resume,
+        test_coupon_store,
+        test_sink_fanout,
+        test_benchmark_gate,
+        test_normalization,
+        test_offer_grammar,
+        test_card_cache,
+        test_http2_fallback,
+        test_sampling_profiler,
+        test_compact_dupefilter,
     ]
     
     passed = 0